@@ -0,0 +1,262 @@
+"""
+Batch processing of many scenes in one long-lived process: masks, cloud shade, and DAAC
+conversion for every scene in a manifest, with scenes spread over a pool of worker processes.
+
+The manifest is either a CSV file with a header row or a JSON list of objects, one scene per
+entry, with the fields in SCENE_FIELDS.  'shade_cloudfile' is an optional binary cloud product
+(value 1) to cast shadows from; without it, shadows are cast from the SpecTf-Cloud probability in
+'cloudfile' above SPECTF_THRESHOLD, which is the SpecTf-Cloud Flag of the masks.  With --fused,
+shadows are always cast from that flag, and 'maskfile' and 'shadefile' are only written with
+--keep_intermediate.  The shade stage takes the pixel size from the GLT grid in both cases.
+"""
+
+import argparse
+import contextlib
+import csv
+import json
+import logging
+import os
+import time
+import traceback
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+import make_emit_masks
+import cloud_shade
+import output_conversion
+from fused_pipeline import run_pipeline
+
+
+SCENE_FIELDS = ['scene_id', 'rdnfile', 'locfile', 'obsfile', 'atmfile', 'cloudfile', 'gltfile',
+                'maskfile', 'shadefile', 'ncfile']
+STAGES = ['masks', 'shade', 'daac']
+
+
+def read_manifest(manifest_file):
+    """ Read the scenes of a batch manifest
+
+    :param manifest_file: CSV file with a header row, or JSON file with a list of objects
+
+    :return: list of scene dictionaries
+    """
+    with open(manifest_file, 'r') as fin:
+        if os.path.splitext(manifest_file)[1].lower() == '.json':
+            scenes = json.load(fin)
+        else:
+            scenes = [row for row in csv.DictReader(fin)]
+
+    for n, scene in enumerate(scenes):
+        missing = [f for f in SCENE_FIELDS if not scene.get(f)]
+        if len(missing) > 0:
+            raise ValueError(f'Manifest entry {n} is missing fields: {", ".join(missing)}')
+    return scenes
+
+
+def stage_args(stage, scene, args):
+    """ Command line arguments of one stage for one scene
+
+    :param stage: one of STAGES
+    :param scene: scene dictionary from the manifest
+    :param args: parsed batch arguments
+
+    :return: list of argument strings
+    """
+    if stage == 'masks':
+        input_args = [scene['rdnfile'], scene['locfile'], scene['obsfile'], scene['atmfile'], scene['cloudfile'],
+                      args.irrfile, scene['maskfile'], '--n_cores', str(args.scene_cores),
+                      '--aerosol_threshold', str(args.aerosol_threshold), '--chunk_lines', str(args.chunk_lines)]
+        if args.wavelengths is not None:
+            input_args += ['--wavelengths', args.wavelengths]
+        if args.irradiance_cache is not None:
+            input_args += ['--irradiance_cache', args.irradiance_cache]
+        if args.stage_cache_dir is not None:
+            input_args += ['--stage_cache_dir', os.path.join(args.stage_cache_dir, scene['scene_id'])]
+        if args.pixel_size_cache_dir is not None:
+            input_args += ['--pixel_size_cache_dir', args.pixel_size_cache_dir]
+        return input_args
+    if stage == 'shade':
+        # Traced on the GLT grid, with its spacing, as in fused_pipeline
+        if scene.get('shade_cloudfile'):
+            input_args = [scene['shade_cloudfile']]
+        else:
+            input_args = [scene['cloudfile'], '--cloud_threshold', str(make_emit_masks.SPECTF_THRESHOLD)]
+        input_args += [scene['obsfile'], scene['gltfile'], scene['shadefile'], '--log_level', args.log_level]
+        if args.glt_cache_dir is not None:
+            input_args += ['--glt_cache_dir', args.glt_cache_dir]
+        return input_args
+    if stage == 'daac':
+        input_args = [scene['ncfile'], scene['maskfile'], scene['locfile'], scene['gltfile'], args.version,
+                      args.software_delivery_version, '--log_level', args.log_level]
+        if 'shade' in args.stages:
+            input_args += ['--shade_file', scene['shadefile']]
+        return input_args
+    raise ValueError(f'Unknown stage: {stage}')
+
+
+def run_stage(stage, input_args):
+    """ Run one stage in this process """
+    if stage == 'masks':
+        make_emit_masks.main(input_args)
+    elif stage == 'shade':
+        cloud_shade.main.main(args=input_args, standalone_mode=False)
+    elif stage == 'daac':
+        output_conversion.main(input_args)
+
+
+def run_fused(scene, args):
+    """ Run all stages of one scene in memory, through fused_pipeline
+
+    :return: dictionary of wall time in s per stage
+    """
+    keep = args.keep_intermediate
+    return run_pipeline(scene['rdnfile'], scene['locfile'], scene['obsfile'], scene['atmfile'], scene['cloudfile'],
+                        scene['gltfile'], args.irrfile, scene['ncfile'], args.version,
+                        args.software_delivery_version, mask_outfile=scene['maskfile'] if keep else None,
+                        shade_outfile=scene['shadefile'] if keep else None, shade='shade' in args.stages,
+                        wavelengths=args.wavelengths, n_cores=args.scene_cores,
+                        aerosol_threshold=args.aerosol_threshold, chunk_lines=args.chunk_lines,
+                        irradiance_cache=args.irradiance_cache, glt_cache_dir=args.glt_cache_dir,
+                        stage_cache_dir=(os.path.join(args.stage_cache_dir, scene['scene_id'])
+                                         if args.stage_cache_dir is not None else None),
+                        pixel_size_cache_dir=args.pixel_size_cache_dir)
+
+
+def process_scene(scene, args):
+    """ Run the requested stages for one scene, timing each of them.  Failures are recorded
+    rather than raised, so that one bad scene does not stop the batch.
+
+    :param scene: scene dictionary from the manifest
+    :param args: parsed batch arguments
+
+    :return: dictionary with the scene id, status, per-stage wall times in s, and any error
+    """
+    result = {'scene_id': scene['scene_id'], 'pid': os.getpid(), 'status': 'ok', 'stages': {}}
+    scene_start = time.perf_counter()
+    if args.fused:
+        try:
+            result['stages'] = run_fused(scene, args)
+        except Exception as e:
+            result['status'] = 'failed'
+            result['failed_stage'] = 'fused'
+            result['error'] = f'{type(e).__name__}: {e}'
+            logging.error(f'Scene {scene["scene_id"]} failed:\n{traceback.format_exc()}')
+    else:
+        for stage in args.stages:
+            stage_start = time.perf_counter()
+            try:
+                run_stage(stage, stage_args(stage, scene, args))
+            except Exception as e:
+                result['status'] = 'failed'
+                result['failed_stage'] = stage
+                result['error'] = f'{type(e).__name__}: {e}'
+                logging.error(f'Scene {scene["scene_id"]} failed in {stage}:\n{traceback.format_exc()}')
+                break
+            finally:
+                result['stages'][stage] = time.perf_counter() - stage_start
+    result['total'] = time.perf_counter() - scene_start
+    logging.info(f'Scene {scene["scene_id"]} {result["status"]} in {result["total"]:.1f} s')
+    return result
+
+
+def _init_worker(log_level, log_file):
+    """ Configure logging once per worker process """
+    logging.basicConfig(format='%(asctime)s %(levelname)s [%(process)d]: %(message)s', level=log_level,
+                        filename=log_file)
+
+
+def summarize(results, wall_time, n_workers):
+    """ Batch summary, for sizing processing resources
+
+    :param results: per-scene results from process_scene
+    :param wall_time: wall time of the whole batch, s
+    :param n_workers: number of worker processes
+
+    :return: summary dictionary
+    """
+    summary = {'n_scenes': len(results),
+               'n_failed': sum(r['status'] != 'ok' for r in results),
+               'n_workers': n_workers,
+               'wall_time': wall_time,
+               'scenes_per_hour': 3600 * len(results) / wall_time if wall_time > 0 else None,
+               'stages': {}}
+    for stage in STAGES + ['total']:
+        times = [r['stages'][stage] if stage != 'total' else r['total'] for r in results
+                 if r['status'] == 'ok' and (stage == 'total' or stage in r['stages'])]
+        if len(times) > 0:
+            summary['stages'][stage] = {'mean': float(np.mean(times)), 'median': float(np.median(times)),
+                                        'p95': float(np.percentile(times, 95)), 'max': float(np.max(times)),
+                                        'sum': float(np.sum(times))}
+    return summary
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Run masks, cloud shade and DAAC conversion for a manifest of scenes")
+    parser.add_argument('manifest', type=str, metavar='MANIFEST', help='CSV or JSON manifest of scenes')
+    parser.add_argument('irrfile', type=str, metavar='SOLAR_IRRADIANCE')
+    parser.add_argument('--stages', type=str, nargs='+', choices=STAGES, default=STAGES)
+    parser.add_argument('--fused', action='store_true',
+                        help='Pass masks and shade to the netCDF writer in memory (see fused_pipeline.py)')
+    parser.add_argument('--keep_intermediate', action='store_true',
+                        help='With --fused, still write the ENVI mask and GeoTIFF shade products')
+    parser.add_argument('--n_workers', type=int, default=1,
+                        help='Number of scenes processed at once, -1 to use all available cores')
+    parser.add_argument('--scene_cores', type=int, default=1,
+                        help='Number of mask threads within each scene')
+    parser.add_argument('--wavelengths', type=str, default=None)
+    parser.add_argument('--aerosol_threshold', type=float, default=0.5)
+    parser.add_argument('--chunk_lines', type=int, default=256)
+    parser.add_argument('--irradiance_cache', type=str, default=None)
+    parser.add_argument('--glt_cache_dir', type=str, default=None)
+    parser.add_argument('--pixel_size_cache_dir', type=str, default=None)
+    parser.add_argument('--stage_cache_dir', type=str, default=None,
+                        help='Directory of per-scene stage caches, so reruns only recompute changed stages')
+    parser.add_argument('--version', type=str, default='V001', help="3 digit (with leading V) version number")
+    parser.add_argument('--software_delivery_version', type=str, default='',
+                        help="The extended build number at delivery time")
+    parser.add_argument('--timing_file', type=str, default=None,
+                        help='JSON lines file with the timing of each scene, written as scenes complete')
+    parser.add_argument('--summary_file', type=str, default=None, help='JSON file with the batch summary')
+    parser.add_argument('--log_file', type=str, default=None)
+    parser.add_argument('--log_level', type=str, default='INFO')
+    args = parser.parse_args()
+    if args.fused and not {'masks', 'daac'}.issubset(args.stages):
+        parser.error('--fused runs the masks and daac stages together; drop --fused to run a subset of them')
+
+    _init_worker(args.log_level, args.log_file)
+
+    scenes = read_manifest(args.manifest)
+    n_workers = os.cpu_count() if args.n_workers == -1 else max(1, args.n_workers)
+    n_workers = min(n_workers, max(1, len(scenes)))
+    logging.info(f'Processing {len(scenes)} scenes with {n_workers} workers: {" -> ".join(args.stages)}')
+
+    start = time.perf_counter()
+    results = []
+    with contextlib.ExitStack() as stack:
+        timing_out = stack.enter_context(open(args.timing_file, 'w')) if args.timing_file is not None else None
+        if n_workers == 1:
+            result_iter = (process_scene(scene, args) for scene in scenes)
+        else:
+            executor = stack.enter_context(ProcessPoolExecutor(max_workers=n_workers, initializer=_init_worker,
+                                                               initargs=(args.log_level, args.log_file)))
+            result_iter = executor.map(process_scene, scenes, [args] * len(scenes))
+
+        for result in result_iter:
+            results.append(result)
+            if timing_out is not None:
+                timing_out.write(json.dumps(result) + '\n')
+                timing_out.flush()
+
+    summary = summarize(results, time.perf_counter() - start, n_workers)
+    logging.info(f'Processed {summary["n_scenes"]} scenes, {summary["n_failed"]} failed, '
+                 f'in {summary["wall_time"]:.1f} s')
+    if args.summary_file is not None:
+        with open(args.summary_file, 'w') as fout:
+            json.dump(summary, fout, indent=2)
+
+    if summary['n_failed'] > 0:
+        raise SystemExit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,61 @@
+"""
+Bounded-radius buffer distance transform against the whole-scene transform, over cloud
+fractions, with peak memory of the numpy allocations and a check that both agree within
+the radius.
+
+Run from the repository root:
+    python -m benchmarks.buffer_distance --size 1280 --radius 40 --cloud_fractions 0 0.001 0.01 0.1 0.4
+"""
+
+import argparse
+import time
+import tracemalloc
+
+import numpy as np
+from scipy.ndimage import distance_transform_edt
+
+import make_emit_masks
+from benchmarks.synthetic import synthetic_cloud_field
+
+
+def measure(fn, repeats):
+    """ Minimum wall time over repeats, and peak traced memory of one call, in MB """
+    times = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        result = fn()
+        times.append(time.perf_counter() - start)
+    tracemalloc.start()
+    fn()
+    peak = tracemalloc.get_traced_memory()[1] / 1e6
+    tracemalloc.stop()
+    return result, min(times), peak
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark bounded-radius buffer distances")
+    parser.add_argument('--size', type=int, default=1280)
+    parser.add_argument('--radius', type=int, default=40)
+    parser.add_argument('--cloud_fractions', type=float, nargs='+', default=[0, 0.001, 0.01, 0.1, 0.4])
+    parser.add_argument('--tile_size', type=int, default=make_emit_masks.BUFFER_TILE_SIZE)
+    parser.add_argument('--repeats', type=int, default=3)
+    args = parser.parse_args()
+
+    print(f'{"cloud":>6} {"full s":>8} {"full MB":>8} {"bounded s":>10} {"bounded MB":>11} {"speedup":>8} {"exact":>6}')
+    for cloud_fraction in args.cloud_fractions:
+        featureless = np.logical_not(synthetic_cloud_field((args.size, args.size), cloud_fraction, feature_size=4))
+        if cloud_fraction > 0 and np.all(featureless):
+            featureless[args.size // 2, args.size // 2] = False
+
+        full, full_time, full_peak = measure(lambda: distance_transform_edt(featureless), args.repeats)
+        bounded, bounded_time, bounded_peak = measure(
+            lambda: make_emit_masks.buffer_distance(featureless, args.radius, tile_size=args.tile_size), args.repeats)
+
+        inside = full <= args.radius
+        exact = np.array_equal(full[inside], bounded[inside]) and np.all(bounded[~inside] > args.radius)
+        print(f'{cloud_fraction:>6.3f} {full_time:>8.3f} {full_peak:>8.1f} {bounded_time:>10.3f} {bounded_peak:>11.1f} '
+              f'{full_time / bounded_time:>8.2f} {str(exact):>6}')
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,81 @@
+"""
+netCDF mask file size against write time, for combinations of chunking and compression
+settings, on masks generated from a synthetic scene.
+
+Run from the repository root:
+    python -m benchmarks.netcdf_compression --complevels 1 4 9 --shuffle --quantize_digits 3 --workers 1 4
+
+Only the mask variable is written, so the location and GLT data of the full product are
+not included in the sizes.
+"""
+
+import argparse
+import itertools
+import os
+import tempfile
+import time
+
+from netCDF4 import Dataset
+
+import make_emit_masks
+import output_conversion
+from benchmarks.synthetic import synthetic_scene
+
+
+def scene_masks(scene, chunk_lines=256):
+    """ Mask product of a synthetic scene, as a MaskBlock """
+    blocks = [mask for _, _, mask in make_emit_masks.generate_mask_blocks(
+        scene['rdn'], scene['obs'], scene['atm'], scene['cloud_dset'], scene['irr'],
+        make_emit_masks.get_band_indices(scene['wl']), scene['aod_bands'], scene['h2o_band'], 60.0, 0.5,
+        chunk_lines, -1)]
+    return make_emit_masks.MaskBlock.concatenate(blocks)
+
+
+def write(filename, masks, chunk_lines, complevel, shuffle, quantize_digits, n_workers):
+    nc_ds = Dataset(filename, 'w', clobber=True, format='NETCDF4')
+    nc_ds.createDimension('downtrack', masks.shape[0])
+    nc_ds.createDimension('crosstrack', masks.shape[1])
+    nc_ds.createDimension('bands', masks.shape[2])
+    finish = output_conversion.add_mask_variable(nc_ds, masks, make_emit_masks.MASK_BAND_NAMES, chunk_lines,
+                                                 complevel, shuffle, quantize_digits, n_workers)
+    nc_ds.close()
+    finish(filename)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark netCDF mask compression settings")
+    parser.add_argument('--n_lines', type=int, default=1280)
+    parser.add_argument('--n_samples', type=int, default=1242)
+    parser.add_argument('--n_bands', type=int, default=285)
+    parser.add_argument('--cloud_fraction', type=float, default=0.2)
+    parser.add_argument('--chunk_lines', type=int, nargs='+', default=[32])
+    parser.add_argument('--complevels', type=int, nargs='+', default=[1, 4, 9])
+    parser.add_argument('--shuffle', action='store_true', help='Also time each setting with the shuffle filter')
+    parser.add_argument('--quantize_digits', type=int, nargs='*', default=[],
+                        help='Also time each setting with the continuous bands quantized to these digits')
+    parser.add_argument('--workers', type=int, nargs='+', default=[1])
+    parser.add_argument('--repeats', type=int, default=1)
+    args = parser.parse_args()
+
+    masks = scene_masks(synthetic_scene(args.n_lines, args.n_samples, args.n_bands, args.cloud_fraction))
+    raw_size = masks.shape[0] * masks.shape[1] * masks.shape[2] * 4
+
+    shuffles = [False, True] if args.shuffle else [False]
+    quantizations = [None] + args.quantize_digits
+    print(f'{"chunk":>6} {"level":>6} {"shuffle":>8} {"digits":>7} {"workers":>8} {"MB":>8} {"ratio":>7} {"seconds":>9}')
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        filename = os.path.join(tmp_dir, 'mask.nc')
+        for chunk_lines, complevel, shuffle, digits, n_workers in itertools.product(
+                args.chunk_lines, args.complevels, shuffles, quantizations, args.workers):
+            times = []
+            for _ in range(args.repeats):
+                start = time.perf_counter()
+                write(filename, masks, chunk_lines, complevel, shuffle, digits, n_workers)
+                times.append(time.perf_counter() - start)
+            size = os.path.getsize(filename)
+            print(f'{chunk_lines:>6} {complevel:>6} {str(shuffle):>8} {str(digits):>7} {n_workers:>8} '
+                  f'{size / 1e6:>8.1f} {raw_size / size:>7.2f} {min(times):>9.3f}')
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,55 @@
+"""
+Speedup of make_emit_masks mask generation against the number of worker threads,
+relative to the first core count given.
+
+Run from the repository root:
+    python -m benchmarks.parallel_scaling --n_lines 1280 --cores 1 2 4 8 16
+"""
+
+import argparse
+import time
+
+import numpy as np
+
+import make_emit_masks
+from benchmarks.synthetic import synthetic_scene
+
+
+def run(scene, n_cores, chunk_lines):
+    for _ in make_emit_masks.generate_mask_blocks(scene['rdn'], scene['obs'], scene['atm'], scene['cloud_dset'],
+                                                   scene['irr'], make_emit_masks.get_band_indices(scene['wl']),
+                                                   scene['aod_bands'], scene['h2o_band'], 60.0, 0.5,
+                                                   chunk_lines, n_cores):
+        pass
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark parallel mask generation")
+    parser.add_argument('--n_lines', type=int, default=1280)
+    parser.add_argument('--n_samples', type=int, default=1242)
+    parser.add_argument('--n_bands', type=int, default=285)
+    parser.add_argument('--cloud_fraction', type=float, default=0.2)
+    parser.add_argument('--chunk_lines', type=int, default=64)
+    parser.add_argument('--cores', type=int, nargs='+', default=[1, 2, 4, 8])
+    parser.add_argument('--repeats', type=int, default=3)
+    args = parser.parse_args()
+
+    scene = synthetic_scene(args.n_lines, args.n_samples, args.n_bands, args.cloud_fraction)
+
+    print(f'{"cores":>6} {"seconds":>10} {"speedup":>8} {"efficiency":>10}')
+    baseline = None
+    for n_cores in args.cores:
+        times = []
+        for _ in range(args.repeats):
+            start = time.perf_counter()
+            run(scene, n_cores, args.chunk_lines)
+            times.append(time.perf_counter() - start)
+        elapsed = np.min(times)
+        if baseline is None:
+            baseline = elapsed
+        speedup = baseline / elapsed
+        print(f'{n_cores:>6} {elapsed:>10.3f} {speedup:>8.2f} {speedup / n_cores:>10.2f}')
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,67 @@
+"""
+Cloud shadow tracing with solar angles quantized into bins against the exact per-pixel
+rays, over bin widths, with the agreement of the two shadow distances.
+
+Run from the repository root:
+    python -m benchmarks.shadow_binning --size 1280 --cloud_fraction 0.2 --angle_bins 0.25 1 2 5
+"""
+
+import argparse
+import time
+
+import numpy as np
+
+import cloud_shade
+from benchmarks.synthetic import synthetic_cloud_field
+
+
+def best_time(fn, repeats):
+    """ Result of fn, and its minimum wall time over repeats """
+    times = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        result = fn()
+        times.append(time.perf_counter() - start)
+    return result, min(times)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark shadow tracing with binned solar angles")
+    parser.add_argument('--size', type=int, default=1280)
+    parser.add_argument('--cloud_fraction', type=float, default=0.2)
+    parser.add_argument('--azimuth', type=float, nargs=2, default=[140, 146],
+                        help='Solar azimuth range across the scene, degrees clockwise from North')
+    parser.add_argument('--zenith', type=float, nargs=2, default=[25, 31],
+                        help='Solar zenith range along the scene, degrees')
+    parser.add_argument('--angle_bins', type=float, nargs='+', default=[0.25, 1, 2, 5],
+                        help='Bin widths to test, degrees, used for both azimuth and zenith')
+    parser.add_argument('--pixel_size', type=float, default=60)
+    parser.add_argument('--tolerance', type=float, default=1, help='Distance agreement tolerance, pixels')
+    parser.add_argument('--edge_only', action='store_true')
+    parser.add_argument('--repeats', type=int, default=3)
+    args = parser.parse_args()
+
+    shape = (args.size, args.size)
+    clouds = synthetic_cloud_field(shape, args.cloud_fraction)
+    # Azimuth varies across track and zenith along track, as over an EMIT scene
+    solar_azimuth = np.broadcast_to(np.linspace(*args.azimuth, shape[1]), shape)
+    solar_zenith = np.broadcast_to(np.linspace(*args.zenith, shape[0])[:, np.newaxis], shape)
+
+    exact, exact_time = best_time(lambda: cloud_shade.cast_shadows(
+        clouds, solar_azimuth, solar_zenith, args.pixel_size, edge_only=args.edge_only), args.repeats)
+    print(f'exact: {exact_time:.3f} s')
+    print(f'{"bin":>6} {"bins":>6} {"s":>8} {"speedup":>8} {"IoU":>6} {"dist agree":>10} {"agree":>6}')
+    for angle_bin in args.angle_bins:
+        binned, binned_time = best_time(lambda: cloud_shade.cast_shadows(
+            clouds, solar_azimuth, solar_zenith, args.pixel_size, edge_only=args.edge_only,
+            angle_bins=(angle_bin, angle_bin)), args.repeats)
+        n_bins = len(np.unique(np.stack((np.floor(solar_azimuth[clouds] / angle_bin),
+                                         np.floor(solar_zenith[clouds] / angle_bin)), axis=-1), axis=0))
+        agreement = cloud_shade.shade_agreement(binned, exact, args.tolerance)
+        print(f'{angle_bin:>6.2f} {n_bins:>6} {binned_time:>8.3f} {exact_time / binned_time:>8.2f} '
+              f'{agreement["shadow_iou"]:>6.3f} {agreement["distance_agreement"]:>10.3f} '
+              f'{agreement["agreement"]:>6.3f}')
+
+
+if __name__ == "__main__":
+    main()
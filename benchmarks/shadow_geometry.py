@@ -0,0 +1,63 @@
+"""
+Cloud shadow tracing in raw geometry against the orthorectified path of cloud_shade, over
+solar azimuths, with the agreement of the two shadow distances.
+
+Run from the repository root:
+    python -m benchmarks.shadow_geometry --size 1280 --cloud_fraction 0.1 --azimuths 100 150 200 250
+"""
+
+import argparse
+import time
+
+import numpy as np
+
+import cloud_shade
+from glt_index import GltIndex
+from benchmarks.synthetic import synthetic_cloud_field, synthetic_geometry
+
+
+def best_time(fn, repeats):
+    """ Result of fn, and its minimum wall time over repeats """
+    times = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        result = fn()
+        times.append(time.perf_counter() - start)
+    return result, min(times)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark raw geometry cloud shadow tracing")
+    parser.add_argument('--size', type=int, default=1280)
+    parser.add_argument('--cloud_fraction', type=float, default=0.1)
+    parser.add_argument('--azimuths', type=float, nargs='+', default=[100, 150, 200, 250],
+                        help='Solar azimuths, degrees clockwise from North')
+    parser.add_argument('--zenith', type=float, default=30)
+    parser.add_argument('--pixel_size', type=float, default=60)
+    parser.add_argument('--rotation', type=float, default=12, help='Angle of the track from North, degrees')
+    parser.add_argument('--tolerance', type=float, default=1, help='Distance agreement tolerance, pixels')
+    parser.add_argument('--edge_only', action='store_true')
+    parser.add_argument('--repeats', type=int, default=3)
+    args = parser.parse_args()
+
+    shape = (args.size, args.size)
+    loc, glt, _ = synthetic_geometry(*shape, pixel_size=args.pixel_size, rotation=args.rotation)
+    loc = loc.transpose((0, 2, 1))
+    glt_index = GltIndex.from_glt(glt.transpose((0, 2, 1)), shape)
+    clouds = synthetic_cloud_field(shape, args.cloud_fraction)
+
+    print(f'{"azimuth":>8} {"ortho s":>8} {"raw s":>8} {"speedup":>8} {"IoU":>6} {"dist agree":>10} {"agree":>6}')
+    for azimuth in args.azimuths:
+        solar = np.stack([np.full(shape, azimuth), np.full(shape, args.zenith)], axis=-1)
+        ortho, ortho_time = best_time(lambda: cloud_shade.shade_distance(
+            clouds, solar, glt_index, args.pixel_size, edge_only=args.edge_only), args.repeats)
+        raw, raw_time = best_time(lambda: cloud_shade.raw_shade_distance(
+            clouds, solar, loc, args.pixel_size, edge_only=args.edge_only), args.repeats)
+        agreement = cloud_shade.shade_agreement(raw, ortho, args.tolerance)
+        print(f'{azimuth:>8.1f} {ortho_time:>8.3f} {raw_time:>8.3f} {ortho_time / raw_time:>8.2f} '
+              f'{agreement["shadow_iou"]:>6.3f} {agreement["distance_agreement"]:>10.3f} '
+              f'{agreement["agreement"]:>6.3f}')
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,71 @@
+"""
+Cloud shadows of several cloud heights from a single ray pass to the highest, against a
+separate pass per height, with the agreement of the per-height shadow flags.
+
+Run from the repository root:
+    python -m benchmarks.shadow_heights --size 1280 --cloud_fraction 0.2 --cloud_heights 1000 2000 4000 8000
+"""
+
+import argparse
+import time
+
+import numpy as np
+
+import cloud_shade
+from benchmarks.synthetic import synthetic_cloud_field
+
+
+def best_time(fn, repeats):
+    """ Result of fn, and its minimum wall time over repeats """
+    times = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        result = fn()
+        times.append(time.perf_counter() - start)
+    return result, min(times)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark multi-height cloud shadows from one ray pass")
+    parser.add_argument('--size', type=int, default=1280)
+    parser.add_argument('--cloud_fraction', type=float, default=0.2)
+    parser.add_argument('--cloud_heights', type=float, nargs='+', default=[1000, 2000, 4000, 8000],
+                        help='Cloud heights, m')
+    parser.add_argument('--azimuth', type=float, default=145, help='Solar azimuth, degrees clockwise from North')
+    parser.add_argument('--zenith', type=float, default=30, help='Solar zenith, degrees')
+    parser.add_argument('--pixel_size', type=float, default=60)
+    parser.add_argument('--angle_bins', type=float, nargs=2, default=None)
+    parser.add_argument('--edge_only', action='store_true')
+    parser.add_argument('--repeats', type=int, default=3)
+    args = parser.parse_args()
+
+    shape = (args.size, args.size)
+    clouds = synthetic_cloud_field(shape, args.cloud_fraction)
+    solar_azimuth, solar_zenith = np.full(shape, args.azimuth), np.full(shape, args.zenith)
+    kwargs = {'edge_only': args.edge_only, 'angle_bins': args.angle_bins}
+
+    def single_pass():
+        _, shade_height = cloud_shade.cast_shadows(clouds, solar_azimuth, solar_zenith, args.pixel_size,
+                                                   cloud_height=max(args.cloud_heights), return_height=True,
+                                                   **kwargs)
+        return cloud_shade.height_shadow_bands(shade_height, args.cloud_heights)[0]
+
+    def per_height():
+        return [cloud_shade.cast_shadows(clouds, solar_azimuth, solar_zenith, args.pixel_size, cloud_height=height,
+                                         **kwargs) > 0 for height in args.cloud_heights]
+
+    flags, single_time = best_time(single_pass, args.repeats)
+    shaded, separate_time = best_time(per_height, args.repeats)
+    _, top_time = best_time(lambda: cloud_shade.cast_shadows(
+        clouds, solar_azimuth, solar_zenith, args.pixel_size, cloud_height=max(args.cloud_heights), **kwargs),
+        args.repeats)
+
+    print(f'single pass: {single_time:.3f} s, {single_time / top_time:.2f}x a single height run')
+    print(f'per height: {separate_time:.3f} s, single pass speedup {separate_time / single_time:.2f}')
+    print(f'{"height":>8} {"shaded":>8} {"mismatch":>8}')
+    for height, flag, reference in zip(args.cloud_heights, flags, shaded):
+        print(f'{height:>8.0f} {np.sum(reference):>8} {np.sum((flag > 0) != reference):>8}')
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,73 @@
+"""
+Cloud shadow ray casting time against cloud fraction, on synthetic cloud fields.
+
+Run from the repository root:
+    python -m benchmarks.shadow_raycast --size 1280 --cloud_fractions 0.01 0.05 0.1 0.2 0.4
+
+The edge-only mode is timed alongside the full trace, with the fraction of rays it skips
+and of shadow pixels on which it disagrees.  With --reference, the one ray at a time
+implementation is also timed and checked for identical output (slow on large, cloudy scenes).
+"""
+
+import argparse
+import time
+
+import numpy as np
+
+import cloud_shade
+from benchmarks.synthetic import synthetic_cloud_field
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark cloud shadow ray casting")
+    parser.add_argument('--size', type=int, default=1280)
+    parser.add_argument('--cloud_fractions', type=float, nargs='+', default=[0.01, 0.05, 0.1, 0.2, 0.4])
+    parser.add_argument('--solar_azimuth', type=float, default=150.)
+    parser.add_argument('--solar_zenith', type=float, default=35.)
+    parser.add_argument('--pixel_size', type=float, default=60.)
+    parser.add_argument('--edge_depth', type=int, default=2)
+    parser.add_argument('--reference', action='store_true')
+    args = parser.parse_args()
+
+    shape = (args.size, args.size)
+    solar_azimuth = np.full(shape, args.solar_azimuth)
+    solar_zenith = np.full(shape, args.solar_zenith)
+
+    print(f'{"fraction":>8} {"rays":>10} {"batched s":>10} {"edge s":>10} {"skipped":>8} {"mismatch":>8} '
+          f'{"loop s":>10} {"identical":>9}')
+    for cloud_fraction in args.cloud_fractions:
+        clouds = synthetic_cloud_field(shape, cloud_fraction)
+
+        start = time.perf_counter()
+        out_mask = cloud_shade.cast_shadows(clouds, solar_azimuth, solar_zenith, args.pixel_size)
+        batched = time.perf_counter() - start
+
+        start = time.perf_counter()
+        edge_mask = cloud_shade.cast_shadows(clouds, solar_azimuth, solar_zenith, args.pixel_size,
+                                             edge_only=True, edge_depth=args.edge_depth)
+        edge = time.perf_counter() - start
+        locs = np.where(clouds)
+        start_px = np.stack(locs[::-1], axis=-1)
+        if len(start_px) > 0:
+            edge_x, edge_y, _ = cloud_shade.edge_coords_from_target(
+                locs[1], locs[0], cloud_shade.cwn_to_math(solar_azimuth[clouds] - 180),
+                (0, 0, shape[1] - 1, shape[0] - 1))
+            end_px = np.stack((edge_x, edge_y), axis=-1)
+            skipped = 1 - np.mean(cloud_shade.antisolar_edge_pixels(clouds, start_px, end_px, args.edge_depth))
+        else:
+            skipped = 0
+        mismatch = np.sum((out_mask > 0) != (edge_mask > 0)) / max(np.sum(out_mask > 0), 1)
+
+        loop, identical = float('nan'), ''
+        if args.reference:
+            start = time.perf_counter()
+            reference = cloud_shade._cast_shadows_loop(clouds, solar_azimuth, solar_zenith, args.pixel_size)
+            loop = time.perf_counter() - start
+            identical = str(np.array_equal(out_mask, reference))
+
+        print(f'{cloud_fraction:>8.2f} {np.sum(clouds):>10} {batched:>10.3f} {edge:>10.3f} {skipped:>8.3f} '
+              f'{mismatch:>8.4f} {loop:>10.3f} {identical:>9}')
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,199 @@
+"""
+End to end benchmark of make_emit_masks, cloud_shade and output_conversion on synthetic scenes
+written to disk, with per-stage times from the profiling module, and a check of the results
+against a JSON baseline.
+
+Run from the repository root:
+    python -m benchmarks.suite --sizes 512x512 1280x1242 --cloud_fractions 0.05 0.3 \
+        --solar_geometries 150:30 90:60 --output results.json --baseline baseline.json
+
+Each tool runs in this process, so scenes after the first reuse the in-memory irradiance; the
+minimum time over the repeats is reported.
+A tool regresses when its throughput, in megapixels per second of scene, falls below the
+baseline by more than the tolerance, in which case the exit status is 1.  Baselines depend on
+the machine, so record them with --update_baseline on the machine they are checked on.
+"""
+
+import argparse
+import itertools
+import json
+import os
+import platform
+import sys
+import tempfile
+import time
+
+import numpy as np
+
+import make_emit_masks
+import cloud_shade
+import output_conversion
+from benchmarks.synthetic import write_synthetic_scene
+
+
+def parse_size(size):
+    """ (lines, samples) from LINESxSAMPLES """
+    lines, samples = size.lower().split('x')
+    return int(lines), int(samples)
+
+
+def parse_geometry(geometry):
+    """ (solar azimuth, solar zenith) from AZIMUTH:ZENITH, degrees """
+    azimuth, zenith = geometry.split(':')
+    return float(azimuth), float(zenith)
+
+
+def run_tool(tool, input_args, profile_file, repeats):
+    """ Time a command line tool, with the stage profile of its fastest run
+
+    :param tool: one of 'masks', 'shade' or 'daac'
+    :param input_args: command line arguments, without the profile file
+    :param profile_file: JSON profile file to use
+    :param repeats: number of runs
+
+    :return: tuple of (minimum wall time in s, dictionary of wall time in s per stage)
+    """
+    best, stages = None, None
+    for _ in range(repeats):
+        args = input_args + ['--profile_file', profile_file]
+        start = time.perf_counter()
+        if tool == 'masks':
+            make_emit_masks.main(args)
+        elif tool == 'shade':
+            cloud_shade.main.main(args=args, standalone_mode=False)
+        else:
+            output_conversion.main(args)
+        elapsed = time.perf_counter() - start
+        if best is None or elapsed < best:
+            best = elapsed
+            with open(profile_file, 'r') as fin:
+                stages = {s['stage']: s['wall_s'] for s in json.load(fin)['stages']}
+    return best, stages
+
+
+def record(results, case, n_pixels, wall_s, stages):
+    results[case] = {'wall_s': wall_s, 'mpix_per_s': n_pixels / wall_s / 1e6, 'stages': stages}
+    print(f'{case:<48} {wall_s:>9.3f} {results[case]["mpix_per_s"]:>9.3f}')
+
+
+def run_suite(args, work_dir):
+    """ Run every case of the suite
+
+    :return: dictionary of results per case
+    """
+    results = {}
+    geometries = [parse_geometry(g) for g in args.solar_geometries]
+    print(f'{"case":<48} {"seconds":>9} {"Mpix/s":>9}')
+    for size, cloud_fraction in itertools.product(args.sizes, args.cloud_fractions):
+        n_lines, n_samples = parse_size(size)
+        n_pixels = n_lines * n_samples
+        for n, (solar_azimuth, solar_zenith) in enumerate(geometries):
+            scene_dir = os.path.join(work_dir, f'{size}_{cloud_fraction}_{solar_azimuth}_{solar_zenith}')
+            files = write_synthetic_scene(scene_dir, n_lines, n_samples, args.n_bands, cloud_fraction,
+                                          seed=args.seed, solar_azimuth=solar_azimuth, solar_zenith=solar_zenith)
+            profile_file = os.path.join(scene_dir, 'profile.json')
+            mask_file = os.path.join(scene_dir, 'masks.img')
+            scene_case = f'{size}/cloud_{cloud_fraction}'
+
+            # The masks barely depend on the solar geometry, so only the first is timed
+            if n == 0:
+                wall_s, stages = run_tool('masks', [
+                    files['rdnfile'], files['locfile'], files['obsfile'], files['atmfile'], files['cloudfile'],
+                    files['irrfile'], mask_file, '--n_cores', str(args.n_cores)], profile_file, args.repeats)
+                record(results, f'masks/{scene_case}', n_pixels, wall_s, stages)
+
+            shade_file = os.path.join(scene_dir, 'shade.tif')
+            wall_s, stages = run_tool('shade', [
+                files['shade_cloudfile'], files['obsfile'], files['gltfile'], shade_file,
+                '--loc_file', files['locfile'], '--log_level', 'WARNING'], profile_file, args.repeats)
+            record(results, f'shade/{scene_case}/sun_{solar_azimuth}_{solar_zenith}', n_pixels, wall_s, stages)
+
+            if n == 0:
+                wall_s, stages = run_tool('daac', [
+                    os.path.join(scene_dir, 'mask.nc'), mask_file, files['locfile'], files['gltfile'], 'V001',
+                    'benchmark', '--shade_file', shade_file, '--n_workers', str(args.n_cores),
+                    '--log_level', 'WARNING'], profile_file, args.repeats)
+                record(results, f'daac/{scene_case}', n_pixels, wall_s, stages)
+    return results
+
+
+def compare(results, baseline, tolerance):
+    """ Compare throughput against a baseline
+
+    :param results: results of this run, per case
+    :param baseline: baseline results, per case
+    :param tolerance: allowed fractional loss of throughput
+
+    :return: list of the regressed cases
+    """
+    regressions = []
+    print(f'\n{"case":<48} {"baseline":>9} {"current":>9} {"ratio":>7}')
+    for case in sorted(set(results) & set(baseline)):
+        ratio = results[case]['mpix_per_s'] / baseline[case]['mpix_per_s']
+        regressed = ratio < 1 - tolerance
+        print(f'{case:<48} {baseline[case]["mpix_per_s"]:>9.3f} {results[case]["mpix_per_s"]:>9.3f} '
+              f'{ratio:>7.2f}{"  REGRESSED" if regressed else ""}')
+        if regressed:
+            regressions.append(case)
+            # Point at the stages that added the most time
+            base_stages = baseline[case].get('stages') or {}
+            current_stages = results[case]['stages'] or {}
+            slower = sorted(((current_stages[s] - t, s) for s, t in base_stages.items() if s in current_stages),
+                            reverse=True)
+            for added, stage in slower[:3]:
+                print(f'    {stage:<44} {added:>+9.3f} s')
+    for case in sorted(set(baseline) - set(results)):
+        print(f'{case:<48} not run')
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the mask tools end to end on synthetic scenes")
+    parser.add_argument('--sizes', type=str, nargs='+', default=['512x512'], help='Scene sizes, LINESxSAMPLES')
+    parser.add_argument('--n_bands', type=int, default=285)
+    parser.add_argument('--cloud_fractions', type=float, nargs='+', default=[0.05, 0.3])
+    parser.add_argument('--solar_geometries', type=str, nargs='+', default=['150:30', '90:60'],
+                        help='Solar geometries of the cloud shade cases, AZIMUTH:ZENITH in degrees')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--n_cores', type=int, default=1, help='Mask and compression threads')
+    parser.add_argument('--repeats', type=int, default=3)
+    parser.add_argument('--work_dir', type=str, default=None,
+                        help='Directory for the synthetic scenes and outputs; a temporary directory if not set')
+    parser.add_argument('--output', type=str, default=None, help='JSON file for the results of this run')
+    parser.add_argument('--baseline', type=str, default=None, help='JSON baseline to check the results against')
+    parser.add_argument('--update_baseline', action='store_true',
+                        help='Write the results of this run to --baseline instead of checking them')
+    parser.add_argument('--tolerance', type=float, default=0.2,
+                        help='Allowed fractional loss of throughput against the baseline')
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        results = run_suite(args, args.work_dir or tmp_dir)
+
+    report = {'environment': {'python': sys.version.split()[0], 'numpy': np.__version__,
+                              'platform': platform.platform(), 'cpu_count': os.cpu_count()},
+              'arguments': {k: v for k, v in vars(args).items()
+                            if k not in ['output', 'baseline', 'update_baseline', 'work_dir']},
+              'results': results}
+    if args.output is not None:
+        with open(args.output, 'w') as fout:
+            json.dump(report, fout, indent=2)
+
+    if args.baseline is None:
+        return
+    if args.update_baseline or not os.path.isfile(args.baseline):
+        with open(args.baseline, 'w') as fout:
+            json.dump(report, fout, indent=2)
+        print(f'Wrote baseline {args.baseline}')
+        return
+
+    with open(args.baseline, 'r') as fin:
+        baseline = json.load(fin)
+    regressions = compare(results, baseline['results'], args.tolerance)
+    if len(regressions) > 0:
+        print(f'{len(regressions)} case(s) regressed by more than {args.tolerance:.0%}')
+        raise SystemExit(1)
+
+
+if __name__ == "__main__":
+    main()
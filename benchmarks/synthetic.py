@@ -0,0 +1,227 @@
+"""
+Synthetic, EMIT-like inputs for benchmarking the mask code without real scenes, either in
+memory or written to disk as the files the command line tools read.
+"""
+
+import os
+
+import numpy as np
+from osgeo import gdal
+from spectral.io import envi
+
+from scene_geometry import EARTH_RADIUS
+
+
+def synthetic_wavelengths(n_bands=285):
+    """ EMIT-like wavelength and fwhm grid, in nm
+
+    :param n_bands: number of spectral bands
+
+    :return: tuple of (wl, fwhm) arrays
+    """
+    wl = np.linspace(381.0, 2493.0, n_bands)
+    fwhm = np.full(n_bands, (wl[-1] - wl[0]) / (n_bands - 1) * 1.1)
+    return wl, fwhm
+
+
+def synthetic_cloud_field(shape, cloud_fraction, seed=0, feature_size=8):
+    """ Blobby boolean cloud field with approximately the requested cloud fraction
+
+    :param shape: (lines, samples)
+    :param cloud_fraction: fraction of pixels to set as cloudy, 0 - 1
+    :param seed: random seed
+    :param feature_size: approximate size of the cloud objects, in pixels
+
+    :return: boolean array
+    """
+    from scipy.ndimage import gaussian_filter
+    if cloud_fraction <= 0:
+        return np.zeros(shape, dtype=bool)
+    rng = np.random.default_rng(seed)
+    field = gaussian_filter(rng.standard_normal(shape), feature_size)
+    return field >= np.quantile(field, 1 - cloud_fraction)
+
+
+def synthetic_irradiance(wl):
+    """ Smooth solar irradiance-like spectrum, uW cm-2 sr-1 nm-1
+
+    :param wl: wavelengths, nm
+
+    :return: float32 irradiance at wl
+    """
+    return np.interp(wl, [380, 500, 1000, 2500], [110, 200, 95, 7]).astype(np.float32)
+
+
+def synthetic_scene(n_lines=1280, n_samples=1242, n_bands=285, cloud_fraction=0.2, seed=0, solar_azimuth=150.0,
+                    solar_zenith=None):
+    """ In-memory radiance, observation, atmosphere and SpecTf inputs for make_emit_masks
+
+    :param n_lines: number of downtrack lines
+    :param n_samples: number of crosstrack samples
+    :param n_bands: number of radiance bands
+    :param cloud_fraction: approximate fraction of cloudy pixels
+    :param seed: random seed
+    :param solar_azimuth: solar azimuth, degrees clockwise from North
+    :param solar_zenith: solar zenith at the first sample, degrees; random between 20 and 40 if None.
+                         The zenith increases by 5 degrees across track.
+
+    :return: dict with BIL arrays 'rdn', 'obs' and 'atm', the 'tf_prob' array, the boolean
+             'clouds' field, the SpecTf gdal MEM dataset 'cloud_dset', and 'wl', 'fwhm', 'irr',
+             'aod_bands', 'h2o_band'
+    """
+    rng = np.random.default_rng(seed)
+    wl, fwhm = synthetic_wavelengths(n_bands)
+    irr = synthetic_irradiance(wl)
+
+    clouds = synthetic_cloud_field((n_lines, n_samples), cloud_fraction, seed)
+    # Drawn even when the zenith is given, so the rest of the scene does not depend on it
+    zen_start = rng.uniform(20, 40)
+    if solar_zenith is not None:
+        zen_start = solar_zenith
+    zen = zen_start + np.linspace(0, 5, n_samples)[np.newaxis, :].repeat(n_lines, axis=0)
+
+    rho = rng.uniform(0.02, 0.3, (n_lines, 1, n_samples)).astype(np.float32)
+    rho[clouds[:, np.newaxis, :]] = 0.7
+    rdn = np.empty((n_lines, n_bands, n_samples), dtype=np.float32)
+    for _l in range(n_lines):
+        rdn[_l] = rho[_l] * irr[:, np.newaxis] / np.pi * np.cos(np.radians(zen[_l]))[np.newaxis, :]
+
+    obs = np.zeros((n_lines, 11, n_samples), dtype=np.float32)
+    obs[:, 3, :] = solar_azimuth
+    obs[:, 4, :] = zen
+
+    atm = np.zeros((n_lines, 2, n_samples), dtype=np.float32)
+    atm[:, 0, :] = rng.uniform(0.05, 0.6, (n_lines, n_samples))
+    atm[:, 1, :] = rng.uniform(0.5, 3.0, (n_lines, n_samples))
+
+    tf_prob = np.clip(clouds + rng.normal(0, 0.2, clouds.shape), 0, 1).astype(np.float32)
+    cloud_dset = gdal.GetDriverByName('MEM').Create('', n_samples, n_lines, 1, gdal.GDT_Float32)
+    cloud_dset.GetRasterBand(1).WriteArray(tf_prob)
+
+    return {'rdn': rdn, 'obs': obs, 'atm': atm, 'tf_prob': tf_prob, 'clouds': clouds, 'cloud_dset': cloud_dset,
+            'wl': wl, 'fwhm': fwhm, 'irr': irr, 'aod_bands': [0], 'h2o_band': [1]}
+
+
+def write_envi(path, data, header=None):
+    """ Write a BIL array as an ENVI file
+
+    :param path: output data file; the header goes alongside as .hdr
+    :param data: (lines, bands, samples) array
+    :param header: optional additional header entries
+    """
+    hdr = {'lines': data.shape[0], 'bands': data.shape[1], 'samples': data.shape[2], 'interleave': 'bil',
+           'header offset': 0, 'byte order': 0, 'file type': 'ENVI Standard',
+           'data type': {np.dtype(np.uint8): 1, np.dtype(np.int16): 2, np.dtype(np.int32): 3,
+                         np.dtype(np.float32): 4, np.dtype(np.float64): 5}[data.dtype]}
+    hdr.update(header or {})
+    np.ascontiguousarray(data).astype(data.dtype.newbyteorder('<')).tofile(path)
+    envi.write_envi_header(os.path.splitext(path)[0] + '.hdr', hdr)
+
+
+def write_geotiff(path, data, gdal_type):
+    """ Write a single band GeoTIFF """
+    dset = gdal.GetDriverByName('GTiff').Create(path, data.shape[1], data.shape[0], 1, gdal_type)
+    dset.GetRasterBand(1).WriteArray(data)
+    del dset
+
+
+def synthetic_geometry(n_lines, n_samples, pixel_size=60.0, rotation=12.0, lon=-117.0, lat=34.0):
+    """ LOC data and GLT of a scene whose track is rotated from a north-up geographic grid.
+    The grid spacing is pixel_size on the ground in both directions, and the GLT is filled
+    by nearest neighbour.
+
+    :param n_lines: number of raw lines
+    :param n_samples: number of raw samples
+    :param pixel_size: ground pixel spacing, m
+    :param rotation: angle of the track from the map grid, degrees
+    :param lon: longitude of the first raw pixel, degrees
+    :param lat: latitude of the first raw pixel, degrees
+
+    :return: tuple of the (lines, 3, samples) float64 longitude, latitude and elevation, the
+             (ortho lines, 2, ortho samples) int32 GLT, 1-based (sample, line) and 0 outside the
+             scene, and the GDAL geotransform of the GLT
+    """
+    theta = np.radians(rotation)
+    cos, sin = np.cos(theta), np.sin(theta)
+    dlat = np.degrees(pixel_size / EARTH_RADIUS)
+    dlon = dlat / np.cos(np.radians(lat))
+
+    # Raw pixels in map pixel units, x east and y south
+    lines, samples = np.meshgrid(np.arange(n_lines), np.arange(n_samples), indexing='ij')
+    loc = np.empty((n_lines, 3, n_samples), dtype=np.float64)
+    loc[:, 0, :] = lon + (samples * cos - lines * sin) * dlon
+    loc[:, 1, :] = lat - (samples * sin + lines * cos) * dlat
+    loc[:, 2, :] = 200 + 50 * np.sin(samples / 40.0)
+
+    corners = np.array([[0, 0], [n_samples, 0], [0, n_lines], [n_samples, n_lines]], dtype=np.float64)
+    ortho_corners = np.stack([corners[:, 0] * cos - corners[:, 1] * sin,
+                              corners[:, 0] * sin + corners[:, 1] * cos], axis=-1)
+    origin = np.floor(ortho_corners.min(axis=0))
+    ortho_samples, ortho_lines = (np.ceil(ortho_corners.max(axis=0)) - origin).astype(int)
+
+    rows, cols = np.meshgrid(np.arange(ortho_lines) + origin[1], np.arange(ortho_samples) + origin[0],
+                             indexing='ij')
+    raw_sample = np.rint(cols * cos + rows * sin).astype(np.int32)
+    raw_line = np.rint(-cols * sin + rows * cos).astype(np.int32)
+    inside = (raw_sample >= 0) & (raw_sample < n_samples) & (raw_line >= 0) & (raw_line < n_lines)
+
+    glt = np.zeros((ortho_lines, 2, ortho_samples), dtype=np.int32)
+    glt[:, 0, :] = np.where(inside, raw_sample + 1, 0)
+    glt[:, 1, :] = np.where(inside, raw_line + 1, 0)
+
+    # Map pixel centers are at the raw pixel positions, so the grid corner is half a pixel out
+    geotransform = (lon + (origin[0] - 0.5) * dlon, dlon, 0.0, lat - (origin[1] - 0.5) * dlat, 0.0, -dlat)
+    return loc, glt, tuple(float(v) for v in geotransform)
+
+
+def write_synthetic_scene(output_dir, n_lines=1280, n_samples=1242, n_bands=285, cloud_fraction=0.2, seed=0,
+                          solar_azimuth=150.0, solar_zenith=None, pixel_size=60.0):
+    """ Write a synthetic scene as the input files of make_emit_masks, cloud_shade and
+    output_conversion: radiance, LOC, OBS and atmospheric state ENVI files, the SpecTf-Cloud
+    probability and a binary cloud GeoTIFF, a GLT ENVI file, and a solar irradiance text file
+
+    :param output_dir: directory to write the files to
+    :param n_lines: number of downtrack lines
+    :param n_samples: number of crosstrack samples
+    :param n_bands: number of radiance bands
+    :param cloud_fraction: approximate fraction of cloudy pixels
+    :param seed: random seed
+    :param solar_azimuth: solar azimuth, degrees clockwise from North
+    :param solar_zenith: solar zenith at the first sample, degrees; random between 20 and 40 if None
+    :param pixel_size: pixel spacing of the LOC and GLT data, m
+
+    :return: dict of file paths, keyed 'rdnfile', 'locfile', 'obsfile', 'atmfile', 'cloudfile',
+             'shade_cloudfile', 'gltfile' and 'irrfile'
+    """
+    os.makedirs(output_dir, exist_ok=True)
+    scene = synthetic_scene(n_lines, n_samples, n_bands, cloud_fraction, seed, solar_azimuth, solar_zenith)
+    files = {k: os.path.join(output_dir, name) for k, name in [
+        ('rdnfile', 'rdn.img'), ('locfile', 'loc.img'), ('obsfile', 'obs.img'), ('atmfile', 'atm.img'),
+        ('cloudfile', 'spectf_prob.tif'), ('shade_cloudfile', 'clouds.tif'), ('gltfile', 'glt.img'),
+        ('irrfile', 'irradiance.txt')]}
+
+    write_envi(files['rdnfile'], scene['rdn'], {'wavelength': list(scene['wl']), 'fwhm': list(scene['fwhm']),
+                                                'wavelength units': 'Nanometers'})
+    loc, glt, geotransform = synthetic_geometry(n_lines, n_samples, pixel_size)
+    write_envi(files['locfile'], loc,
+               {'band names': ['Longitude (WGS-84)', 'Latitude (WGS-84)', 'Elevation (m)']})
+    write_envi(files['obsfile'], scene['obs'],
+               {'band names': ['Path length (m)', 'To-sensor azimuth (0 to 360 degrees CW from N)',
+                               'To-sensor zenith (0 to 90 degrees from zenith)',
+                               'To-sun azimuth (0 to 360 degrees CW from N)',
+                               'To-sun zenith (0 to 90 degrees from zenith)', 'Solar phase',
+                               'Slope', 'Aspect', 'Cosine(i)', 'UTC Time', 'Earth-sun distance (AU)']})
+    write_envi(files['atmfile'], scene['atm'], {'band names': ['AOT550', 'H2OSTR']})
+    write_geotiff(files['cloudfile'], scene['tf_prob'], gdal.GDT_Float32)
+    write_geotiff(files['shade_cloudfile'], scene['clouds'].astype(np.uint8), gdal.GDT_Byte)
+
+    write_envi(files['gltfile'], glt,
+               {'band names': ['GLT Sample Lookup', 'GLT Line Lookup'],
+                'map info': f'{{Geographic Lat/Lon, 1, 1, {geotransform[0]!r}, {geotransform[3]!r}, '
+                            f'{geotransform[1]!r}, {-geotransform[5]!r}, WGS-84}}'})
+
+    # Irradiance files are in the units of the Kurucz spectrum, ten times uW cm-2 sr-1 nm-1
+    irr_wl = np.arange(350.0, 2600.0, 0.5)
+    np.savetxt(files['irrfile'], np.stack([irr_wl, 10 * synthetic_irradiance(irr_wl)], axis=-1),
+               header='wavelength (nm), irradiance')
+    return files
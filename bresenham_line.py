@@ -58,12 +58,9 @@ def _bresenhamlines(start, end, max_iter):
     npts, dim = start.shape
     nslope = _bresenhamline_nslope(end - start)
 
-    # steps to iterate on
+    # steps to iterate on, broadcast against the (npts x 1 x dimension) slopes
     stepseq = np.arange(1, max_iter + 1)
-    stepmat = np.tile(stepseq, (dim, 1)).T
-
-    # some hacks for broadcasting properly
-    bline = start[:, np.newaxis, :] + nslope[:, np.newaxis, :] * stepmat
+    bline = start[:, np.newaxis, :] + nslope[:, np.newaxis, :] * stepseq[:, np.newaxis]
 
     # Approximate to nearest int
     return np.array(np.rint(bline), dtype=start.dtype)
@@ -78,8 +75,8 @@ def bresenhamline(start, end, max_iter=5):
         end:   An end points (1 x dimension)
             or An array of end point corresponding to each start point
                 (number of points x dimension)
-        max_iter: Max points to traverse. if -1, maximum number of required
-                  points are traversed
+        max_iter: Max points to traverse, rounded down. if -1, maximum number
+                  of required points are traversed
 
     Returns:
         linevox (n x dimension) A cumulative array of all points traversed by
@@ -106,9 +103,90 @@ def bresenhamline(start, end, max_iter=5):
            [ 0,  0, -5,  0],
            [ 0,  0, -6,  0]])
     """
-    # Return the points as a single array
-    bl_out = _bresenhamlines(start, end, max_iter).reshape(-1, start.shape[-1])
+    # Steps beyond max_iter are never traced, whatever the direction of the line
     if max_iter != -1:
-        good_points = bl_out[:, 0] < start[:,0] + max_iter
-        bl_out = bl_out[good_points,:]
-    return bl_out
+        max_iter = max(int(np.floor(max_iter)), 0)
+    # Return the points as a single array
+    return _bresenhamlines(start, end, max_iter).reshape(-1, start.shape[-1])
+
+
+def _steps_inside(start, nslope, shape, origin=(0, 0)):
+    """
+    Number of steps of each 2D line before it leaves an image of the given
+    (rows, cols) shape whose first pixel is at (row, col) origin, plus one for
+    the rounding to the nearest pixel.  Lines are straight, so once outside
+    they never come back.
+    """
+    n_inside = np.full(len(start), np.inf)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        for axis, size in enumerate([shape[1], shape[0]]):
+            s = nslope[:, axis]
+            offset = start[:, axis] - origin[1 - axis]
+            limit = np.where(s > 0, (size - 0.5 - offset) / s, (offset + 0.5) / -s)
+            n_inside = np.where(s != 0, np.minimum(n_inside, np.floor(limit) + 1), n_inside)
+    return n_inside
+
+
+def trace_rays(start, end, lengths, shape=None, origin=(0, 0), chunk_size=2**18):
+    """
+    Streams the pixels of 2D rays, each traced from start towards end for its
+    own number of steps, in chunks of at most chunk_size pixels.  Pixels are
+    those of bresenhamline: step k of a ray is start + k * slope rounded to the
+    nearest pixel, with the slope normalized to one pixel along its major axis.
+    Long rays are split across chunks, so memory is bounded by chunk_size
+    rather than by the number of rays times the longest ray.
+    Parameters:
+        start: An array of start points (number of rays x 2), as (x, y)
+        end:   An array of points (number of rays x 2), as (x, y), giving the
+               direction of each ray
+        lengths: Number of steps of each ray; fractional lengths are rounded
+                 down, and negative or non-finite lengths trace nothing
+        shape: Optional (rows, cols) image shape; pixels outside it are dropped,
+               and rays stop once they leave it
+        origin: (row, col) of the first pixel of the image, in the coordinates
+                of the rays, for rays traced over a window of a larger image
+        chunk_size: Maximum number of pixels per chunk
+
+    Yields:
+        ray (n) int32 index of the ray of each pixel
+        records (n x 3) int32 (row, col, step) of each pixel, step from 1
+
+    >>> s = np.array([[0, 0], [3, 1]])
+    >>> e = np.array([[4, 2], [0, 1]])
+    >>> for ray, records in trace_rays(s, e, [3, 5], shape=(4, 4), chunk_size=4):
+    ...     print(ray, records.tolist())
+    [0 0 0 1] [[0, 1, 1], [1, 2, 2], [2, 3, 3], [1, 2, 1]]
+    [1 1] [[1, 1, 2], [1, 0, 3]]
+    """
+    start = np.asarray(start)
+    if len(start) == 0:
+        return
+    nslope = _bresenhamline_nslope(np.asarray(end) - start)
+
+    lengths = np.asarray(lengths, dtype=np.float64)
+    n_steps = np.where(np.isfinite(lengths), np.floor(np.maximum(lengths, 0)), 0)
+    if shape is not None:
+        n_steps = np.minimum(n_steps, np.maximum(_steps_inside(start, nslope, shape, origin), 0))
+    n_steps = n_steps.astype(np.int64)
+
+    ray_end = np.cumsum(n_steps)
+    ray_start = ray_end - n_steps - 1
+    for chunk_start in range(0, int(ray_end[-1]) if len(ray_end) > 0 else 0, chunk_size):
+        step = np.arange(chunk_start, min(chunk_start + chunk_size, ray_end[-1]))
+        ray = np.searchsorted(ray_end, step, side='right').astype(np.int32)
+        step -= ray_start[ray]
+
+        # One axis at a time, to keep the float64 temporaries to a single column
+        records = np.empty((len(step), 3), dtype=np.int32)
+        records[:, 2] = step
+        for column, axis in [(1, 0), (0, 1)]:
+            px = nslope[ray, axis] * step
+            px += start[ray, axis]
+            records[:, column] = np.rint(px, out=px)
+        del step, px
+
+        if shape is not None:
+            inside = (records[:, 0] >= origin[0]) & (records[:, 0] < origin[0] + shape[0])
+            inside &= (records[:, 1] >= origin[1]) & (records[:, 1] < origin[1] + shape[1])
+            ray, records = ray[inside], records[inside]
+        yield ray, records
@@ -4,8 +4,27 @@ import numpy as np
 from osgeo import gdal
 import bresenham_line
 import logging
-from scipy.interpolate import griddata
-from scipy.ndimage import distance_transform_edt
+from glt_index import GltIndex, fill_nearest, glt_raw_flat
+from scene_geometry import geotransform_pixel_size, scene_pixel_size, EARTH_RADIUS
+from scene_files import EnviFile
+import profiling
+
+
+# Cloud height, in m above the surface, that shadow rays are cast from
+SHADOW_CLOUD_HEIGHT = 4000
+
+# Side, in orthorectified pixels, of the GLT tiles traced at once, without their halo
+SHADE_TILE_SIZE = 1024
+
+# Lines written to the output GeoTIFF per call, rounded to whole blocks
+SHADE_WRITE_LINES = 256
+
+# Cost of scattering a ray pixel relative to a pixel of dilation, above which binned rays are dilated
+BINNED_SCATTER_COST = 32
+
+# Algorithm version of the shadow distance, part of its stage cache key in fused_pipeline.
+# Bump it whenever a code change alters the output.
+SHADE_STAGE_VERSION = 1
 
 
 def edge_coords_from_target(target_px_x: np.array, target_px_y: np.array, angle: np.array, bounds):
@@ -14,57 +33,36 @@ def edge_coords_from_target(target_px_x: np.array, target_px_y: np.array, angle:
     Args:
         target_px_x (array, int): array of x-coordinate of the target pixel.
         target_px_y (array, int): array of y-coordinate of the target pixel.
-        angle (array, float): angle in degrees, clockwise from North.
+        angle (array, float): angle in degrees, counterclockwise from East (see cwn_to_math).
         bounds (tuple): bounds of the image in the format (min_x, min_y, max_x, max_y).
+
+    Returns:
+        tuple: x and y of the edge pixel, y truncated to an integer, and the slope dy / dx of the direction.
     """
 
-    # Compute direction vector (dx, dy) in image coordinates
-    dy = np.sin(np.deg2rad(angle))  
-    dx = np.cos(np.deg2rad(angle))  
-    #dy = -dy  # Invert y direction for image coordinates
-
-    invert = np.zeros_like(angle, dtype=bool)
-    invert[np.logical_and(angle > 180, angle < 360)] = True
-    invert[np.logical_and(angle < 0, angle > -180)] = True
-
-    xdelta = np.ones_like(angle, dtype=int) * target_px_x
-    ydelta = np.ones_like(angle, dtype=int) * target_px_y
-
-    if np.any(invert):
-        print('inverting')
-        xdelta[invert] = bounds[2] - target_px_x
-        ydelta[invert] = bounds[3] - target_px_y
-        xdelta[invert] *= -1
-        ydelta[invert] *= -1
-
-    # There will be two candidate edges, one on the x-axis, and one the y-axis.
-    # Start by finding both
-    edge_px_horizontal_y = np.zeros_like(angle, dtype=int) 
-    if np.any(invert):
-        edge_px_horizontal_y[invert] = bounds[3]
-    edge_px_horizontal_x = dx / dy * ydelta  + target_px_x
-
-    edge_px_vertical_x = np.zeros_like(angle, dtype=int)
-    if np.any(invert):
-        edge_px_vertical_x[invert] = bounds[2]
-    edge_px_vertical_y = dy / dx * xdelta + target_px_y
-
-    vertical_select = np.logical_or.reduce((
-        edge_px_horizontal_x < bounds[0],
-        edge_px_horizontal_x > bounds[2],
-        edge_px_horizontal_y < bounds[1],
-        edge_px_horizontal_y > bounds[3]
-    ))
-
-    edge_px_x_out = edge_px_horizontal_x.copy()
-    edge_px_y_out = edge_px_horizontal_y.copy()
-    edge_px_x_out[vertical_select] = edge_px_vertical_x[vertical_select]
-    edge_px_y_out[vertical_select] = edge_px_vertical_y[vertical_select]
+    # Compute direction vector (dx, dy), with y pointing North, so against the image rows
+    dy = np.sin(np.deg2rad(angle))
+    dx = np.cos(np.deg2rad(angle))
+
+    # There will be two candidate edges, the top or bottom one, and the left or right one,
+    # each on the side the direction points to
+    edge_px_horizontal_y = np.where(dy >= 0, bounds[1], bounds[3])
+    edge_px_vertical_x = np.where(dx >= 0, bounds[2], bounds[0])
+    with np.errstate(divide='ignore', invalid='ignore'):
+        edge_px_horizontal_x = target_px_x + dx / dy * (target_px_y - edge_px_horizontal_y)
+        edge_px_vertical_y = target_px_y - dy / dx * (edge_px_vertical_x - target_px_x)
+
+    # The top or bottom edge is hit first unless its crossing lies beyond the left or right edge
+    vertical_select = np.logical_not(np.logical_and(edge_px_horizontal_x >= bounds[0],
+                                                    edge_px_horizontal_x <= bounds[2]))
+
+    edge_px_x_out = np.where(vertical_select, edge_px_vertical_x, edge_px_horizontal_x)
+    edge_px_y_out = np.where(vertical_select, edge_px_vertical_y, edge_px_horizontal_y).astype(int)
     slope = dy / dx
     return edge_px_x_out, edge_px_y_out, slope
 
 
-def distance_of_ray(sza, solar_slope, pixel_size, cloud_height_above_surface_m=4000):
+def distance_of_ray(sza, solar_slope, pixel_size, cloud_height_above_surface_m=SHADOW_CLOUD_HEIGHT):
     straight_distance = np.cos(np.deg2rad(sza)) * cloud_height_above_surface_m
     x_fraction = np.abs(np.cos(np.arctan(solar_slope)))
     x_distance_m = x_fraction * straight_distance
@@ -77,6 +75,399 @@ def cwn_to_math(angle_cw_from_north):
     return (90 - angle_cw_from_north) % 360
 
 
+def antisolar_edge_pixels(clouds, start, end, depth=2, offset=(0, 0)):
+    """Find the cloud pixels on the antisolar-facing boundary of their cloud.
+
+    A cloud pixel is on the boundary when any of the first depth pixels of its antisolar
+    ray is clear or outside the image - a directional erosion of the cloud mask.  A single
+    pixel deep boundary leaves gaps between the rasterized rays; two or more pixels close
+    them to within a small fraction of the shadow.
+
+    Args:
+        clouds (array, bool): orthorectified cloud mask.
+        start (array, int): (n, 2) cloud pixels (x, y).
+        end (array, float): (n, 2) antisolar ray end points (x, y).
+        depth (int, optional): boundary depth, in ray steps. Defaults to 2.
+        offset (tuple, optional): (row, col) of clouds[0, 0] in the coordinates of start and end. Defaults to (0, 0).
+
+    Returns:
+        array, bool: true for the cloud pixels on an antisolar-facing boundary.
+    """
+    nslope = bresenham_line._bresenhamline_nslope(end - start)
+    edge = np.zeros(len(start), dtype=bool)
+    for step in range(1, depth + 1):
+        px = np.rint(start + nslope * step) - (offset[1], offset[0])
+        inside = np.all(np.isfinite(px), axis=-1)
+        inside &= (px[:, 0] >= 0) & (px[:, 0] < clouds.shape[1])
+        inside &= (px[:, 1] >= 0) & (px[:, 1] < clouds.shape[0])
+
+        px = px[inside].astype(int)
+        step_clear = np.ones(len(start), dtype=bool)
+        step_clear[inside] = np.logical_not(clouds[px[:, 1], px[:, 0]])
+        edge |= step_clear
+    return edge
+
+
+def shadow_stencil(solar_azimuth, solar_zenith, pixel_size, cloud_height=SHADOW_CLOUD_HEIGHT):
+    """Pixel offsets of the antisolar ray from a cloud pixel, shared by every pixel with the same solar angles.
+
+    The ray follows the antisolar azimuth on the orthorectified grid, north up, in steps of one
+    pixel along its major axis, for as many steps as distance_of_ray gives.
+
+    Args:
+        solar_azimuth (float): solar azimuth, degrees clockwise from North.
+        solar_zenith (float): solar zenith, degrees.
+        pixel_size (float): pixel size in m.
+        cloud_height (float, optional): cloud height, in m, the ray is cast from. Defaults to SHADOW_CLOUD_HEIGHT.
+
+    Returns:
+        tuple: (steps,) int row and column offsets of the ray pixels, their float distance in pixels,
+            and the lowest cloud height, in m, whose ray reaches them.
+    """
+    angle = np.deg2rad(cwn_to_math(solar_azimuth - 180))
+    direction = np.array([np.cos(angle), -np.sin(angle)])
+    with np.errstate(divide='ignore'):
+        ray_length = distance_of_ray(solar_zenith, np.sin(angle) / np.cos(angle), pixel_size, cloud_height)
+    n_steps = int(np.floor(ray_length)) if np.isfinite(ray_length) and ray_length > 0 else 0
+
+    nslope = direction / np.max(np.abs(direction))
+    steps = np.arange(1, n_steps + 1)
+    px = np.rint(nslope * steps[:, np.newaxis]).astype(int)
+    return px[:, 1], px[:, 0], np.hypot(px[:, 0], px[:, 1]), steps * (cloud_height / ray_length)
+
+
+def cast_shadows_binned(clouds, solar_azimuth, solar_zenith, pixel_size, angle_bins=(1.0, 1.0), edge_only=False,
+                        edge_depth=2, cloud_height=SHADOW_CLOUD_HEIGHT, return_height=False):
+    """Ray trace cloud shadows in map geometry, with the solar angles quantized into bins.
+
+    Solar angles vary slowly across a scene, so cloud pixels are grouped by azimuth and zenith
+    bin, and the ray of each bin, its shadow_stencil, is computed once at the bin center.  The
+    stencil is then applied to all the cloud pixels of its bin at once, as a dilation of their
+    mask by each ray offset in turn, over the bounding box of the bin.  Rays follow the
+    antisolar azimuth, as in cast_shadows, so the two agree to within the bin width and the
+    rasterization of the rays.
+
+    Args:
+        clouds (array, bool): orthorectified cloud mask.
+        solar_azimuth (array, float): orthorectified solar azimuth, degrees clockwise from North.
+        solar_zenith (array, float): orthorectified solar zenith, degrees.
+        pixel_size (float): pixel size in m.
+        angle_bins (tuple, optional): (azimuth, zenith) bin widths, degrees. Defaults to (1, 1).
+        edge_only (bool, optional): only cast rays from antisolar-facing cloud boundaries. Defaults to False.
+        edge_depth (int, optional): depth of the cloud boundary, in ray steps, for edge_only. Defaults to 2.
+        cloud_height (float, optional): cloud height, in m, rays are cast from. Defaults to SHADOW_CLOUD_HEIGHT.
+        return_height (bool, optional): also return the shade height, as cast_shadows. Defaults to False.
+
+    Returns:
+        array like: distance, in pixels, to the nearest shading cloud; 0 for cloud and unshaded pixels.
+            With return_height, a tuple of the distance and the shade height.
+    """
+    clouds_loc = np.where(clouds)
+    azimuth_bin = np.floor(solar_azimuth[clouds].astype(np.float64) / angle_bins[0]).astype(np.int64)
+    zenith_bin = np.floor(solar_zenith[clouds].astype(np.float64) / angle_bins[1]).astype(np.int64)
+
+    # One integer key per (azimuth, zenith) bin, and the cloud pixels sorted by bin
+    n_bins = 0
+    if len(azimuth_bin) > 0:
+        n_zenith = zenith_bin.max() - zenith_bin.min() + 1
+        key = (azimuth_bin - azimuth_bin.min()) * n_zenith + zenith_bin - zenith_bin.min()
+        order = np.argsort(key, kind='stable')
+        bin_starts = np.flatnonzero(np.diff(key[order], prepend=-1))
+        n_bins = len(bin_starts)
+
+    out_mask = np.full(clouds.shape, np.inf)
+    out_height = np.full(clouds.shape, np.inf) if return_height else None
+    for members in np.split(order, bin_starts[1:]) if n_bins > 0 else []:
+        d_rows, d_cols, distance, height = shadow_stencil((azimuth_bin[members[0]] + 0.5) * angle_bins[0],
+                                                          (zenith_bin[members[0]] + 0.5) * angle_bins[1],
+                                                          pixel_size, cloud_height)
+        rows, cols = clouds_loc[0][members], clouds_loc[1][members]
+        if len(distance) == 0:
+            continue
+        if edge_only:
+            # As antisolar_edge_pixels, along the first steps of the stencil
+            edge = np.zeros(len(rows), dtype=bool)
+            for d_row, d_col in zip(d_rows[:edge_depth], d_cols[:edge_depth]):
+                step_rows, step_cols = rows + d_row, cols + d_col
+                inside = (step_rows >= 0) & (step_rows < clouds.shape[0])
+                inside &= (step_cols >= 0) & (step_cols < clouds.shape[1])
+                step_clear = np.ones(len(rows), dtype=bool)
+                step_clear[inside] = np.logical_not(clouds[step_rows[inside], step_cols[inside]])
+                edge |= step_clear
+            rows, cols = rows[edge], cols[edge]
+            if len(rows) == 0:
+                continue
+
+        row_min, col_min = rows.min(), cols.min()
+        box_shape = (rows.max() - row_min + 1, cols.max() - col_min + 1)
+        if len(rows) * BINNED_SCATTER_COST < box_shape[0] * box_shape[1]:
+            # Few pixels for their bounding box, such as edge pixels: scatter the stencil from each of them
+            chunk = max(2**18 // len(distance), 1)
+            for chunk_start in range(0, len(rows), chunk):
+                ray_rows = rows[chunk_start:chunk_start + chunk, np.newaxis] + d_rows
+                ray_cols = cols[chunk_start:chunk_start + chunk, np.newaxis] + d_cols
+                inside = (ray_rows >= 0) & (ray_rows < clouds.shape[0]) & (ray_cols >= 0) & (ray_cols < clouds.shape[1])
+                np.minimum.at(out_mask, (ray_rows[inside], ray_cols[inside]),
+                              np.broadcast_to(distance, ray_rows.shape)[inside])
+                if return_height:
+                    np.minimum.at(out_height, (ray_rows[inside], ray_cols[inside]),
+                                  np.broadcast_to(height, ray_rows.shape)[inside])
+            continue
+
+        source = np.zeros(box_shape, dtype=bool)
+        source[rows - row_min, cols - col_min] = True
+        # Region the stencil reaches from the bounding box, and the first stencil step reaching each of its pixels;
+        # distance and height both grow along the stencil, so the first step holds the minimum of each
+        reach_top, reach_left = max(row_min + min(d_rows.min(), 0), 0), max(col_min + min(d_cols.min(), 0), 0)
+        reach_bottom = min(row_min + box_shape[0] + max(d_rows.max(), 0), clouds.shape[0])
+        reach_right = min(col_min + box_shape[1] + max(d_cols.max(), 0), clouds.shape[1])
+        first_step = np.full((reach_bottom - reach_top, reach_right - reach_left), -1, dtype=np.int32)
+        for step in range(len(distance) - 1, -1, -1):
+            d_row, d_col = d_rows[step], d_cols[step]
+            # Part of the shifted bounding box inside the image, and the source pixels that land there
+            top, left = max(row_min + d_row, 0), max(col_min + d_col, 0)
+            bottom = min(row_min + d_row + source.shape[0], clouds.shape[0])
+            right = min(col_min + d_col + source.shape[1], clouds.shape[1])
+            if bottom <= top or right <= left:
+                continue
+            shifted = source[top - row_min - d_row:bottom - row_min - d_row, left - col_min - d_col:right - col_min - d_col]
+            np.copyto(first_step[top - reach_top:bottom - reach_top, left - reach_left:right - reach_left], step,
+                      where=shifted)
+        reached = first_step >= 0
+        window = out_mask[reach_top:reach_bottom, reach_left:reach_right]
+        np.minimum(window, distance[first_step], out=window, where=reached)
+        if return_height:
+            window = out_height[reach_top:reach_bottom, reach_left:reach_right]
+            np.minimum(window, height[first_step], out=window, where=reached)
+    logging.debug(f'Cast shadows from {n_bins} solar angle bins')
+
+    out_mask[np.isinf(out_mask)] = 0
+    out_mask[clouds_loc[0], clouds_loc[1]] = 0
+    if return_height:
+        out_height[clouds_loc[0], clouds_loc[1]] = np.inf
+        return out_mask, out_height
+    return out_mask
+
+
+def cast_shadows(clouds, solar_azimuth, solar_zenith, pixel_size, max_chunk_pixels=2**18, edge_only=False,
+                 edge_depth=2, offset=(0, 0), grid_shape=None, angle_bins=None, cloud_height=SHADOW_CLOUD_HEIGHT,
+                 return_height=False):
+    """Ray trace cloud shadows in map geometry.
+
+    Antisolar rays from every cloud pixel are traced with bresenham_line.trace_rays, in chunks
+    of at most max_chunk_pixels ray pixels, and each pixel keeps the distance to the nearest
+    cloud that shades it.  Rays are num_x_pixels steps long, rounded down, in any direction.
+
+    With edge_only, rays are only cast from cloud pixels on the antisolar-facing boundary
+    of each cloud (see antisolar_edge_pixels).  The ray from an interior pixel crosses its
+    own cloud before reaching clear pixels that the boundary rays cover at a shorter
+    distance, so the result differs from the full trace only where the rasterized rays
+    do not line up - typically well under 1% of shadow pixels with edge_depth=2.
+
+    The clouds may be a window of a larger orthorectified grid, at offset in a grid of
+    grid_shape.  Rays are then traced in grid coordinates, so they follow the same pixels
+    as over the whole grid.
+
+    With angle_bins, the solar angles are quantized and rays shared within each bin, see
+    cast_shadows_binned; this per-pixel trace remains the reference.
+
+    Ray lengths scale with the cloud height, so step k of a ray traced from cloud_height is
+    also reached from any cloud at k / ray length * cloud_height or above.  With return_height,
+    each pixel also keeps the lowest such height over all rays, from which the shadows of any
+    lower cloud height follow without tracing again (see height_shadow_bands).
+
+    Args:
+        clouds (array, bool): orthorectified cloud mask.
+        solar_azimuth (array, float): orthorectified solar azimuth, degrees clockwise from North.
+        solar_zenith (array, float): orthorectified solar zenith, degrees.
+        pixel_size (float): pixel size in m.
+        max_chunk_pixels (int, optional): maximum number of ray pixels traced at once. Defaults to 2**18.
+        edge_only (bool, optional): only cast rays from antisolar-facing cloud boundaries. Defaults to False.
+        edge_depth (int, optional): depth of the cloud boundary, in ray steps, for edge_only. Defaults to 2.
+        offset (tuple, optional): (row, col) of clouds[0, 0] in the orthorectified grid. Defaults to (0, 0).
+        grid_shape (tuple, optional): (rows, cols) of the orthorectified grid. Defaults to the shape of clouds.
+        angle_bins (tuple, optional): (azimuth, zenith) bin widths, in degrees, to quantize the solar
+            angles to. Defaults to None (exact per-pixel rays).
+        cloud_height (float, optional): cloud height, in m, rays are cast from. Defaults to SHADOW_CLOUD_HEIGHT.
+        return_height (bool, optional): also return the shade height. Defaults to False.
+
+    Returns:
+        array like: distance, in pixels, to the nearest shading cloud; 0 for cloud and unshaded pixels.
+            With return_height, a tuple of the distance and the shade height: the lowest cloud height,
+            in m, whose shadow reaches each pixel, infinite for cloud and unshaded pixels.
+    """
+    if angle_bins is not None:
+        # Stencils are relative to each cloud pixel, so they do not depend on the window offset
+        return cast_shadows_binned(clouds, solar_azimuth, solar_zenith, pixel_size, angle_bins, edge_only=edge_only,
+                                   edge_depth=edge_depth, cloud_height=cloud_height, return_height=return_height)
+    if grid_shape is None:
+        grid_shape = clouds.shape
+    bounds = (0, 0, grid_shape[1] - 1, grid_shape[0] - 1)
+    clouds_loc = np.where(clouds)
+    cloud_x, cloud_y = clouds_loc[1] + offset[1], clouds_loc[0] + offset[0]
+    # Geometry is evaluated in float64 whatever the dtype of the angle images
+    cloud_azimuth = solar_azimuth[clouds].astype(np.float64)
+    cloud_zenith = solar_zenith[clouds].astype(np.float64)
+    antisolar_edge_px_x, antisolar_edge_px_y, antisolar_s = edge_coords_from_target(cloud_x, cloud_y, cwn_to_math(cloud_azimuth - 180), bounds)
+    num_x_pixels = distance_of_ray(cloud_zenith, antisolar_s, pixel_size, cloud_height)
+
+    start = np.stack((cloud_x, cloud_y), axis=-1)
+    end = np.stack((antisolar_edge_px_x, antisolar_edge_px_y), axis=-1)
+
+    if edge_only and len(start) > 0:
+        edge = antisolar_edge_pixels(clouds, start, end, edge_depth, offset)
+        logging.info(f'Casting {np.sum(edge)} edge rays, skipped {len(edge) - np.sum(edge)} of {len(edge)} cloud pixels')
+        start, end, num_x_pixels = start[edge], end[edge], num_x_pixels[edge]
+
+    out_mask = np.full(clouds.shape, 1e6)
+    out_height = np.full(clouds.shape, np.inf) if return_height else None
+    n_chunks = 0
+    for ray, records in bresenham_line.trace_rays(start, end, num_x_pixels, shape=clouds.shape, origin=offset,
+                                                  chunk_size=max_chunk_pixels):
+        px = (records[:, 0] - offset[0], records[:, 1] - offset[1])
+        px_dist = np.hypot(records[:, 1] - start[ray, 0], records[:, 0] - start[ray, 1])
+        np.minimum.at(out_mask, px, px_dist)
+        if return_height:
+            np.minimum.at(out_height, px, records[:, 2] * (cloud_height / num_x_pixels[ray]))
+        n_chunks += 1
+    logging.debug(f'Traced {len(start)} rays in {n_chunks} chunks')
+
+    out_mask[out_mask == 1e6] = 0
+    out_mask[clouds_loc[0], clouds_loc[1]] = 0
+    if return_height:
+        out_height[clouds_loc[0], clouds_loc[1]] = np.inf
+        return out_mask, out_height
+    return out_mask
+
+
+def _cast_shadows_loop(clouds, solar_azimuth, solar_zenith, pixel_size):
+    """Reference, one ray at a time, implementation of cast_shadows."""
+    bounds = (0, 0, clouds.shape[1] - 1, clouds.shape[0] - 1)
+    clouds_loc = np.where(clouds)
+    antisolar_edge_px_x, antisolar_edge_px_y, antisolar_s = edge_coords_from_target(clouds_loc[1], clouds_loc[0], cwn_to_math(solar_azimuth[clouds] - 180), bounds)
+    num_x_pixels = distance_of_ray(solar_zenith[clouds], antisolar_s, pixel_size)
+    out_mask = np.full(clouds.shape, 1e6)
+    for _l in range(len(clouds_loc[0])):
+        if not np.isfinite(num_x_pixels[_l]):
+            continue
+        linepx = bresenham_line.bresenhamline(np.array([clouds_loc[1][_l], clouds_loc[0][_l]]).reshape(1,-1), np.array([antisolar_edge_px_x[_l], antisolar_edge_px_y[_l]]).reshape(1,-1), max_iter=num_x_pixels[_l])
+        valid = (linepx[:,0] >= 0) & (linepx[:,0] < clouds.shape[1])
+        valid &= (linepx[:,1] >= 0) & (linepx[:,1] < clouds.shape[0])
+
+        linepx = linepx[valid,:]
+        px_dist = np.sqrt((linepx[:,0] - clouds_loc[1][_l])**2 + (linepx[:,1] - clouds_loc[0][_l])**2)
+        out_mask[linepx[:,1], linepx[:,0]] = np.minimum(px_dist, out_mask[linepx[:,1], linepx[:,0]])
+    out_mask[out_mask == 1e6] = 0
+    out_mask[clouds_loc[0], clouds_loc[1]] = 0
+    return out_mask
+
+
+def loc_jacobian(loc, lines, samples):
+    """Ground displacement per raw pixel step, from central differences of the LOC coordinates.
+
+    Args:
+        loc (array like): (rows, cols, >= 2) raw longitude and latitude, degrees.
+        lines (array, int): raw lines of the pixels to evaluate.
+        samples (array, int): raw samples of the pixels to evaluate.
+
+    Returns:
+        array, float: (n, 2, 2) [[east, north] per sample, [east, north] per line] in m, transposed
+            as [[d east / d sample, d east / d line], [d north / d sample, d north / d line]].
+    """
+    jacobian = np.empty((len(lines), 2, 2))
+    lat = np.radians(np.asarray(loc[lines, samples, 1], dtype=np.float64))
+    for axis, (index, size) in enumerate([(samples, loc.shape[1]), (lines, loc.shape[0])]):
+        low, high = np.maximum(index - 1, 0), np.minimum(index + 1, size - 1)
+        if axis == 0:
+            delta = np.asarray(loc[lines, high, :2], dtype=np.float64) - loc[lines, low, :2]
+        else:
+            delta = np.asarray(loc[high, samples, :2], dtype=np.float64) - loc[low, samples, :2]
+        # Longitude differences across the antimeridian
+        delta[:, 0] = (delta[:, 0] + 180) % 360 - 180
+        with np.errstate(divide='ignore', invalid='ignore'):
+            span = (high - low).astype(np.float64)
+            jacobian[:, 0, axis] = np.radians(delta[:, 0]) * EARTH_RADIUS * np.cos(lat) / span
+            jacobian[:, 1, axis] = np.radians(delta[:, 1]) * EARTH_RADIUS / span
+    return jacobian
+
+
+def cast_shadows_raw(clouds, solar_azimuth, solar_zenith, loc, pixel_size, max_chunk_pixels=2**18,
+                     edge_only=False, edge_depth=2, cloud_height=SHADOW_CLOUD_HEIGHT, return_height=False):
+    """Ray trace cloud shadows directly in raw (downtrack, crosstrack) geometry.
+
+    Each antisolar ray is laid out on the ground, along the solar azimuth, and mapped into raw
+    pixel steps through the local LOC Jacobian of its cloud pixel, so no orthorectification is
+    needed.  Ray lengths follow cast_shadows, and distances are in pixels of pixel_size, so the
+    two agree to within the rasterization of the rays and the orthorectification; on the
+    synthetic scenes of benchmarks/shadow_geometry the shadow IoU is 0.91 to 0.97 at every
+    solar azimuth.
+
+    Args:
+        clouds (array, bool): raw cloud mask.
+        solar_azimuth (array, float): raw solar azimuth, degrees clockwise from North.
+        solar_zenith (array, float): raw solar zenith, degrees.
+        loc (array like): (rows, cols, >= 2) raw longitude and latitude, degrees.
+        pixel_size (float): pixel size in m.
+        max_chunk_pixels (int, optional): maximum number of ray pixels traced at once. Defaults to 2**18.
+        edge_only (bool, optional): only cast rays from antisolar-facing cloud boundaries. Defaults to False.
+        edge_depth (int, optional): depth of the cloud boundary, in ray steps, for edge_only. Defaults to 2.
+        cloud_height (float, optional): cloud height, in m, rays are cast from. Defaults to SHADOW_CLOUD_HEIGHT.
+        return_height (bool, optional): also return the shade height, as cast_shadows. Defaults to False.
+
+    Returns:
+        array, float32: distance, in pixels, to the nearest shading cloud; 0 for cloud and unshaded pixels.
+            With return_height, a tuple of the distance and the float32 shade height.
+    """
+    clouds_loc = np.where(clouds)
+    cloud_azimuth = np.radians(np.asarray(solar_azimuth[clouds], dtype=np.float64) - 180)
+    cloud_zenith = np.asarray(solar_zenith[clouds], dtype=np.float64)
+
+    # Unit antisolar direction on the ground, east and north, and the ray length of cast_shadows in pixels
+    east, north = np.sin(cloud_azimuth), np.cos(cloud_azimuth)
+    major = np.maximum(np.abs(east), np.abs(north))
+    with np.errstate(divide='ignore', invalid='ignore'):
+        ray_length = distance_of_ray(cloud_zenith, -north / east, pixel_size, cloud_height) / major
+
+    # Raw pixels per m along the ray, from the inverse of the LOC Jacobian
+    jacobian = loc_jacobian(loc, clouds_loc[0], clouds_loc[1])
+    with np.errstate(divide='ignore', invalid='ignore'):
+        det = jacobian[:, 0, 0] * jacobian[:, 1, 1] - jacobian[:, 0, 1] * jacobian[:, 1, 0]
+        raw_direction = np.stack(((jacobian[:, 1, 1] * east - jacobian[:, 0, 1] * north) / det,
+                                  (jacobian[:, 0, 0] * north - jacobian[:, 1, 0] * east) / det), axis=-1)
+        raw_major = np.max(np.abs(raw_direction), axis=-1)
+        step = raw_direction / raw_major[:, np.newaxis]
+        step_distance = 1 / (raw_major * pixel_size)
+        n_raw = raw_major * ray_length * pixel_size
+
+    start = np.stack((clouds_loc[1], clouds_loc[0]), axis=-1)
+    traced = np.isfinite(n_raw) & np.all(np.isfinite(step), axis=-1) & (n_raw > 0)
+    if edge_only and np.any(traced):
+        edge = antisolar_edge_pixels(clouds, start[traced], start[traced] + step[traced], edge_depth)
+        logging.info(f'Casting {np.sum(edge)} edge rays, skipped {len(edge) - np.sum(edge)} of {len(edge)} '
+                     f'cloud pixels')
+        traced[np.flatnonzero(traced)[~edge]] = False
+    start, step, step_distance, n_raw = start[traced], step[traced], step_distance[traced], n_raw[traced]
+
+    out_mask = np.full(clouds.shape, 1e6)
+    out_height = np.full(clouds.shape, np.inf) if return_height else None
+    n_chunks = 0
+    # Steps are already one pixel along their major axis, so start + step gives the ray direction
+    for ray, records in bresenham_line.trace_rays(start, start + step, n_raw, shape=clouds.shape,
+                                                  chunk_size=max_chunk_pixels):
+        np.minimum.at(out_mask, (records[:, 0], records[:, 1]), records[:, 2] * step_distance[ray])
+        if return_height:
+            np.minimum.at(out_height, (records[:, 0], records[:, 1]), records[:, 2] * (cloud_height / n_raw[ray]))
+        n_chunks += 1
+    logging.debug(f'Traced {len(start)} raw rays in {n_chunks} chunks')
+
+    out_mask[out_mask == 1e6] = 0
+    out_mask[clouds_loc[0], clouds_loc[1]] = 0
+    if return_height:
+        out_height[clouds_loc[0], clouds_loc[1]] = np.inf
+        return out_mask.astype(np.float32), out_height.astype(np.float32)
+    return out_mask.astype(np.float32)
+
+
 def ortho(img_dat, glt, glt_nodata_value=0):
     """Orthorectify a single image
 
@@ -88,12 +479,7 @@ def ortho(img_dat, glt, glt_nodata_value=0):
     Returns:
         array like: orthorectified version of img_dat
     """
-    outdat = np.zeros((glt.shape[0], glt.shape[1], img_dat.shape[-1]))
-    outdat[...] = np.nan
-    valid_glt = np.all(glt != glt_nodata_value, axis=-1)
-    glt[valid_glt] -= 1 # account for 1-based indexing
-    outdat[valid_glt, :] = img_dat[glt[valid_glt, 1], glt[valid_glt, 0], :]
-    return outdat
+    return GltIndex.from_glt(glt, img_dat.shape[:2], glt_nodata_value).ortho(img_dat, dtype=np.float64)
 
 
 def unortho(img_dat, glt, outshape, glt_nodata_value=0, interpolate=False):
@@ -103,109 +489,438 @@ def unortho(img_dat, glt, outshape, glt_nodata_value=0, interpolate=False):
         img_dat (array like): raw input image
         glt (array like): glt - 2 band 1-based indexing for output file(x, y)
         glt_nodata_value (int, optional): Value from glt to ignore. Defaults to 0.
+        interpolate (bool, optional): Fill pixels without a GLT entry from their nearest neighbour. Defaults to False.
 
     Returns:
         array like: unorthorectified version of img_dat
     """
-    outdat = np.zeros(outshape, dtype=np.float32)
-    outdat[:] = np.nan
-    valid_glt = np.all(glt != glt_nodata_value, axis=-1)
-    glt[valid_glt] -= 1 # account for 1-based indexing
-    outdat[glt[valid_glt, 1], glt[valid_glt, 0], :] = img_dat[valid_glt]
+    return GltIndex.from_glt(glt, outshape[:2], glt_nodata_value).unortho(img_dat, dtype=np.float32,
+                                                                          interpolate=interpolate)
 
-    if interpolate:
-        # use 2d linear interpolation from scipy to interpolate the nans
-        x = np.arange(outdat.shape[1])
-        y = np.arange(outdat.shape[0])
-        xx, yy = np.meshgrid(x, y)
-        valid_mask = ~np.isnan(outdat[:, :])
-        points = np.column_stack((xx[valid_mask], yy[valid_mask]))
-        values = outdat[valid_mask]
-        outdat = griddata(points, values, (xx, yy), method='nearest', fill_value=np.nan)
-        
 
-    return outdat
+def shade_distance(clouds, solar, glt_index, pixel_size, edge_only=False, edge_depth=2, angle_bins=None,
+                   cloud_height=SHADOW_CLOUD_HEIGHT, return_height=False):
+    """Cloud shadow distance of a scene in raw geometry, traced on the orthorectified grid
+
+    Args:
+        clouds (array, bool): (rows, cols) raw cloud mask
+        solar (array like): (rows, cols, 2) raw solar azimuth and zenith, degrees
+        glt_index (GltIndex): index maps of the scene
+        pixel_size (float): pixel size in m
+        edge_only (bool, optional): Only cast rays from the antisolar-facing cloud edges. Defaults to False.
+        edge_depth (int, optional): Depth of the cloud edges used with edge_only. Defaults to 2.
+        angle_bins (tuple, optional): (azimuth, zenith) bin widths, degrees, to share rays within. Defaults to
+            None (exact per-pixel rays).
+        cloud_height (float, optional): Cloud height, in m, rays are cast from. Defaults to SHADOW_CLOUD_HEIGHT.
+        return_height (bool, optional): Also return the shade height, see cast_shadows. Defaults to False.
+
+    Returns:
+        array, float32: (rows, cols) distance, in pixels, to the nearest shading cloud, and with
+            return_height, the (rows, cols) shade height in m
+    """
+    logging.info("Ortho files")
+    with profiling.stage('ortho'):
+        # Solar azimuth and zenith go through the GLT together in their input dtype, and clouds as a boolean
+        solar = glt_index.ortho(solar)
+        solar_azimuth, solar_zenith = solar[..., 0], solar[..., 1]
+        clouds = glt_index.ortho(clouds, nodata_value=False)
+
+    logging.info("Run ray trace")
+    with profiling.stage('ray_trace'):
+        out_mask = cast_shadows(clouds, solar_azimuth, solar_zenith, pixel_size, edge_only=edge_only,
+                                edge_depth=edge_depth, angle_bins=angle_bins, cloud_height=cloud_height,
+                                return_height=return_height)
+
+    logging.info("Unortho output mask")
+    with profiling.stage('unortho'):
+        if return_height:
+            return tuple(glt_index.unortho(band.astype(np.float32), interpolate=True) for band in out_mask)
+        return glt_index.unortho(out_mask.astype(np.float32), interpolate=True)
+
+
+def tile_halo(pixel_size, edge_depth=2, cloud_height=SHADOW_CLOUD_HEIGHT):
+    """Halo, in orthorectified pixels, around a tile that holds every cloud whose shadow reaches it
+
+    Rays are at most cloud_height / pixel_size steps long, and each step moves at most
+    one pixel along each axis.  The edge_depth margin lets clouds at the border of the halo
+    find their antisolar edges as they would over the whole grid.
+
+    Args:
+        pixel_size (float): pixel size in m
+        edge_depth (int, optional): Depth of the cloud edges used with edge_only. Defaults to 2.
+        cloud_height (float, optional): Cloud height, in m, rays are cast from. Defaults to SHADOW_CLOUD_HEIGHT.
+
+    Returns:
+        int: halo width in pixels
+    """
+    return int(np.ceil(cloud_height / pixel_size)) + edge_depth + 1
+
+
+def tiled_shade_distance(clouds, solar_azimuth, solar_zenith, glt_set, pixel_size, tile_size=SHADE_TILE_SIZE,
+                         edge_only=False, edge_depth=2, angle_bins=None, glt_nodata_value=0,
+                         cloud_height=SHADOW_CLOUD_HEIGHT, return_height=False):
+    """Cloud shadow distance of a scene in raw geometry, traced over orthorectified GLT tiles
+
+    Gives the same result as shade_distance, but only a tile of the GLT, with a halo of
+    tile_halo pixels, is read and orthorectified at a time, so the memory held for the
+    orthorectified grid does not grow with the size of the GLT.  Where several orthorectified
+    pixels map to the same raw pixel, the last in row-major order is kept, as in GltIndex.
+
+    Args:
+        clouds (array, bool): (rows, cols) raw cloud mask
+        solar_azimuth (array like): (rows, cols) raw solar azimuth, degrees, such as an ENVI memmap band
+        solar_zenith (array like): (rows, cols) raw solar zenith, degrees, such as an ENVI memmap band
+        glt_set (gdal.Dataset): 2 band GLT, 1-based (x, y) indices into the raw image
+        pixel_size (float): pixel size in m
+        tile_size (int, optional): Side of the tiles, in orthorectified pixels. Defaults to SHADE_TILE_SIZE.
+        edge_only (bool, optional): Only cast rays from the antisolar-facing cloud edges. Defaults to False.
+        edge_depth (int, optional): Depth of the cloud edges used with edge_only. Defaults to 2.
+        angle_bins (tuple, optional): (azimuth, zenith) bin widths, degrees, to share rays within. Defaults to
+            None (exact per-pixel rays).
+        glt_nodata_value (int, optional): Value from glt to ignore. Defaults to 0.
+        cloud_height (float, optional): Cloud height, in m, rays are cast from. Defaults to SHADOW_CLOUD_HEIGHT.
+        return_height (bool, optional): Also return the shade height, see cast_shadows. Defaults to False.
+
+    Returns:
+        array, float32: (rows, cols) distance, in pixels, to the nearest shading cloud, and with
+            return_height, the (rows, cols) shade height in m
+    """
+    grid_shape = (glt_set.RasterYSize, glt_set.RasterXSize)
+    halo = tile_halo(pixel_size, edge_depth, cloud_height)
+    out_mask = np.zeros(clouds.size, dtype=np.float32)
+    out_height = np.full(clouds.size, np.inf, dtype=np.float32) if return_height else None
+    # Flat orthorectified index of the pixel each raw pixel was last taken from
+    owner = np.full(clouds.size, -1, dtype=np.int64)
+
+    n_tiles = 0
+    for row in range(0, grid_shape[0], tile_size):
+        for col in range(0, grid_shape[1], tile_size):
+            window_row, window_col = max(row - halo, 0), max(col - halo, 0)
+            window_shape = (min(row + tile_size + halo, grid_shape[0]) - window_row,
+                            min(col + tile_size + halo, grid_shape[1]) - window_col)
+            glt = glt_set.ReadAsArray(window_col, window_row, window_shape[1], window_shape[0])
+            valid_glt, raw_flat = glt_raw_flat(np.moveaxis(glt, 0, -1), clouds.shape, glt_nodata_value)
+            del glt
+            if len(raw_flat) == 0:
+                continue
+
+            # Solar geometry is only read for the cloud pixels, the only ones the rays use
+            tile_clouds = np.zeros(window_shape, dtype=bool)
+            tile_clouds[valid_glt] = clouds.reshape(-1)[raw_flat]
+            cloud_raw = np.unravel_index(raw_flat[tile_clouds[valid_glt]], clouds.shape)
+            tile_azimuth = np.full(window_shape, np.nan)
+            tile_zenith = np.full(window_shape, np.nan)
+            tile_azimuth[tile_clouds] = solar_azimuth[cloud_raw]
+            tile_zenith[tile_clouds] = solar_zenith[cloud_raw]
+
+            tile_mask = cast_shadows(tile_clouds, tile_azimuth, tile_zenith, pixel_size, edge_only=edge_only,
+                                     edge_depth=edge_depth, offset=(window_row, window_col), grid_shape=grid_shape,
+                                     angle_bins=angle_bins, cloud_height=cloud_height, return_height=return_height)
+            if return_height:
+                tile_mask, tile_height = tile_mask
+
+            # Only the tile itself is kept, its halo belongs to the neighbouring tiles
+            tile_rows, tile_cols = np.nonzero(valid_glt)
+            core = (tile_rows >= row - window_row) & (tile_rows < row - window_row + tile_size)
+            core &= (tile_cols >= col - window_col) & (tile_cols < col - window_col + tile_size)
+            tile_rows, tile_cols, raw_flat = tile_rows[core], tile_cols[core], raw_flat[core]
+            ortho_flat = (tile_rows + window_row).astype(np.int64) * grid_shape[1] + tile_cols + window_col
+
+            later = ortho_flat > owner[raw_flat]
+            owner[raw_flat[later]] = ortho_flat[later]
+            out_mask[raw_flat[later]] = tile_mask[tile_rows[later], tile_cols[later]]
+            if return_height:
+                out_height[raw_flat[later]] = tile_height[tile_rows[later], tile_cols[later]]
+            n_tiles += 1
+    logging.debug(f'Traced {n_tiles} GLT tiles of {tile_size} pixels with a {halo} pixel halo')
+
+    holes = (owner < 0).reshape(clouds.shape)
+    out_mask = fill_nearest(out_mask.reshape(clouds.shape), holes)
+    if return_height:
+        return out_mask, fill_nearest(out_height.reshape(clouds.shape), holes)
+    return out_mask
+
+
+def read_cloud_mask(cloud_set, band=1, threshold=None):
+    """Read the clouds, value 1, of a cloud product in strips of whole blocks
+
+    Args:
+        cloud_set (gdal.Dataset): raw cloud product
+        band (int, optional): 1-based band of the cloud values. Defaults to 1.
+        threshold (float, optional): clouds are values above this, as for a cloud probability,
+            rather than value 1. Defaults to None.
+
+    Returns:
+        array, bool: (rows, cols) cloud mask
+    """
+    cloud_band = cloud_set.GetRasterBand(band)
+    block_lines = max(cloud_band.GetBlockSize()[1], 1)
+    lines = block_lines * max(SHADE_WRITE_LINES // block_lines, 1)
+    clouds = np.zeros((cloud_set.RasterYSize, cloud_set.RasterXSize), dtype=bool)
+    for line in range(0, cloud_set.RasterYSize, lines):
+        n_lines = min(lines, cloud_set.RasterYSize - line)
+        values = cloud_band.ReadAsArray(0, line, cloud_set.RasterXSize, n_lines)
+        clouds[line:line + n_lines] = values == 1 if threshold is None else values > threshold
+    return clouds
+
+
+def raw_shade_distance(clouds, solar, loc, pixel_size, edge_only=False, edge_depth=2,
+                       cloud_height=SHADOW_CLOUD_HEIGHT, return_height=False):
+    """Cloud shadow distance of a scene, traced in raw geometry without orthorectification
+
+    Args:
+        clouds (array, bool): (rows, cols) raw cloud mask
+        solar (array like): (rows, cols, 2) raw solar azimuth and zenith, degrees
+        loc (array like): (rows, cols, >= 2) raw longitude and latitude, degrees
+        pixel_size (float): pixel size in m
+        edge_only (bool, optional): Only cast rays from the antisolar-facing cloud edges. Defaults to False.
+        edge_depth (int, optional): Depth of the cloud edges used with edge_only. Defaults to 2.
+        cloud_height (float, optional): Cloud height, in m, rays are cast from. Defaults to SHADOW_CLOUD_HEIGHT.
+        return_height (bool, optional): Also return the shade height, see cast_shadows. Defaults to False.
+
+    Returns:
+        array, float32: (rows, cols) distance, in pixels, to the nearest shading cloud, and with
+            return_height, the (rows, cols) shade height in m
+    """
+    logging.info("Run raw geometry ray trace")
+    with profiling.stage('ray_trace'):
+        return cast_shadows_raw(clouds, solar[..., 0], solar[..., 1], loc, pixel_size, edge_only=edge_only,
+                                edge_depth=edge_depth, cloud_height=cloud_height, return_height=return_height)
+
+
+def shade_agreement(shade, reference, tolerance=1.0):
+    """Agreement of a cloud shadow distance with a reference, such as raw against ortho geometry
+
+    Args:
+        shade (array, float): (rows, cols) shadow distance, in pixels
+        reference (array, float): (rows, cols) reference shadow distance, in pixels
+        tolerance (float, optional): largest distance difference, in pixels, counted as agreeing. Defaults to 1.
+
+    Returns:
+        dict: 'shadow_iou', the intersection over union of the shaded pixels, 'distance_agreement', the
+            fraction of the pixels shaded in both whose distances agree within tolerance, and
+            'agreement', the fraction of pixels shaded in either that are shaded in both and agree
+    """
+    shaded, reference_shaded = shade > 0, reference > 0
+    both = shaded & reference_shaded
+    n_either = np.sum(shaded | reference_shaded)
+    close = np.abs(np.asarray(shade, dtype=np.float64)[both] - reference[both]) <= tolerance
+    return {'shadow_iou': float(np.sum(both) / n_either) if n_either > 0 else 1.0,
+            'distance_agreement': float(np.mean(close)) if len(close) > 0 else 1.0,
+            'agreement': float(np.sum(close) / n_either) if n_either > 0 else 1.0}
+
+
+def height_shadow_bands(shade_height, cloud_heights, weights=None):
+    """Per-height cloud shadow flags, and their weighted shadow probability, from one shade height
+
+    A pixel is shaded by clouds at a given height when the lowest cloud height whose shadow
+    reaches it, from cast_shadows with return_height, is at or below it.
+
+    Args:
+        shade_height (array, float): (rows, cols) shade height, in m, traced from the largest of cloud_heights
+        cloud_heights (list): cloud heights, in m
+        weights (list, optional): Weight, or probability, of each cloud height. Defaults to equal weights.
+
+    Returns:
+        tuple: (heights, rows, cols) float32 shadow flags, and the (rows, cols) float32 shadow probability
+    """
+    weights = np.ones(len(cloud_heights)) if weights is None else np.asarray(weights, dtype=np.float64)
+    if len(weights) != len(cloud_heights) or np.any(weights < 0) or np.sum(weights) <= 0:
+        raise ValueError('Cloud height weights must be non-negative, not all zero, and one per height')
+
+    flags = np.empty((len(cloud_heights),) + shade_height.shape, dtype=np.float32)
+    probability = np.zeros(shade_height.shape, dtype=np.float32)
+    for flag, cloud_height, weight in zip(flags, cloud_heights, weights / np.sum(weights)):
+        # Allow for the float32 rounding of heights reached exactly at the end of a ray
+        np.less_equal(shade_height, cloud_height * (1 + np.finfo(np.float32).eps), out=flag, casting='unsafe')
+        probability += np.float32(weight) * flag
+    return flags, probability
+
+
+def write_shade(output_file, out_mask, band_names=None):
+    """Write the shadow distance, and any further bands, as an LZW compressed GeoTIFF
+
+    Args:
+        output_file (str): output file path
+        out_mask (array like): (rows, cols) shadow distance, or (bands, rows, cols) with the shadow
+            distance first, in raw geometry
+        band_names (list, optional): description of each band. Defaults to None (no descriptions).
+    """
+    logging.info(f"Writing output to {output_file}")
+    bands = out_mask if out_mask.ndim == 3 else out_mask[np.newaxis]
+    driver = gdal.GetDriverByName('GTiff')
+    outDataset = driver.Create(output_file, bands.shape[2], bands.shape[1], bands.shape[0], gdal.GDT_Float32,
+                               ['COMPRESS=LZW'])
+    for n, band_dat in enumerate(bands):
+        band = outDataset.GetRasterBand(n + 1)
+        if band_names is not None:
+            band.SetDescription(band_names[n])
+        # Whole strips at a time, so that each block is compressed once
+        block_lines = max(band.GetBlockSize()[1], 1)
+        lines = block_lines * max(SHADE_WRITE_LINES // block_lines, 1)
+        for line in range(0, band_dat.shape[0], lines):
+            band.WriteArray(np.asarray(band_dat[line:line + lines], dtype=np.float32), 0, line)
+        del band
+    del outDataset
 
 
 @click.command()
-@click.argument('cloud_file', '-c', type=click.Path(exists=True), required=True,
-              help='Path to cloud file')
-@click.argument('obs_file', '-o', type=click.Path(exists=True), required=True,
-              help='Path to observation file')
-@click.argument('glt_file', '-o', type=click.Path(exists=True), required=True,
-              help='Path to the glt file')
-@click.argument('output_file', '-out', type=click.Path(), 
-              help='Output file path')
+@click.argument('cloud_file', type=click.Path(exists=True))
+@click.argument('obs_file', type=click.Path(exists=True))
+@click.argument('glt_file', type=click.Path(exists=True))
+@click.argument('output_file', type=click.Path())
 @click.option('--solar_azimuth_band', '-sa', type=int, default=4)
 @click.option('--solar_zenith_band', '-sz', type=int, default=5)
+@click.option('--cloud_threshold', type=float, default=None,
+              help='Cast shadows from values above this, such as a SpecTf-Cloud probability, rather than value 1')
+@click.option('--loc_file', type=click.Path(exists=True), default=None,
+              help='Optional LOC file to derive the pixel size from; otherwise the GLT grid spacing is used')
+@click.option('--pixel_size_cache_dir', type=click.Path(), default=None,
+              help='Directory to cache the pixel size derived from the --loc_file in, for repeated runs over the same scene')
+@click.option('--edge_only', is_flag=True, default=False,
+              help='Only cast shadow rays from the antisolar-facing edges of clouds')
+@click.option('--edge_depth', type=int, default=2,
+              help='Depth, in pixels, of the cloud edges used with --edge_only')
+@click.option('--angle_bins', type=(float, float), default=None,
+              help='Quantize the solar azimuth and zenith into bins of these widths, in degrees, and share one '
+                   'ray per bin; exact per-pixel rays if not set')
+@click.option('--cloud_height', type=float, multiple=True,
+              help='Cloud height, in m, to flag shadows for; repeat for several heights, traced in one pass to the '
+                   f'highest. Adds a shadow band per height and a shadow probability band. Defaults to '
+                   f'{SHADOW_CLOUD_HEIGHT} m, with the distance band only')
+@click.option('--height_weight', type=float, multiple=True,
+              help='Weight, or probability, of each --cloud_height in the shadow probability; equal if not set')
+@click.option('--raw_geometry', is_flag=True, default=False,
+              help='Trace shadows in raw geometry from the LOC file, without orthorectifying')
+@click.option('--agreement_tolerance', type=float, default=None,
+              help='With --raw_geometry, also run the ortho path and log the agreement within this many pixels')
+@click.option('--tile_size', type=int, default=SHADE_TILE_SIZE,
+              help='Side, in orthorectified pixels, of the GLT tiles read and traced at once; 0 for the whole GLT')
+@click.option('--glt_cache_dir', type=click.Path(), default=None,
+              help='Directory to cache GLT index maps in, for repeated runs over the same scene, with --tile_size 0')
+@click.option('--profile_file', type=click.Path(), default=None,
+              help='JSON file with the wall time, CPU time, peak memory and I/O of each stage')
+@click.option('--profile_hotspots', is_flag=True, default=False,
+              help='With --profile_file, also capture cProfile statistics and traced allocations')
 @click.option('--log_level', '-l', type=click.Choice(['DEBUG', 'INFO', 'WARNING', 'ERROR', 'CRITICAL']), default='INFO',
               help='Set the logging level')
 @click.option('--log_file', '-lf', type=click.Path(), default=None,
               help='Path to the log file. If not provided, logs will be printed to console.')
 def main(cloud_file, obs_file, output_file, glt_file,
-         solar_azimuth_band, solar_zenith_band, log_level, log_file):
-    """Process cloud and observation files."""
+         solar_azimuth_band, solar_zenith_band, cloud_threshold, loc_file, pixel_size_cache_dir, edge_only, edge_depth,
+         angle_bins, cloud_height, height_weight, raw_geometry, agreement_tolerance, tile_size, glt_cache_dir,
+         profile_file, profile_hotspots, log_level, log_file):
+    """Process cloud and observation files.
+
+    Casts shadows from the clouds (value 1, or above --cloud_threshold) in CLOUD_FILE using the solar
+    geometry in OBS_FILE, projected through GLT_FILE, and writes the shadow distance to OUTPUT_FILE.
+    With --cloud_height, the shadow flag of each height and their weighted shadow probability follow
+    as further bands.
+    """
 
     logging.basicConfig(level=log_level, filename=log_file, filemode='w',
                         format='%(asctime)s - %(levelname)s - %(message)s')
     logging.info('Starting cloud processing')
-    logging.info('Arguments: %s', {
+    arguments = {
         'cloud_file': cloud_file,
         'obs_file': obs_file,
         'glt_file': glt_file,
         'output_file': output_file,
         'solar_azimuth_band': solar_azimuth_band,
         'solar_zenith_band': solar_zenith_band,
+        'cloud_threshold': cloud_threshold,
+        'loc_file': loc_file,
+        'pixel_size_cache_dir': pixel_size_cache_dir,
+        'edge_only': edge_only,
+        'edge_depth': edge_depth,
+        'angle_bins': angle_bins,
+        'cloud_height': cloud_height,
+        'height_weight': height_weight,
+        'raw_geometry': raw_geometry,
+        'agreement_tolerance': agreement_tolerance,
+        'tile_size': tile_size,
+        'glt_cache_dir': glt_cache_dir,
+        'profile_file': profile_file,
+        'profile_hotspots': profile_hotspots,
         'log_level': log_level,
         'log_file': log_file
-    })
-    
-    
-    logging.info(f"Reading cloud file: {cloud_file}")
-    cloud_set = gdal.Open(cloud_file, gdal.GA_ReadOnly)
-    clouds = cloud_set.ReadAsArray()
-    
-    logging.info(f"Reading observation file: {obs_file}")
-    obs_set = gdal.Open(obs_file, gdal.GA_ReadOnly)
-    solar_azimuth = obs_set.GetRasterBand(solar_azimuth_band).ReadAsArray()
-    solar_zenith = obs_set.GetRasterBand(solar_zenith_band).ReadAsArray()
-
-    logging.info(f"Reading GLT file: {glt_file}")
-    glt_set = gdal.Open(glt_file, gdal.GA_ReadOnly)
-    glt = glt_set.ReadAsArray()
-
-
-    logging.info("Ortho files")
-    solar_azimuth = ortho(solar_azimuth[..., np.newaxis], glt).squeeze()
-    solar_zenith = ortho(solar_zenith[...,np.newaxis], glt).squeeze()
-    clouds = ortho(clouds[...,np.newaxis], glt).squeeze() == 1
-
-    logging.info("Run ray trace")
-    bounds = (0, 0, solar_azimuth.shape[1] - 1, solar_azimuth.shape[0] - 1)
-    clouds_loc = np.where(clouds)
-    antisolar_edge_px_x, antisolar_edge_px_y, antisolar_s = edge_coords_from_target(clouds_loc[1], clouds_loc[0], cwn_to_math(solar_azimuth[clouds] - 180), bounds)
-    num_x_pixels = distance_of_ray(solar_zenith[clouds], antisolar_s, 60)
-    out_mask = np.ones_like(solar_azimuth)*1e6
-    for _l in range(len(clouds_loc[0])):
-        linepx = bresenham_line.bresenhamline(np.array([clouds_loc[1][_l], clouds_loc[0][_l]]).reshape(1,-1), np.array([antisolar_edge_px_x[_l], antisolar_edge_px_y[_l]]).reshape(1,-1), max_iter=num_x_pixels[_l])
-        valid = linepx[:,0] < bounds[2]
-        valid[linepx[:,1] >= bounds[3]] = False
-
-        linepx = linepx[valid,:]
-        px_dist = np.sqrt((linepx[:,0] - clouds_loc[1][_l])**2 + (linepx[:,1] - clouds_loc[0][_l])**2)
-        out_mask[linepx[:,1], linepx[:,0]] = np.minimum(px_dist, out_mask[linepx[:,1], linepx[:,0]])
-    out_mask[out_mask == 1e6] = 0
-    out_mask[clouds_loc[0], clouds_loc[1]] = 0
-
-
-    logging.info("Unortho output mask")
-    out_mask = unortho(out_mask, glt, (cloud_set.RasterYSize, cloud_set.RasterXSize), interpolate=True)
-
-    logging.info(f"Writing output to {output_file}")
-    driver = gdal.GetDriverByName('GTiff')
-    outDataset = driver.Create(output_file, cloud_set.RasterXSize, cloud_set.RasterYSize, 1, gdal.GDT_Float32, ['COMPRESS=LZW'])
-    outDataset.GetRasterBand(1).WriteArray(out_mask, 0, 0)
-    del outDataset
+    }
+    logging.info('Arguments: %s', arguments)
+    if raw_geometry and loc_file is None:
+        raise click.UsageError('--raw_geometry needs the --loc_file')
+    if height_weight and len(height_weight) != len(cloud_height):
+        raise click.UsageError('--height_weight needs one weight per --cloud_height')
+    if any(height <= 0 for height in cloud_height):
+        raise click.UsageError('--cloud_height must be positive')
+    # Shadows of every height follow from the rays of the highest clouds
+    trace_height = max(cloud_height) if cloud_height else SHADOW_CLOUD_HEIGHT
+    return_height = len(cloud_height) > 0
+
+    if glt_cache_dir is not None and tile_size > 0 and not raw_geometry:
+        logging.warning('The GLT cache is only used with --tile_size 0')
+
+    with profiling.profiled('cloud_shade', profile_file, profile_hotspots, arguments):
+        with profiling.stage('read_inputs'):
+            logging.info(f"Reading cloud file: {cloud_file}")
+            cloud_set = gdal.Open(cloud_file, gdal.GA_ReadOnly)
+            clouds = read_cloud_mask(cloud_set, threshold=cloud_threshold)
+
+            # Solar geometry is memory mapped, and only read where it is used
+            logging.info(f"Reading observation file: {obs_file}")
+            obs = EnviFile(obs_file).memmap('bip')
+            solar_azimuth, solar_zenith = obs[:, :, solar_azimuth_band - 1], obs[:, :, solar_zenith_band - 1]
+
+        # The whole GLT index is needed by the untiled ortho path, and the agreement check
+        glt_index = None
+        if (not raw_geometry and tile_size <= 0) or (raw_geometry and agreement_tolerance is not None):
+            logging.info(f"Reading GLT file: {glt_file}")
+            with profiling.stage('glt_index'):
+                glt_index = GltIndex.from_file(glt_file, clouds.shape, cache_dir=glt_cache_dir)
+        glt_set = gdal.Open(glt_file, gdal.GA_ReadOnly)
+
+        loc_ds = EnviFile(loc_file) if loc_file is not None else None
+        with profiling.stage('pixel_size'):
+            if loc_file is not None:
+                pixel_size = scene_pixel_size(loc_file, cache_dir=pixel_size_cache_dir, loc_ds=loc_ds)
+            else:
+                pixel_size = geotransform_pixel_size(glt_set.GetGeoTransform(), glt_set.GetProjection())
+        logging.info(f"Pixel size: {pixel_size} m")
+
+        if raw_geometry:
+            solar = np.stack((solar_azimuth, solar_zenith), axis=-1)
+            out_mask = raw_shade_distance(clouds, solar, loc_ds.memmap('bip'), pixel_size,
+                                          edge_only=edge_only, edge_depth=edge_depth, cloud_height=trace_height,
+                                          return_height=return_height)
+            if agreement_tolerance is not None:
+                with profiling.stage('ortho_reference'):
+                    reference = shade_distance(clouds, solar, glt_index, pixel_size, edge_only=edge_only,
+                                               edge_depth=edge_depth, cloud_height=trace_height)
+                logging.info(f'Agreement with the ortho path within {agreement_tolerance} pixels: %s',
+                             shade_agreement(out_mask[0] if return_height else out_mask, reference,
+                                             agreement_tolerance))
+        elif tile_size > 0:
+            logging.info(f"Run ray trace over GLT tiles of {tile_size} pixels")
+            with profiling.stage('tiled_ray_trace'):
+                out_mask = tiled_shade_distance(clouds, solar_azimuth, solar_zenith, glt_set, pixel_size,
+                                                tile_size=tile_size, edge_only=edge_only, edge_depth=edge_depth,
+                                                angle_bins=angle_bins, cloud_height=trace_height,
+                                                return_height=return_height)
+        else:
+            out_mask = shade_distance(clouds, np.stack((solar_azimuth, solar_zenith), axis=-1), glt_index,
+                                      pixel_size, edge_only=edge_only, edge_depth=edge_depth, angle_bins=angle_bins,
+                                      cloud_height=trace_height, return_height=return_height)
+
+        band_names = None
+        if return_height:
+            out_mask, shade_height = out_mask
+            with profiling.stage('height_bands'):
+                flags, probability = height_shadow_bands(shade_height, cloud_height, height_weight or None)
+                out_mask = np.concatenate((out_mask[np.newaxis], flags, probability[np.newaxis]))
+            band_names = ([f'Shadow distance, {trace_height:g} m clouds'] +
+                          [f'Shadow, {height:g} m clouds' for height in cloud_height] + ['Shadow probability'])
+
+        with profiling.stage('write'):
+            write_shade(output_file, out_mask, band_names)
 
     
 
@@ -0,0 +1,208 @@
+"""
+Masks, cloud shade and DAAC conversion of one scene in a single pass, handing the
+mask planes and shadow distances to the netCDF writer in memory.  The intermediate
+ENVI mask and GeoTIFF shade products are only written on request.
+"""
+
+import argparse
+import logging
+import time
+
+from make_emit_masks import make_masks, MASK_BAND_NAMES, FLAG_BANDS
+from cloud_shade import shade_distance, write_shade, SHADOW_CLOUD_HEIGHT, SHADE_STAGE_VERSION
+from glt_index import GltIndex
+from scene_geometry import geotransform_pixel_size
+from scene_files import describe_scene
+from stage_cache import StageCache
+from output_conversion import write_mask_netcdf, DAAC_STAGE_VERSION
+import profiling
+
+
+# Mask band whose clouds cast the shadows - the SpecTf-Cloud Flag
+SHADE_CLOUD_BAND = 9
+
+
+def run_pipeline(rdnfile, locfile, obsfile, atmfile, cloudfile, gltfile, irrfile, ncfile, version,
+                 software_delivery_version, mask_outfile=None, shade_outfile=None, shade=True,
+                 shade_cloud_band=SHADE_CLOUD_BAND, solar_azimuth_band=4, solar_zenith_band=5, wavelengths=None,
+                 n_cores=-1, aerosol_threshold=0.5, chunk_lines=256, irradiance_cache=None,
+                 per_line_pixel_size=False, edge_only=False, edge_depth=2, angle_bins=None, glt_cache_dir=None,
+                 netcdf_options=None, stage_cache_dir=None, pixel_size_cache_dir=None):
+    """ Run the mask, cloud shade and DAAC conversion stages of a scene without intermediate files
+
+    :param rdnfile: radiance ENVI file
+    :param locfile: EMIT L1B location data ENVI file
+    :param obsfile: observation ENVI file
+    :param atmfile: atmospheric state (subset labels) ENVI file
+    :param cloudfile: SpecTf-Cloud probability file
+    :param gltfile: EMIT L1B glt ENVI file
+    :param irrfile: solar irradiance text file
+    :param ncfile: output netCDF file
+    :param version: 3 digit (with leading V) version number
+    :param software_delivery_version: the extended build number at delivery time
+    :param mask_outfile: optional intermediate ENVI mask product
+    :param shade_outfile: optional intermediate GeoTIFF cloud shade product
+    :param shade: run the cloud shade stage
+    :param shade_cloud_band: mask band, one of FLAG_BANDS, whose clouds cast shadows
+    :param solar_azimuth_band: 1-based obs band of the solar azimuth
+    :param solar_zenith_band: 1-based obs band of the solar zenith
+    :param wavelengths: optional wavelength file, otherwise the radiance header is used
+    :param n_cores: number of mask worker threads; -1 to use all available cores
+    :param aerosol_threshold: AOD550 above which the aggregate flag is set
+    :param chunk_lines: number of downtrack lines read and processed at a time
+    :param irradiance_cache: optional directory caching the resampled irradiance
+    :param per_line_pixel_size: use the downtrack pixel size of each line for the cloud buffers
+    :param edge_only: only cast shadow rays from the antisolar-facing cloud edges
+    :param edge_depth: depth, in pixels, of the cloud edges used with edge_only
+    :param angle_bins: optional (azimuth, zenith) bin widths, in degrees, to share one shadow ray per bin
+    :param glt_cache_dir: optional directory caching the GLT index maps
+    :param netcdf_options: optional chunking and compression keyword arguments of write_mask_netcdf
+    :param stage_cache_dir: optional directory caching the stage results of this scene; on a rerun, only
+                            the stages whose inputs or parameters changed are recomputed
+    :param pixel_size_cache_dir: optional directory caching the LOC-derived pixel size of the masks
+
+    :return: dictionary of wall time in s per stage
+    """
+    if shade_cloud_band not in FLAG_BANDS:
+        raise ValueError(f'Shade cloud band must be one of the flag bands {FLAG_BANDS}')
+    timing = {}
+    netcdf_options = netcdf_options or {}
+    # The software version is part of every stage key, so an upgrade recomputes all stages
+    stage_cache = StageCache(stage_cache_dir, software_version=software_delivery_version) \
+        if stage_cache_dir is not None else None
+
+    start = time.perf_counter()
+    # Each ENVI header is parsed, and each data file mapped, once for all stages
+    with profiling.stage('make_masks'):
+        scene = describe_scene(rdnfile, locfile, obsfile, atmfile)
+        masks, _ = make_masks(rdnfile, locfile, obsfile, atmfile, cloudfile, irrfile, mask_outfile,
+                              wavelengths=wavelengths, n_cores=n_cores, aerosol_threshold=aerosol_threshold,
+                              chunk_lines=chunk_lines, irradiance_cache=irradiance_cache,
+                              per_line_pixel_size=per_line_pixel_size, keep_masks=True, scene=scene,
+                              stage_cache=stage_cache, pixel_size_cache_dir=pixel_size_cache_dir)
+    timing['masks'] = time.perf_counter() - start
+
+    shadow = None
+    if shade:
+        start = time.perf_counter()
+        with profiling.stage('cloud_shade'):
+            cached = None
+            if stage_cache is not None:
+                # The SpecTf-Cloud Flag only depends on the threshold tests for bad data
+                upstream = ['reflectance_flags', 'spectf_buffer'] if shade_cloud_band == 9 else ['masks']
+                stage_cache.key('cloud_shade', SHADE_STAGE_VERSION, upstream=upstream, files=[obsfile, gltfile],
+                                params={'pixel_size': 'glt_geotransform',
+                                        'shade_cloud_band': shade_cloud_band, 'solar_azimuth_band': solar_azimuth_band,
+                                        'solar_zenith_band': solar_zenith_band, 'edge_only': edge_only,
+                                        'edge_depth': edge_depth, 'angle_bins': angle_bins,
+                                        'shadow_cloud_height': SHADOW_CLOUD_HEIGHT})
+                cached = stage_cache.load('cloud_shade')
+            if cached is not None:
+                shadow = cached['distance']
+            else:
+                solar = scene['obs'].memmap('bip')[..., [solar_azimuth_band - 1, solar_zenith_band - 1]]
+                glt_index = GltIndex.from_file(gltfile, masks.flags.shape, cache_dir=glt_cache_dir)
+                # Rays are traced on the orthorectified grid, so its spacing is used, as in cloud_shade
+                pixel_size = geotransform_pixel_size(glt_index.geotransform, glt_index.projection)
+                shadow = shade_distance(masks.flag(shade_cloud_band), solar, glt_index, pixel_size,
+                                        edge_only=edge_only, edge_depth=edge_depth, angle_bins=angle_bins)
+                if stage_cache is not None:
+                    stage_cache.save('cloud_shade', distance=shadow)
+            if shade_outfile is not None:
+                write_shade(shade_outfile, shadow)
+        timing['shade'] = time.perf_counter() - start
+
+    start = time.perf_counter()
+    with profiling.stage('daac'):
+        if stage_cache is not None:
+            stage_cache.key('daac', DAAC_STAGE_VERSION, upstream=['masks'] + (['cloud_shade'] if shade else []),
+                            files=[rdnfile, locfile, gltfile],
+                            params={'ncfile': ncfile, 'version': version,
+                                    'software_delivery_version': software_delivery_version,
+                                    **{k: v for k, v in netcdf_options.items() if k != 'n_workers'}})
+        if stage_cache is not None and stage_cache.is_current('daac', [ncfile]):
+            logging.info(f'{ncfile} is up to date')
+        else:
+            # The mask header carries the radiance metadata, so the radiance supplies the global attributes
+            write_mask_netcdf(ncfile, masks, MASK_BAND_NAMES, rdnfile, locfile, gltfile, version,
+                              software_delivery_version, shade=shadow, **netcdf_options)
+            if stage_cache is not None:
+                stage_cache.record('daac', outputs=[ncfile])
+    timing['daac'] = time.perf_counter() - start
+    return timing
+
+
+def main(input_args=None):
+    parser = argparse.ArgumentParser(description="Masks, cloud shade and DAAC conversion of a scene in one pass")
+    parser.add_argument('rdnfile', type=str, metavar='RADIANCE')
+    parser.add_argument('locfile', type=str, metavar='LOCATIONS')
+    parser.add_argument('obsfile', type=str, metavar='OBSERVATIONS')
+    parser.add_argument('atmfile', type=str, metavar='SUBSET_LABELS')
+    parser.add_argument('cloudfile', type=str, metavar='SPECTF_CLOUD_PROB')
+    parser.add_argument('gltfile', type=str, metavar='GLT')
+    parser.add_argument('irrfile', type=str, metavar='SOLAR_IRRADIANCE')
+    parser.add_argument('ncfile', type=str, metavar='OUTPUT_NETCDF')
+    parser.add_argument('version', type=str, help="3 digit (with leading V) version number")
+    parser.add_argument('software_delivery_version', type=str, help="The extended build number at delivery time")
+    parser.add_argument('--mask_outfile', type=str, default=None, help='Also write the ENVI mask product')
+    parser.add_argument('--shade_outfile', type=str, default=None, help='Also write the GeoTIFF cloud shade product')
+    parser.add_argument('--no_shade', action='store_true', help='Skip the cloud shade stage')
+    parser.add_argument('--shade_cloud_band', type=int, default=SHADE_CLOUD_BAND,
+                        help='Mask band whose clouds cast shadows')
+    parser.add_argument('--solar_azimuth_band', type=int, default=4)
+    parser.add_argument('--solar_zenith_band', type=int, default=5)
+    parser.add_argument('--wavelengths', type=str, default=None)
+    parser.add_argument('--n_cores', type=int, default=-1,
+                        help='Number of worker threads, -1 to use all available cores')
+    parser.add_argument('--aerosol_threshold', type=float, default=0.5)
+    parser.add_argument('--chunk_lines', type=int, default=256)
+    parser.add_argument('--irradiance_cache', type=str, default=None)
+    parser.add_argument('--per_line_pixel_size', action='store_true')
+    parser.add_argument('--pixel_size_cache_dir', type=str, default=None)
+    parser.add_argument('--edge_only', action='store_true')
+    parser.add_argument('--edge_depth', type=int, default=2)
+    parser.add_argument('--angle_bins', type=float, nargs=2, default=None, metavar=('AZIMUTH', 'ZENITH'),
+                        help='Solar angle bin widths, in degrees, to share one shadow ray per bin')
+    parser.add_argument('--glt_cache_dir', type=str, default=None)
+    parser.add_argument('--nc_chunk_lines', type=int, default=32)
+    parser.add_argument('--nc_complevel', type=int, default=9)
+    parser.add_argument('--nc_shuffle', action='store_true')
+    parser.add_argument('--nc_quantize_digits', type=int, default=None)
+    parser.add_argument('--nc_workers', type=int, default=1)
+    parser.add_argument('--stage_cache_dir', type=str, default=None,
+                        help='Directory caching stage results of this scene, so reruns only recompute changed stages')
+    parser.add_argument('--profile_file', type=str, default=None,
+                        help='JSON file with the wall time, CPU time, peak memory and I/O of each stage')
+    parser.add_argument('--profile_hotspots', action='store_true',
+                        help='With --profile_file, also capture cProfile statistics and traced allocations')
+    parser.add_argument('--log_file', type=str, default=None)
+    parser.add_argument('--log_level', type=str, default='INFO')
+    args = parser.parse_args(input_args)
+
+    if args.log_file is None:
+        logging.basicConfig(format='%(message)s', level=args.log_level)
+    else:
+        logging.basicConfig(format='%(asctime)s %(levelname)s: %(message)s', level=args.log_level,
+                            filename=args.log_file)
+
+    with profiling.profiled('fused_pipeline', args.profile_file, args.profile_hotspots, vars(args)):
+        timing = run_pipeline(args.rdnfile, args.locfile, args.obsfile, args.atmfile, args.cloudfile, args.gltfile,
+                              args.irrfile, args.ncfile, args.version, args.software_delivery_version,
+                              mask_outfile=args.mask_outfile, shade_outfile=args.shade_outfile,
+                              shade=not args.no_shade,
+                              shade_cloud_band=args.shade_cloud_band, solar_azimuth_band=args.solar_azimuth_band,
+                              solar_zenith_band=args.solar_zenith_band, wavelengths=args.wavelengths,
+                              n_cores=args.n_cores, aerosol_threshold=args.aerosol_threshold,
+                              chunk_lines=args.chunk_lines, irradiance_cache=args.irradiance_cache,
+                              per_line_pixel_size=args.per_line_pixel_size, edge_only=args.edge_only,
+                              edge_depth=args.edge_depth, angle_bins=args.angle_bins,
+                              glt_cache_dir=args.glt_cache_dir,
+                              netcdf_options={'chunk_lines': args.nc_chunk_lines, 'complevel': args.nc_complevel,
+                                              'shuffle': args.nc_shuffle, 'quantize_digits': args.nc_quantize_digits,
+                                              'n_workers': args.nc_workers},
+                              stage_cache_dir=args.stage_cache_dir, pixel_size_cache_dir=args.pixel_size_cache_dir)
+    logging.info('Stage times: ' + ', '.join(f'{k} {v:.1f} s' for k, v in timing.items()))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,197 @@
+"""
+Reusable geographic lookup table (GLT) index maps, for moving images between raw
+(downtrack, crosstrack) and orthorectified geometry.
+"""
+
+import hashlib
+import logging
+import os
+
+import numpy as np
+from osgeo import gdal
+from scipy.ndimage import distance_transform_edt
+
+
+def fill_nearest(img_dat, holes=None):
+    """Fill holes with the value of the nearest valid pixel
+
+    Nearest pixels come from a single Euclidean distance transform of the holes, so this
+    runs in linear time and only the holes are written.  Equidistant candidates may be
+    resolved differently than a KD-tree search would.
+
+    Args:
+        img_dat (array like): (rows, cols) or (rows, cols, bands) image
+        holes (array, bool, optional): (rows, cols) pixels to fill. Defaults to pixels that are NaN in all bands.
+
+    Returns:
+        array like: img_dat, filled in place
+    """
+    if holes is None:
+        holes = np.isnan(img_dat)
+        if img_dat.ndim > 2:
+            holes = np.all(holes, axis=tuple(range(2, img_dat.ndim)))
+    if not np.any(holes) or np.all(holes):
+        return img_dat
+
+    nearest = distance_transform_edt(holes, return_distances=False, return_indices=True)
+    img_dat[holes] = img_dat[nearest[0][holes], nearest[1][holes]]
+    return img_dat
+
+
+def _output_dtype(img_dtype, nodata_value, dtype):
+    """Output dtype for a projection - the input dtype, unless it cannot hold a NaN nodata value"""
+    if dtype is not None:
+        return np.dtype(dtype)
+    if np.issubdtype(img_dtype, np.floating) or not np.isnan(nodata_value):
+        return np.dtype(img_dtype)
+    return np.dtype(np.float64)
+
+
+def glt_raw_flat(glt, raw_shape, glt_nodata_value=0):
+    """Raw pixels referenced by a GLT, or a window of one
+
+    Args:
+        glt (array like): glt - (rows, cols, 2), 1-based indexing into the raw image (x, y)
+        raw_shape (tuple): (rows, cols) of the raw image
+        glt_nodata_value (int, optional): Value from glt to ignore. Defaults to 0.
+
+    Returns:
+        tuple: (rows, cols) boolean array of the valid GLT pixels, and the flat raw index of each
+            valid GLT pixel, in row-major order
+    """
+    valid_glt = np.all(glt != glt_nodata_value, axis=-1)
+    # account for 1-based indexing, with negative indices counting back from the end as in numpy indexing
+    raw_y = glt[..., 1][valid_glt].astype(np.int64) - 1
+    raw_x = glt[..., 0][valid_glt].astype(np.int64) - 1
+    raw_y[raw_y < 0] += raw_shape[0]
+    raw_x[raw_x < 0] += raw_shape[1]
+    return valid_glt, np.ravel_multi_index((raw_y, raw_x), raw_shape[:2])
+
+
+class GltIndex:
+    """Flat index maps between raw and orthorectified pixels, built once per GLT.
+
+    Attributes:
+        ortho_shape (tuple): (rows, cols) of the orthorectified grid.
+        raw_shape (tuple): (rows, cols) of the raw image.
+        ortho_flat (array, int32): flat ortho index of each valid GLT pixel.
+        raw_flat (array, int32): flat raw index of each valid GLT pixel, 1-based offset removed.
+        inverse (array, int32): flat ortho index for each raw pixel, -1 where no GLT pixel points to it.
+            Where several ortho pixels point to the same raw pixel, the last one in row-major
+            order is used.
+        geotransform (tuple): GDAL geotransform of the orthorectified grid, if built from a file.
+        projection (str): projection WKT of the orthorectified grid, if built from a file.
+    """
+
+    def __init__(self, ortho_shape, raw_shape, ortho_flat, raw_flat, inverse, geotransform=None, projection=None):
+        self.ortho_shape = tuple(int(v) for v in ortho_shape)
+        self.raw_shape = tuple(int(v) for v in raw_shape)
+        self.ortho_flat = ortho_flat
+        self.raw_flat = raw_flat
+        self.inverse = inverse
+        self.geotransform = geotransform
+        self.projection = projection
+
+    @classmethod
+    def from_glt(cls, glt, raw_shape, glt_nodata_value=0):
+        """Build the index maps from a GLT array
+
+        Args:
+            glt (array like): glt - (rows, cols, 2), 1-based indexing into the raw image (x, y)
+            raw_shape (tuple): (rows, cols) of the raw image
+            glt_nodata_value (int, optional): Value from glt to ignore. Defaults to 0.
+
+        Returns:
+            GltIndex: index maps
+        """
+        valid_glt, raw_flat = glt_raw_flat(glt, raw_shape, glt_nodata_value)
+        ortho_flat = np.flatnonzero(valid_glt).astype(np.int32)
+        raw_flat = raw_flat.astype(np.int32)
+
+        inverse = np.full(int(np.prod(raw_shape[:2])), -1, dtype=np.int32)
+        inverse[raw_flat] = ortho_flat
+        return cls(glt.shape[:2], raw_shape[:2], ortho_flat, raw_flat, inverse)
+
+    @classmethod
+    def from_file(cls, glt_file, raw_shape, glt_nodata_value=0, cache_dir=None):
+        """Build the index maps from a 2 band GLT file, optionally through an on-disk cache
+
+        Args:
+            glt_file (str): path to the GLT file
+            raw_shape (tuple): (rows, cols) of the raw image
+            glt_nodata_value (int, optional): Value from glt to ignore. Defaults to 0.
+            cache_dir (str, optional): Directory to cache the index maps in, keyed by the GLT
+                path and modification time. Defaults to None (no cache).
+
+        Returns:
+            GltIndex: index maps
+        """
+        cache_file = None
+        if cache_dir is not None:
+            stat = os.stat(glt_file)
+            key = f'{os.path.abspath(glt_file)}:{stat.st_mtime_ns}:{stat.st_size}:{glt_nodata_value}:{tuple(raw_shape[:2])}'
+            cache_file = os.path.join(cache_dir, f'glt_index_{hashlib.sha1(key.encode()).hexdigest()}.npz')
+            if os.path.isfile(cache_file):
+                logging.debug(f'Loading GLT index from cache: {cache_file}')
+                with np.load(cache_file) as cached:
+                    return cls(tuple(cached['ortho_shape']), tuple(cached['raw_shape']), cached['ortho_flat'],
+                               cached['raw_flat'], cached['inverse'], tuple(cached['geotransform']),
+                               str(cached['projection']))
+
+        glt_set = gdal.Open(glt_file, gdal.GA_ReadOnly)
+        glt = np.moveaxis(glt_set.ReadAsArray(), 0, -1)
+        index = cls.from_glt(glt, raw_shape, glt_nodata_value)
+        index.geotransform = glt_set.GetGeoTransform()
+        index.projection = glt_set.GetProjection()
+
+        if cache_file is not None:
+            os.makedirs(cache_dir, exist_ok=True)
+            tmp_file = f'{cache_file}.{os.getpid()}.tmp.npz'
+            np.savez(tmp_file, ortho_shape=index.ortho_shape, raw_shape=index.raw_shape, ortho_flat=index.ortho_flat,
+                     raw_flat=index.raw_flat, inverse=index.inverse, geotransform=index.geotransform,
+                     projection=index.projection)
+            os.replace(tmp_file, cache_file)
+            logging.debug(f'Wrote GLT index cache: {cache_file}')
+        return index
+
+    def ortho(self, img_dat, nodata_value=np.nan, dtype=None):
+        """Orthorectify an image with any number of bands
+
+        Args:
+            img_dat (array like): raw input image, (rows, cols) or (rows, cols, bands)
+            nodata_value (optional): Value for pixels outside the GLT. Defaults to NaN.
+            dtype (optional): Output dtype. Defaults to the input dtype, or float64 when that
+                cannot hold a NaN nodata_value.
+
+        Returns:
+            array like: orthorectified version of img_dat
+        """
+        band_shape = img_dat.shape[2:]
+        outdat = np.full((self.ortho_shape[0] * self.ortho_shape[1],) + band_shape, nodata_value,
+                         dtype=_output_dtype(img_dat.dtype, nodata_value, dtype))
+        outdat[self.ortho_flat] = np.take(img_dat.reshape((-1,) + band_shape), self.raw_flat, axis=0)
+        return outdat.reshape(self.ortho_shape + band_shape)
+
+    def unortho(self, img_dat, nodata_value=np.nan, dtype=None, interpolate=False):
+        """Unorthorectify an image with any number of bands
+
+        Args:
+            img_dat (array like): orthorectified input image, (rows, cols) or (rows, cols, bands)
+            nodata_value (optional): Value for raw pixels without a GLT entry. Defaults to NaN.
+            dtype (optional): Output dtype. Defaults to the input dtype, or float64 when that
+                cannot hold a NaN nodata_value.
+            interpolate (bool, optional): Fill raw pixels without a GLT entry from their nearest neighbour. Defaults to False.
+
+        Returns:
+            array like: unorthorectified version of img_dat
+        """
+        band_shape = img_dat.shape[2:]
+        outdat = np.full((self.raw_shape[0] * self.raw_shape[1],) + band_shape, nodata_value,
+                         dtype=_output_dtype(img_dat.dtype, nodata_value, dtype))
+        mapped = self.inverse >= 0
+        outdat[mapped] = np.take(img_dat.reshape((-1,) + band_shape), self.inverse[mapped], axis=0)
+        outdat = outdat.reshape(self.raw_shape + band_shape)
+
+        if interpolate:
+            outdat = fill_nearest(outdat, np.logical_not(mapped).reshape(self.raw_shape))
+        return outdat
@@ -0,0 +1,149 @@
+"""
+Solar irradiance loading and resampling, with an optional on-disk cache so that
+batches of scenes on the same wavelength grid skip parsing and resampling.
+
+To pre-warm the cache for a wavelength grid:
+    python irradiance.py data/kurudz_0.1nm.dat CACHE_DIR --rdnfile RADIANCE
+"""
+
+import argparse
+import hashlib
+import logging
+import os
+
+import numpy as np
+from spectral.io import envi
+from isofit.core.common import resample_spectrum
+from emit_utils.file_checks import envi_header
+
+
+# Resampled irradiance already computed in this process, for long-running batch jobs
+_resampled = {}
+
+
+def read_wavelengths(hdr, wavelength_file=None):
+    """ Wavelengths and fwhm, from a wavelength file or the radiance header
+
+    :param hdr: radiance ENVI header dictionary
+    :param wavelength_file: optional text file with columns (channel, wavelength, fwhm)
+
+    :return: tuple of (wl, fwhm) arrays, with wavelengths in nm
+    """
+    if wavelength_file is not None:
+        c, wl, fwhm = np.loadtxt(wavelength_file).T
+    else:
+        if 'wavelength' not in hdr:
+            raise IndexError('Could not find wavelength data anywhere')
+        else:
+            wl = np.array([float(f) for f in hdr['wavelength']])
+        if 'fwhm' not in hdr:
+            raise IndexError('Could not find fwhm data anywhere')
+        else:
+            fwhm = np.array([float(f) for f in hdr['fwhm']])
+
+    # convert from microns to nm
+    if not any(wl > 100):
+        wl = wl*1000.0
+
+    return wl, fwhm
+
+
+def _file_key(path):
+    """ Cache key component identifying a file by path, modification time and size """
+    stat = os.stat(path)
+    return f'{os.path.abspath(path)}:{stat.st_mtime_ns}:{stat.st_size}'
+
+
+def _save(cache_file, data):
+    """ Write an array to the cache atomically, so concurrent jobs never read a partial file """
+    os.makedirs(os.path.dirname(cache_file), exist_ok=True)
+    tmp_file = f'{cache_file}.{os.getpid()}.tmp.npy'
+    np.save(tmp_file, data)
+    os.replace(tmp_file, cache_file)
+
+
+def load_irradiance(irrfile, cache_dir=None):
+    """ Load the solar irradiance spectrum, through a binary copy in the cache when available
+
+    :param irrfile: text file with columns (wavelength nm, irradiance)
+    :param cache_dir: optional cache directory
+
+    :return: tuple of (irr_wl, irr) arrays, with irradiance in uW cm-2 sr-1 nm-1
+    """
+    cache_file = None
+    if cache_dir is not None:
+        key = hashlib.sha1(_file_key(irrfile).encode()).hexdigest()
+        cache_file = os.path.join(cache_dir, f'irradiance_{key}.npy')
+
+    if cache_file is not None and os.path.isfile(cache_file):
+        spectrum = np.load(cache_file)
+    else:
+        spectrum = np.loadtxt(irrfile, comments='#').T
+        if cache_file is not None:
+            _save(cache_file, spectrum)
+
+    irr_wl, irr = spectrum
+    irr = irr / 10  # convert to uW cm-2 sr-1 nm-1
+    return irr_wl, irr
+
+
+def resampled_irradiance(irrfile, wl, fwhm, cache_dir=None):
+    """ Solar irradiance resampled to an instrument wavelength grid.  Results are kept in memory
+    for the life of the process and, with a cache directory, stored on disk keyed by a hash of the
+    irradiance file and the (wl, fwhm) grid, so repeated calls only memory map it.
+
+    :param irrfile: text file with columns (wavelength nm, irradiance)
+    :param wl: instrument wavelengths, nm
+    :param fwhm: instrument fwhm, nm
+    :param cache_dir: optional cache directory
+
+    :return: float32 irradiance, uW cm-2 sr-1 nm-1, one value per band
+    """
+    key = hashlib.sha1(_file_key(irrfile).encode())
+    key.update(np.asarray(wl, dtype=np.float64).tobytes())
+    key.update(np.asarray(fwhm, dtype=np.float64).tobytes())
+    key = key.hexdigest()
+    if key in _resampled:
+        return _resampled[key]
+
+    cache_file = None
+    if cache_dir is not None:
+        cache_file = os.path.join(cache_dir, f'irradiance_resampled_{key}.npy')
+        if os.path.isfile(cache_file):
+            logging.debug(f'Using cached irradiance {cache_file}')
+            _resampled[key] = np.load(cache_file, mmap_mode='r')
+            return _resampled[key]
+
+    irr_wl, irr = load_irradiance(irrfile, cache_dir)
+    irr_resamp = resample_spectrum(irr, irr_wl, wl, fwhm)
+    irr_resamp = np.array(irr_resamp, dtype=np.float32)
+
+    if cache_file is not None:
+        _save(cache_file, irr_resamp)
+    irr_resamp.flags.writeable = False
+    _resampled[key] = irr_resamp
+    return irr_resamp
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Pre-warm the resampled solar irradiance cache")
+    parser.add_argument('irrfile', type=str, metavar='SOLAR_IRRADIANCE')
+    parser.add_argument('cache_dir', type=str, metavar='CACHE_DIR')
+    parser.add_argument('--rdnfile', type=str, nargs='+', default=[],
+                        help='Radiance files whose header wavelength grids should be cached')
+    parser.add_argument('--wavelengths', type=str, nargs='+', default=[],
+                        help='Wavelength files (channel, wavelength, fwhm) whose grids should be cached')
+    args = parser.parse_args()
+
+    logging.basicConfig(format='%(message)s', level='INFO')
+
+    load_irradiance(args.irrfile, args.cache_dir)
+    grids = [read_wavelengths(envi.read_envi_header(envi_header(f))) for f in args.rdnfile]
+    grids += [read_wavelengths({}, f) for f in args.wavelengths]
+    for wl, fwhm in grids:
+        resampled_irradiance(args.irrfile, wl, fwhm, args.cache_dir)
+    logging.info(f'Cached irradiance for {len(grids)} wavelength grid(s) in {args.cache_dir}')
+
+
+if __name__ == "__main__":
+    main()
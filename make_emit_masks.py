@@ -6,213 +6,760 @@ Authors: David R. Thompson, david.r.thompson@jpl.nasa.gov,
 """
 
 import argparse
+import contextlib
+import os
+import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 from osgeo import gdal
 import numpy as np
 from spectral.io import envi
 from scipy.ndimage.morphology import distance_transform_edt
-from isofit.core.common import resample_spectrum
 from emit_utils.file_checks import envi_header
+from scene_geometry import haversine_distance, scene_pixel_size
+from irradiance import read_wavelengths, resampled_irradiance
+from scene_files import describe_scene
+from stage_cache import StageCache
+import profiling
 
 
-def haversine_distance(lon1, lat1, lon2, lat2, radius=6335439):
-    """ Approximate the great circle distance using Haversine formula
+# Wavelengths (nm) of the bands used by the threshold tests, in the order
+# expected by threshold_flags
+THRESHOLD_WAVELENGTHS = [450, 762, 780, 1000, 1250, 1380, 1650]
 
-    :param lon1: point one longitude
-    :param lat1: point one latitude
-    :param lon2: point two longitude
-    :param lat2: point two latitude
-    :param radius: radius to use (default is approximate radius at equator)
+# To-do - ideally get this threshold from spectf repository
+SPECTF_THRESHOLD = 0.51
 
-    :return: great circle distance in radius units
+MAX_CLOUD_HEIGHT = 3000.0
+
+# Edge length, in pixels, of the tiles of the bounded-radius buffer distance transforms
+BUFFER_TILE_SIZE = 256
+
+MASK_BAND_NAMES = ['Cloud Flag', 'Cirrus Flag', 'Water Flag',
+                   'Spacecraft Flag', 'Dilated Cloud Flag',
+                   'AOD550', 'H2O (g cm-2)', 'Aggregate Flag',
+                   'SpecTf-Cloud Probability', 'SpecTf-Cloud Flag',
+                   'SpecTf-Buffer Distance']
+
+# Boolean mask bands, in the bit order of the packed flag byte
+FLAG_BANDS = [0, 1, 2, 3, 4, 7, 9]
+
+# Continuous mask bands, held as float32
+CONTINUOUS_BANDS = [5, 6, 8, 10]
+
+# Packed flag bit marking bad data.  Bad pixels carry all bits set in the packed
+# flags, and NODATA_VALUE in every band of the full product.
+NODATA_BIT = 7
+NODATA_FLAGS = 255
+NODATA_VALUE = -9999.0
+
+# Algorithm version of each cached mask stage, part of its stage cache key.  Bump a stage
+# whenever a code change alters its output; the stages downstream of it follow.
+STAGE_VERSIONS = {'reflectance_flags': 1, 'cloud_buffer': 1, 'spectf_buffer': 1, 'masks': 1}
+
+
+def flag_bits(*bands):
+    """ Packed flag byte with the bits of the given mask bands set
+
+    :param bands: mask band indices, from FLAG_BANDS
+
+    :return: uint8 bit mask
     """
-    # convert decimal degrees to radians
-    lon1, lat1, lon2, lat2 = map(np.radians, [lon1, lat1, lon2, lat2])
+    return np.uint8(sum(1 << FLAG_BANDS.index(b) for b in bands))
 
-    # haversine formula
-    delta_lon = lon2 - lon1
-    delta_lat = lat2 - lat1
 
-    d = 2 * radius * np.arcsin(np.sqrt(np.sin(delta_lat/2)**2 + np.cos(lat1)
-                               * np.cos(lat2) * np.sin(delta_lon/2)**2))
+class MaskBlock:
+    """ Compact container for a block of mask lines.  Boolean bands are packed into a
+    single uint8 per pixel, with bit i holding band FLAG_BANDS[i], and continuous bands
+    are held as float32 in BIL order.  The float32 BIL layout of the full product is only
+    built line by line on write.
+    """
 
-    return d
+    def __init__(self, flags, continuous):
+        """
+        :param flags: packed uint8 flags, shape (lines, samples)
+        :param continuous: float32 CONTINUOUS_BANDS, shape (lines, len(CONTINUOUS_BANDS), samples)
+        """
+        self.flags = flags
+        self.continuous = continuous
 
-def main():
+    @property
+    def n_lines(self):
+        return self.flags.shape[0]
 
-    parser = argparse.ArgumentParser(description="Remove glint")
-    parser.add_argument('rdnfile', type=str, metavar='RADIANCE')
-    parser.add_argument('locfile', type=str, metavar='LOCATIONS')
-    parser.add_argument('obsfile', type=str, metavar='OBSERVATIONS')
-    parser.add_argument('atmfile', type=str, metavar='SUBSET_LABELS')
-    parser.add_argument('cloudfile', type=str, metavar='SPECTF_CLOUD_PROB')
-    parser.add_argument('irrfile', type=str, metavar='SOLAR_IRRADIANCE')
-    parser.add_argument('outfile', type=str, metavar='OUTPUT_MASKS')
-    parser.add_argument('--wavelengths', type=str, default=None)
-    parser.add_argument('--n_cores', type=int, default=-1)
-    parser.add_argument('--aerosol_threshold', type=float, default=0.5)
-    args = parser.parse_args()
-
-    rdn_hdr = envi.read_envi_header(envi_header(args.rdnfile))
-    rdn_shp = envi.open(envi_header(args.rdnfile)).open_memmap(interleave='bil').shape
-    atm_hdr = envi.read_envi_header(envi_header(args.atmfile))
-    atm_shp = envi.open(envi_header(args.atmfile)).open_memmap(interleave='bil').shape
-    loc_shp = envi.open(envi_header(args.locfile)).open_memmap(interleave='bil').shape
-
-    cloud_dset = gdal.Open(args.cloudfile)
-
-    # Check file size consistency
-    if loc_shp[0] != rdn_shp[0] or loc_shp[2] != rdn_shp[2]:
-        raise ValueError('LOC and input file dimensions do not match.')
-    if atm_shp[0] != rdn_shp[0] or atm_shp[2] != rdn_shp[2]:
-        raise ValueError('Label and input file dimensions do not match.')
-    if loc_shp[1] != 3:
-        raise ValueError('LOC file should have three bands.')
-    if cloud_dset.RasterYSize != rdn_shp[0] or cloud_dset.RasterXSize != rdn_shp[2]:
-        raise ValueError('Cloud mask and input file dimensions do not match.')
-
-    # Get wavelengths and bands
-    if args.wavelengths is not None:
-        c, wl, fwhm = np.loadtxt(args.wavelengths).T
-    else:
-        if 'wavelength' not in rdn_hdr:
-            raise IndexError('Could not find wavelength data anywhere')
-        else:
-            wl = np.array([float(f) for f in rdn_hdr['wavelength']])
-        if 'fwhm' not in rdn_hdr:
-            raise IndexError('Could not find fwhm data anywhere')
-        else:
-            fwhm = np.array([float(f) for f in rdn_hdr['fwhm']])
+    @property
+    def shape(self):
+        """ Shape of the full mask product, (lines, samples, bands) as from to_bip """
+        return self.flags.shape + (len(MASK_BAND_NAMES),)
 
-    # Find H2O and AOD elements in state vector
-    aod_bands, h2o_band = [], []
-    for i, name in enumerate(atm_hdr['band names']):
-        if 'H2O' in name:
-            h2o_band.append(i)
-        elif 'AER' in name or 'AOT' in name or 'AOD' in name:
-            aod_bands.append(i)
+    def bil_line(self, line):
+        """ Full mask product for one line
 
-    # find pixel size
-    if 'map info' in rdn_hdr.keys():
-        pixel_size = float(rdn_hdr['map info'][5].strip())
+        :param line: line index within the block
+
+        :return: float32 array of shape (len(MASK_BAND_NAMES), samples)
+        """
+        packed = self.flags[line]
+        out = np.empty((len(MASK_BAND_NAMES), packed.shape[0]), dtype=np.float32)
+        for bit, band in enumerate(FLAG_BANDS):
+            out[band] = (packed >> bit) & 1
+        out[CONTINUOUS_BANDS] = self.continuous[line]
+        out[:, packed == NODATA_FLAGS] = NODATA_VALUE
+        return out
+
+    def to_bil(self):
+        """ Full mask product for the block, as float32 (lines, bands, samples) """
+        return np.stack([self.bil_line(_l) for _l in range(self.n_lines)])
+
+    def to_bip(self, start_line=0, stop_line=None):
+        """ Full mask product for a range of lines, as float32 (lines, samples, bands)
+
+        :param start_line: first line within the block
+        :param stop_line: line after the last, within the block; the end of the block if None
+
+        :return: float32 array of shape (lines, samples, len(MASK_BAND_NAMES))
+        """
+        packed = self.flags[start_line:stop_line]
+        out = np.empty(packed.shape + (len(MASK_BAND_NAMES),), dtype=np.float32)
+        for bit, band in enumerate(FLAG_BANDS):
+            out[..., band] = (packed >> bit) & 1
+        out[..., CONTINUOUS_BANDS] = np.moveaxis(self.continuous[start_line:stop_line], 1, -1)
+        out[packed == NODATA_FLAGS] = NODATA_VALUE
+        return out
+
+    def flag(self, band):
+        """ One boolean mask band, False where there is no data
+
+        :param band: index of the band in MASK_BAND_NAMES, one of FLAG_BANDS
+
+        :return: bool array of shape (lines, samples)
+        """
+        bit = FLAG_BANDS.index(band)
+        return np.logical_and((self.flags >> bit) & 1, self.flags != NODATA_FLAGS)
+
+    @classmethod
+    def concatenate(cls, blocks):
+        """ Join consecutive blocks into one
+
+        :param blocks: list of MaskBlock, in line order
+
+        :return: MaskBlock
+        """
+        return cls(np.concatenate([b.flags for b in blocks]), np.concatenate([b.continuous for b in blocks]))
+
+    def write_bil(self, fout):
+        """ Append the full mask product, one float32 BIL line at a time
+
+        :param fout: open binary file
+        """
+        for _l in range(self.n_lines):
+            self.bil_line(_l).tofile(fout)
+
+    def write_compact(self, flag_out, continuous_out):
+        """ Append the compact product - the packed flag byte, and the continuous bands as BIL
+
+        :param flag_out: open binary file for the uint8 flags
+        :param continuous_out: open binary file for the float32 continuous bands
+        """
+        self.flags.tofile(flag_out)
+        self.continuous.tofile(continuous_out)
+
+
+def get_band_indices(wl):
+    """ Find the bands closest to each of the threshold wavelengths
+
+    :param wl: wavelengths of the radiance file, in nm
+
+    :return: list of band indices, ordered as THRESHOLD_WAVELENGTHS
+    """
+    return [int(np.argmin(abs(wl - w))) for w in THRESHOLD_WAVELENGTHS]
+
+
+def block_ranges(n_lines, chunk_lines):
+    """ Split a scene into blocks of downtrack lines
+
+    :param n_lines: number of downtrack lines in the scene
+    :param chunk_lines: number of lines per block
+
+    :return: list of (start_line, stop_line) tuples
+    """
+    chunk_lines = max(int(chunk_lines), 1)
+    return [(_l, min(_l + chunk_lines, n_lines)) for _l in range(0, n_lines, chunk_lines)]
+
+
+def read_bil_block(bil_memmap, start_line, stop_line, bands=None):
+    """ Read a block of downtrack lines from a BIL memmap, touching only the requested bands
+
+    :param bil_memmap: memmap with shape (lines, bands, samples)
+    :param start_line: first line of the block
+    :param stop_line: last line of the block (exclusive)
+    :param bands: list of band indices to read; all bands if None
+
+    :return: float32 array with shape (lines, samples, bands)
+    """
+    if bands is None:
+        block = bil_memmap[start_line:stop_line, ...]
     else:
-        loc_memmap = envi.open(envi_header(args.locfile)).open_memmap(interleave='bip')
-        center_y = int(loc_shp[0]/2)
-        center_x = int(loc_shp[2]/2)
-        center_pixels = loc_memmap[center_y-1:center_y+1, center_x, :2]
-        pixel_size = haversine_distance(
-            center_pixels[0, 1], center_pixels[0, 0], center_pixels[1, 1], center_pixels[1, 0])
-        del loc_memmap, center_pixels
-
-    # convert from microns to nm
-    if not any(wl > 100):
-        wl = wl*1000.0
+        block = bil_memmap[start_line:stop_line, bands, :]
+    return np.ascontiguousarray(block.transpose((0, 2, 1)), dtype=np.float32)
 
-    # irradiance
-    irr_wl, irr = np.loadtxt(args.irrfile, comments='#').T
-    irr = irr / 10  # convert to uW cm-2 sr-1 nm-1
-    irr_resamp = resample_spectrum(irr, irr_wl, wl, fwhm)
-    irr_resamp = np.array(irr_resamp, dtype=np.float32)
 
-    rdn_dataset = gdal.Open(args.rdnfile, gdal.GA_ReadOnly)
-    maskbands = 11
+class ThresholdScratch:
+    """ Work planes of threshold_flags, allocated once and reused for every block of lines
 
-    # Build output dataset
-    driver = gdal.GetDriverByName('ENVI')
-    driver.Register()
+    :param n_pixels: largest number of pixels in a block
+    :param dtype: dtype of the reflectance planes, that of the radiance and irradiance
+    """
 
-    outDataset = driver.Create(args.outfile, rdn_shp[2], rdn_shp[0], maskbands, gdal.GDT_Float32, options=['INTERLEAVE=BIL'])
-    outDataset.SetProjection(rdn_dataset.GetProjection())
-    outDataset.SetGeoTransform(rdn_dataset.GetGeoTransform())
-    del outDataset
+    def __init__(self, n_pixels, dtype=np.float32):
+        self.cos_zen = np.empty(n_pixels, dtype=dtype)
+        self.rho = np.empty(n_pixels, dtype=dtype)
+        self.rho_780 = np.empty(n_pixels, dtype=dtype)
+        self.test = np.empty(n_pixels, dtype=bool)
 
-    # replace previous build_line_masks
-    b450 = np.argmin(abs(wl-450))
-    b762 = np.argmin(abs(wl-762))
-    b780 = np.argmin(abs(wl-780))
-    b1000 = np.argmin(abs(wl-1000))
-    b1250 = np.argmin(abs(wl-1250))
-    b1380 = np.argmin(abs(wl-1380))
-    b1650 = np.argmin(abs(wl-1650))
+    def planes(self, shape):
+        """ Views of the work planes, shaped as a block """
+        n_pixels = int(np.prod(shape))
+        return tuple(plane[:n_pixels].reshape(shape) for plane in [self.cos_zen, self.rho, self.rho_780, self.test])
 
-    rdn_ds = envi.open(envi_header(args.rdnfile)).open_memmap(interleave='bip')
-    obs_ds = envi.open(envi_header(args.obsfile)).open_memmap(interleave='bip')
-    atm_ds = envi.open(envi_header(args.atmfile)).open_memmap(interleave='bip')
 
-    rdn = rdn_ds.copy().astype(np.float32)
-    atm = atm_ds.copy().astype(np.float32)
-    zen = np.radians(obs_ds[...,4].copy().astype(np.float32))
+def threshold_flags(rdn, rdn_first_band, zen, irr, scratch=None):
+    """ Apply the reflectance threshold tests to a block of lines.  Reflectance is computed one
+    band at a time into reused work planes, and each test is written straight into the flags.
 
-    rho = rdn * np.pi / irr_resamp[np.newaxis, np.newaxis, :] / np.cos(zen)[..., np.newaxis]
+    :param rdn: radiance of the THRESHOLD_WAVELENGTHS bands, shape (lines, samples, 7); any strides
+    :param rdn_first_band: radiance of the first band, used to find bad data, shape (lines, samples)
+    :param zen: solar zenith in radians, shape (lines, samples)
+    :param irr: solar irradiance resampled to the THRESHOLD_WAVELENGTHS bands
+    :param scratch: optional ThresholdScratch of at least the block size, allocated if None
 
-    bad = rdn[..., 0] <= -9990
-    rho[bad, :] = -9999.0
+    :return: packed uint8 flags with the Cloud, Cirrus, Water and Spacecraft bits,
+             and all bits set (NODATA_FLAGS) for bad data
+    """
+    i450, i762, i780, i1000, i1250, i1380, i1650 = range(len(THRESHOLD_WAVELENGTHS))
 
-    # Cloud threshold from Sandford et al.
-    total = np.array(rho[..., b450] > 0.28, dtype=int) + \
-        np.array(rho[..., b1250] > 0.46, dtype=int) + \
-        np.array(rho[..., b1650] > 0.22, dtype=int)
+    shape = rdn_first_band.shape
+    if scratch is None:
+        scratch = ThresholdScratch(int(np.prod(shape)), np.result_type(rdn, irr, zen))
+    cos_zen, rho, rho_780, test = scratch.planes(shape)
+    np.cos(zen, out=cos_zen)
+
+    def _reflectance(band, out):
+        np.multiply(rdn[..., band], np.pi, out=out)
+        np.divide(out, irr[band], out=out)
+        return np.divide(out, cos_zen, out=out)
 
-    maskbands = 11
-    mask = np.zeros((rdn_shp[0], rdn_shp[2], maskbands))
-    mask[..., 0] = total > 2
+    flags = np.empty(shape, dtype=np.uint8)
+    # The Cloud Flag is bit 0, so the boolean tests can be combined in place over the flag bytes
+    cloud = flags.view(bool)
+
+    # Cloud threshold from Sandford et al.
+    np.greater(_reflectance(i450, rho), 0.28, out=cloud)
+    np.logical_and(cloud, np.greater(_reflectance(i1250, rho), 0.46, out=test), out=cloud)
+    np.logical_and(cloud, np.greater(_reflectance(i1650, rho), 0.22, out=test), out=cloud)
 
     # Cirrus Threshold from Gao and Goetz, GRL 20:4, 1993
-    mask[..., 1] = np.array(rho[..., b1380] > 0.1, dtype=int)
+    np.bitwise_or(flags, flag_bits(1), out=flags, where=np.greater(_reflectance(i1380, rho), 0.1, out=test))
 
     # Water threshold as in CORAL
-    mask[..., 2] = np.array(rho[..., b1000] < 0.05, dtype=int)
-
-    # Threshold spacecraft parts using their lack of an O2 A Band
-    mask[..., 3] = np.array(rho[..., b762]/rho[..., b780] > 0.8, dtype=int)
+    np.bitwise_or(flags, flag_bits(2), out=flags, where=np.less(_reflectance(i1000, rho), 0.05, out=test))
+
+    # Threshold spacecraft parts using their lack of an O2 A Band.  The ratio is undefined,
+    # and the test not applied, where the 780 nm reflectance is zero.
+    _reflectance(i780, rho_780)
+    nonzero = np.not_equal(rho_780, 0, out=test)
+    np.divide(_reflectance(i762, rho), rho_780, out=rho, where=nonzero)
+    np.bitwise_or(flags, flag_bits(3), out=flags, where=np.greater(rho, 0.8, out=test, where=nonzero))
+
+    np.copyto(flags, NODATA_FLAGS, where=np.less_equal(rdn_first_band, -9990, out=test))
+    return flags
+
+
+def build_line_masks(flags, zen, atm, tf_prob, cloud_distance, tf_distance,
+                     aod_bands, h2o_band, pixel_size, aerosol_threshold):
+    """ Assemble the output mask bands for a block of lines
+
+    :param flags: packed flags from threshold_flags, with the SpecTf-Cloud Flag bit set
+    :param zen: solar zenith in radians
+    :param atm: atmospheric state, shape (lines, samples, state elements)
+    :param tf_prob: SpecTf-Cloud probability
+    :param cloud_distance: distance to the nearest cloud or cirrus pixel
+    :param tf_distance: distance to the nearest SpecTf-Cloud pixel
+    :param aod_bands: indices of the aerosol elements of the state vector
+    :param h2o_band: indices of the water vapor element of the state vector
+    :param pixel_size: pixel size in m
+    :param aerosol_threshold: AOD550 above which the aggregate flag is set
+
+    :return: MaskBlock
+    """
+    flags = flags.copy()
+    bad = (flags & np.uint8(1 << NODATA_BIT)) > 0
 
-    max_cloud_height = 3000.0
-    cloud_projection_dist = np.tan(zen) * max_cloud_height / pixel_size
+    cloud_projection_dist = cloud_projection_distance(zen, pixel_size)
 
     # AOD 550
-    mask[..., 5] = atm[..., aod_bands].sum(axis=2)
+    aod = atm[..., aod_bands].sum(axis=2)
 
-    mask[..., 6] = atm[..., h2o_band].squeeze()
+    h2o = np.squeeze(atm[..., h2o_band], axis=2)
 
     # Remove water and spacecraft flagsg if cloud flag is on (mostly cosmetic)
-    mask[np.logical_or(mask[...,0] == 1, mask[...,1] ==1), 2:4] = 0
+    flags[(flags & flag_bits(0, 1)) > 0] &= ~flag_bits(2, 3)
 
-    # Create buffer around clouds (main and cirrus)
-    cloudinv = np.logical_not(np.squeeze(np.logical_or(mask[..., 0], mask[...,1])))
-    cloudinv[bad] = 1
-    cloud_distance = distance_transform_edt(cloudinv)
-    invalid = np.squeeze(cloud_projection_dist) >= cloud_distance
-    mask[..., 4] = invalid.copy()
+    # Buffer around clouds (main and cirrus)
+    flags[cloud_projection_dist >= cloud_distance] |= flag_bits(4)
 
     # Combine Cloud, Cirrus, Water, Spacecraft, and Buffer masks
-    mask[..., 7] = np.logical_or(np.sum(mask[...,0:5], axis=-1) > 0, mask[...,5] > args.aerosol_threshold)
+    aggregate = np.logical_or((flags & flag_bits(0, 1, 2, 3, 4)) > 0,
+                              np.asarray(aod, dtype=np.float64) > aerosol_threshold)
+    flags[aggregate] |= flag_bits(7)
 
-    # SpecTF-Cloud probability
-    mask[..., 8] = cloud_dset.ReadAsArray()
+    tf_distance = tf_distance.copy()
+    tf_distance[cloud_projection_dist <= tf_distance] = -1
 
-    # To-do - ideally get this threshold from spectf repository
-    mask[..., 9] = mask[..., 8] > 0.51
+    continuous = np.stack([aod, h2o, tf_prob, tf_distance], axis=1).astype(np.float32)
 
-    tfinv = np.logical_not(mask[..., 9])
-    tfinv[bad] = 1
-    tf_distance = distance_transform_edt(tfinv)
-    tf_distance[cloud_projection_dist <= tf_distance] = -1
-    mask[..., 10] = tf_distance
+    flags[bad] = NODATA_FLAGS
+    continuous.transpose((0, 2, 1))[bad] = NODATA_VALUE
+    return MaskBlock(flags, continuous)
+
+
+def cloud_projection_distance(zen, pixel_size):
+    """ Distance, in pixels, over which a cloud at MAX_CLOUD_HEIGHT can project
+
+    :param zen: solar zenith in radians
+    :param pixel_size: pixel size in m
+
+    :return: projection distance in pixels
+    """
+    return np.tan(zen) * MAX_CLOUD_HEIGHT / pixel_size
+
+
+def buffer_distance(featureless, halo, executor=None, tile_size=BUFFER_TILE_SIZE):
+    """ Euclidean distance to the nearest feature (False) pixel, exact up to a bounded radius.
+    The transform is run on square tiles padded by halo pixels on each side, so distances up
+    to halo are exact, and anything further is only guaranteed to be > halo, which is all the
+    cloud buffers need.  Tiles without a feature within the halo are skipped and set to inf,
+    so mostly clear scenes cost little more than a pass over the mask.
+
+    :param featureless: boolean array, True away from features
+    :param halo: radius, in pixels, within which distances must be exact
+    :param executor: optional concurrent.futures executor to run the tiles on
+    :param tile_size: tile edge length in pixels; raised to twice the halo when smaller
+
+    :return: float64 distance array
+    """
+    n_lines, n_samples = featureless.shape
+    if np.all(featureless):
+        # A scene without any feature keeps the whole-scene transform, and its behavior
+        return distance_transform_edt(featureless)
+
+    tile_size = max(int(tile_size), 2 * int(halo), 1)
+    distance = np.empty(featureless.shape)
+
+    def _tile(start_line, stop_line, start_sample, stop_sample):
+        pad_line, pad_sample = max(start_line - halo, 0), max(start_sample - halo, 0)
+        window = featureless[pad_line:min(stop_line + halo, n_lines), pad_sample:min(stop_sample + halo, n_samples)]
+        if np.all(window):
+            distance[start_line:stop_line, start_sample:stop_sample] = np.inf
+        else:
+            distance[start_line:stop_line, start_sample:stop_sample] = distance_transform_edt(window)[
+                start_line - pad_line:stop_line - pad_line, start_sample - pad_sample:stop_sample - pad_sample]
+
+    tiles = [lines + samples for lines in block_ranges(n_lines, tile_size)
+             for samples in block_ranges(n_samples, tile_size)]
+    if executor is None:
+        for tile in tiles:
+            _tile(*tile)
+    else:
+        # Tiles write disjoint parts of the output
+        list(executor.map(lambda t: _tile(*t), tiles))
+    return distance
+
+
+def _ordered_map(executor, fn, items, lookahead):
+    """ Like executor.map, but with at most lookahead items in flight at any time """
+    pending = deque()
+    for item in items:
+        pending.append(executor.submit(fn, *item))
+        if len(pending) >= lookahead:
+            yield pending.popleft().result()
+    while pending:
+        yield pending.popleft().result()
+
+
+def generate_mask_blocks(rdn_ds, obs_ds, atm_ds, cloud_dset, irr_resamp, band_idx, aod_bands, h2o_band,
+                         pixel_size, aerosol_threshold, chunk_lines, n_cores=1, stage_cache=None):
+    """ Stream the mask product one block of downtrack lines at a time.  Only the threshold
+    bands are read from the radiance, and only the per-pixel flag and distance planes needed
+    by the cloud buffers are held for the whole scene.  With n_cores > 1 the blocks, and
+    haloed tiles of the buffer distance transforms, are run on a thread pool.
+
+    :param rdn_ds: radiance memmap, BIL (lines, bands, samples)
+    :param obs_ds: observation memmap, BIL
+    :param atm_ds: atmospheric state memmap, BIL
+    :param cloud_dset: gdal dataset of the SpecTf-Cloud probability
+    :param irr_resamp: solar irradiance resampled to the radiance wavelengths
+    :param band_idx: threshold band indices, from get_band_indices
+    :param aod_bands: indices of the aerosol elements of the state vector
+    :param h2o_band: indices of the water vapor element of the state vector
+    :param pixel_size: pixel size in m, either a scalar or one value per line
+    :param aerosol_threshold: AOD550 above which the aggregate flag is set
+    :param chunk_lines: number of downtrack lines per block
+    :param n_cores: number of worker threads; -1 to use all available cores
+    :param stage_cache: optional stage_cache.StageCache, keyed for the 'reflectance_flags', 'cloud_buffer'
+                        and 'spectf_buffer' stages, to reuse and store their results
+
+    :return: generator of (start_line, stop_line, MaskBlock) tuples
+    """
+    n_lines, n_samples = rdn_ds.shape[0], rdn_ds.shape[2]
+    blocks = block_ranges(n_lines, chunk_lines)
+    if n_cores == -1:
+        n_cores = os.cpu_count()
+
+    # gdal datasets are not safe to read from several threads at once
+    gdal_lock = threading.Lock()
+
+    def _read_tf_prob(start_line, stop_line):
+        with gdal_lock:
+            return cloud_dset.ReadAsArray(0, start_line, n_samples, stop_line - start_line)
+
+    def _pixel_size(start_line, stop_line):
+        if np.ndim(pixel_size) == 0:
+            return pixel_size
+        return np.asarray(pixel_size)[start_line:stop_line, np.newaxis]
+
+    # First pass - per-pixel threshold flags, packed as in MaskBlock
+    flags = np.zeros((n_lines, n_samples), dtype=np.uint8)
+
+    # Threshold work planes, one set per thread
+    local = threading.local()
+    irr_threshold = np.asarray(irr_resamp)[band_idx]
+
+    def _flag_block(start_line, stop_line):
+        if not hasattr(local, 'scratch'):
+            local.scratch = ThresholdScratch(min(max(int(chunk_lines), 1), n_lines) * n_samples,
+                                             np.result_type(np.float32, irr_threshold))
+        # Kept in BIL order, so each band of a line is contiguous for the threshold kernel
+        rdn = np.asarray(rdn_ds[start_line:stop_line, [0] + list(band_idx), :], dtype=np.float32)
+        rdn = rdn.transpose((0, 2, 1))
+        zen = np.radians(read_bil_block(obs_ds, start_line, stop_line, [4])[..., 0])
+        block_flags = threshold_flags(rdn[..., 1:], rdn[..., 0], zen, irr_threshold, local.scratch)
+        flags[start_line:stop_line] = block_flags
+        good = (block_flags & np.uint8(1 << NODATA_BIT)) == 0
+        return np.max(cloud_projection_distance(zen, _pixel_size(start_line, stop_line))[good], initial=0)
+
+    tf_flag = np.zeros((n_lines, n_samples), dtype=bool)
+
+    def _tf_block(start_line, stop_line):
+        tf_prob = np.asarray(_read_tf_prob(start_line, stop_line), dtype=np.float64)
+        tf_flag[start_line:stop_line] = tf_prob > SPECTF_THRESHOLD
+
+    # Second pass - assemble the mask lines
+    def _mask_block(start_line, stop_line):
+        zen = np.radians(read_bil_block(obs_ds, start_line, stop_line, [4])[..., 0])
+        atm = read_bil_block(atm_ds, start_line, stop_line)
+        mask = build_line_masks(flags[start_line:stop_line], zen, atm, _read_tf_prob(start_line, stop_line),
+                                cloud_distance[start_line:stop_line], tf_distance[start_line:stop_line],
+                                aod_bands, h2o_band, _pixel_size(start_line, stop_line), aerosol_threshold)
+        return start_line, stop_line, mask
+
+    def _load(stage):
+        return stage_cache.load(stage) if stage_cache is not None else None
+
+    def _save(stage, **arrays):
+        if stage_cache is not None:
+            stage_cache.save(stage, **arrays)
+
+    executor = ThreadPoolExecutor(max_workers=n_cores) if n_cores > 1 else None
+
+    def _run_blocks(fn):
+        if executor is None:
+            return [fn(*b) for b in blocks]
+        return list(executor.map(lambda b: fn(*b), blocks))
+
+    try:
+        with profiling.stage('reflectance_flags'):
+            reflectance = _load('reflectance_flags')
+            if reflectance is not None:
+                flags[:] = reflectance['flags']
+                max_projection = reflectance['max_projection'][()]
+            else:
+                max_projection = max(_run_blocks(_flag_block), default=0)
+                _save('reflectance_flags', flags=flags, max_projection=max_projection)
+
+        # Buffers are only needed within the largest projection distance, so that bounds the tile halo
+        halo = int(np.ceil(max_projection)) if np.isfinite(max_projection) else max(n_lines, n_samples)
+
+        bad = (flags & np.uint8(1 << NODATA_BIT)) > 0
+
+        # Distance to clouds (main and cirrus)
+        with profiling.stage('cloud_buffer'):
+            cloud_buffer = _load('cloud_buffer')
+            if cloud_buffer is not None:
+                cloud_distance = cloud_buffer['distance']
+            else:
+                cloudinv = (flags & flag_bits(0, 1)) == 0
+                cloudinv[bad] = 1
+                cloud_distance = buffer_distance(cloudinv, halo, executor)
+                del cloudinv
+                _save('cloud_buffer', distance=cloud_distance)
+
+        # SpecTf clouds, and the distance to them
+        with profiling.stage('spectf_buffer'):
+            spectf_buffer = _load('spectf_buffer')
+            if spectf_buffer is not None:
+                tf_flag = spectf_buffer['flag']
+                tf_distance = spectf_buffer['distance']
+            else:
+                _run_blocks(_tf_block)
+                tfinv = np.logical_not(tf_flag)
+                tfinv[bad] = 1
+                tf_distance = buffer_distance(tfinv, halo, executor)
+                del tfinv
+                _save('spectf_buffer', flag=tf_flag, distance=tf_distance)
+        flags[tf_flag] |= flag_bits(9)
+        del bad
+
+        if executor is None:
+            for block in blocks:
+                yield _mask_block(*block)
+        else:
+            yield from _ordered_map(executor, _mask_block, blocks, 2 * n_cores)
+    finally:
+        if executor is not None:
+            executor.shutdown()
 
-    mask[bad, :] = -9999.0
-    mask = mask.transpose((0,2,1))
 
+def continuous_filename(compact_outfile):
+    """ Path of the continuous bands that accompany a compact flag file
+
+    :param compact_outfile: path of the compact (packed flag) output
+
+    :return: path of the float32 continuous band output
+    """
+    base, ext = os.path.splitext(compact_outfile)
+    return f'{base}_continuous{ext}'
+
+
+def mask_header(rdn_hdr, band_names, data_type=None, data_ignore_value=None):
+    """ ENVI header for a mask output, based on the radiance header
+
+    :param rdn_hdr: radiance ENVI header dictionary
+    :param band_names: output band names
+    :param data_type: ENVI data type code; keep the radiance data type if None
+    :param data_ignore_value: optional data ignore value
+
+    :return: header dictionary
+    """
     hdr = rdn_hdr.copy()
-    hdr['bands'] = str(maskbands)
-    hdr['band names'] = ['Cloud Flag', 'Cirrus Flag', 'Water Flag',
-                         'Spacecraft Flag', 'Dilated Cloud Flag',
-                         'AOD550', 'H2O (g cm-2)', 'Aggregate Flag',
-                         'SpecTf-Cloud Probability', 'SpecTf-Cloud Flag',
-                         'SpecTf-Buffer Distance']
+    hdr['bands'] = str(len(band_names))
+    hdr['band names'] = band_names
     hdr['interleave'] = 'bil'
-    del hdr['wavelength']
-    del hdr['fwhm']
-    envi.write_envi_header(envi_header(args.outfile), hdr)
-    mask.astype(dtype=np.float32).tofile(args.outfile)
+    if data_type is not None:
+        hdr['data type'] = str(data_type)
+    if data_ignore_value is not None:
+        hdr['data ignore value'] = str(data_ignore_value)
+    hdr.pop('wavelength', None)
+    hdr.pop('fwhm', None)
+    return hdr
+
+
+def key_stages(stage_cache, rdnfile, obsfile, atmfile, cloudfile, irr_resamp, band_idx, aod_bands, h2o_band,
+               pixel_size, aerosol_threshold):
+    """ Key the mask stages of a run by their algorithm versions, input files and parameters
+
+    :param stage_cache: stage_cache.StageCache of the scene
+    :param rdnfile: radiance ENVI file
+    :param obsfile: observation ENVI file
+    :param atmfile: atmospheric state ENVI file
+    :param cloudfile: SpecTf-Cloud probability file
+    :param irr_resamp: solar irradiance resampled to the radiance wavelengths
+    :param band_idx: threshold band indices, from get_band_indices
+    :param aod_bands: indices of the aerosol elements of the state vector
+    :param h2o_band: indices of the water vapor element of the state vector
+    :param pixel_size: pixel size in m, either a scalar or one value per line
+    :param aerosol_threshold: AOD550 above which the aggregate flag is set
+    """
+    stage_cache.key('reflectance_flags', STAGE_VERSIONS['reflectance_flags'], files=[rdnfile, obsfile],
+                    params={'irradiance': np.asarray(irr_resamp)[band_idx], 'band_idx': band_idx,
+                            'pixel_size': pixel_size, 'max_cloud_height': MAX_CLOUD_HEIGHT})
+    stage_cache.key('cloud_buffer', STAGE_VERSIONS['cloud_buffer'], upstream=['reflectance_flags'])
+    stage_cache.key('spectf_buffer', STAGE_VERSIONS['spectf_buffer'], upstream=['reflectance_flags'],
+                    files=[cloudfile],
+                    params={'spectf_threshold': SPECTF_THRESHOLD})
+    stage_cache.key('masks', STAGE_VERSIONS['masks'], upstream=['reflectance_flags', 'cloud_buffer', 'spectf_buffer'],
+                    files=[atmfile],
+                    params={'aod_bands': aod_bands, 'h2o_band': h2o_band, 'pixel_size': pixel_size,
+                            'aerosol_threshold': aerosol_threshold, 'max_cloud_height': MAX_CLOUD_HEIGHT})
+
+
+def make_masks(rdnfile, locfile, obsfile, atmfile, cloudfile, irrfile, outfile=None, wavelengths=None, n_cores=-1,
+               aerosol_threshold=0.5, chunk_lines=256, irradiance_cache=None, per_line_pixel_size=False,
+               compact_outfile=None, keep_masks=False, scene=None, stage_cache=None, pixel_size_cache_dir=None):
+    """ Build the mask product of a scene, writing it to disk and / or keeping it in memory
+
+    :param rdnfile: radiance ENVI file
+    :param locfile: EMIT L1B location data ENVI file
+    :param obsfile: observation ENVI file
+    :param atmfile: atmospheric state (subset labels) ENVI file
+    :param cloudfile: SpecTf-Cloud probability file
+    :param irrfile: solar irradiance text file
+    :param outfile: full mask product ENVI file; not written if None
+    :param wavelengths: optional wavelength file, otherwise the radiance header is used
+    :param n_cores: number of worker threads; -1 to use all available cores
+    :param aerosol_threshold: AOD550 above which the aggregate flag is set
+    :param chunk_lines: number of downtrack lines read and processed at a time
+    :param irradiance_cache: optional directory caching the resampled irradiance
+    :param per_line_pixel_size: use the downtrack pixel size of each line for the cloud buffers
+    :param compact_outfile: optional compact mask product ENVI file
+    :param keep_masks: return the whole scene as a MaskBlock
+    :param scene: optional descriptors of the ENVI inputs, from scene_files.describe_scene
+    :param stage_cache: optional stage_cache.StageCache of the scene, to reuse the results of stages
+                        whose inputs and parameters are unchanged
+    :param pixel_size_cache_dir: optional directory caching the LOC-derived pixel size
+
+    :return: tuple of (MaskBlock of the scene or None, mask ENVI header dictionary)
+    """
+    with profiling.stage('read_inputs'):
+        if scene is None:
+            scene = describe_scene(rdnfile, locfile, obsfile, atmfile)
+        rdn_hdr = scene['rdn'].header
+        atm_hdr = scene['atm'].header
+        n_lines, n_samples = scene['rdn'].lines, scene['rdn'].samples
+
+        cloud_dset = gdal.Open(cloudfile)
+        if cloud_dset.RasterYSize != n_lines or cloud_dset.RasterXSize != n_samples:
+            raise ValueError('Cloud mask and input file dimensions do not match.')
+
+        # Get wavelengths and bands
+        wl, fwhm = read_wavelengths(rdn_hdr, wavelengths)
+
+        # Find H2O and AOD elements in state vector
+        aod_bands, h2o_band = [], []
+        for i, name in enumerate(atm_hdr['band names']):
+            if 'H2O' in name:
+                h2o_band.append(i)
+            elif 'AER' in name or 'AOT' in name or 'AOD' in name:
+                aod_bands.append(i)
+
+    # find pixel size
+    with profiling.stage('pixel_size'):
+        pixel_size = scene_pixel_size(locfile, rdn_hdr.get('map info'), per_line=per_line_pixel_size,
+                                      cache_dir=pixel_size_cache_dir, loc_ds=scene['loc'])
+
+    # irradiance
+    with profiling.stage('irradiance'):
+        irr_resamp = resampled_irradiance(irrfile, wl, fwhm, irradiance_cache)
+
+    band_idx = get_band_indices(wl)
+
+    rdn_ds = scene['rdn'].memmap('bil')
+    obs_ds = scene['obs'].memmap('bil')
+    atm_ds = scene['atm'].memmap('bil')
+
+    cached_masks = None
+    if stage_cache is not None:
+        key_stages(stage_cache, rdnfile, obsfile, atmfile, cloudfile, irr_resamp, band_idx, aod_bands, h2o_band,
+                   pixel_size, aerosol_threshold)
+        cached_masks = stage_cache.load('masks')
+
+    if cached_masks is not None:
+        scene_masks = MaskBlock(cached_masks['flags'], cached_masks['continuous'])
+        mask_blocks = ((start_line, stop_line, MaskBlock(scene_masks.flags[start_line:stop_line],
+                                                         scene_masks.continuous[start_line:stop_line]))
+                       for start_line, stop_line in block_ranges(n_lines, chunk_lines))
+    else:
+        mask_blocks = generate_mask_blocks(rdn_ds, obs_ds, atm_ds, cloud_dset, irr_resamp, band_idx, aod_bands,
+                                           h2o_band, pixel_size, aerosol_threshold, chunk_lines, n_cores,
+                                           stage_cache)
+    # New masks are streamed to the stage cache a block at a time, as to the output files
+    stored_masks = None
+    if stage_cache is not None and cached_masks is None:
+        stored_masks = stage_cache.create('masks', flags=((n_lines, n_samples), np.uint8),
+                                          continuous=((n_lines, len(CONTINUOUS_BANDS), n_samples), np.float32))
+
+    # Line assembly and writing; the whole-scene stages of generate_mask_blocks nest within
+    blocks = []
+    with profiling.stage('masks'), contextlib.ExitStack() as stack:
+        if outfile is not None:
+            fout = stack.enter_context(open(outfile, 'wb'))
+        if compact_outfile is not None:
+            flag_out = stack.enter_context(open(compact_outfile, 'wb'))
+            continuous_out = stack.enter_context(open(continuous_filename(compact_outfile), 'wb'))
+
+        for start_line, stop_line, mask in mask_blocks:
+            if outfile is not None:
+                mask.write_bil(fout)
+            if compact_outfile is not None:
+                mask.write_compact(flag_out, continuous_out)
+            if stored_masks is not None:
+                stored_masks['flags'][start_line:stop_line] = mask.flags
+                stored_masks['continuous'][start_line:stop_line] = mask.continuous
+            if keep_masks and cached_masks is None:
+                blocks.append(mask)
+
+    if stored_masks is not None:
+        with profiling.stage('save_stage_cache'):
+            stage_cache.commit('masks', stored_masks)
+    if keep_masks and cached_masks is None:
+        scene_masks = MaskBlock.concatenate(blocks)
+
+    hdr = mask_header(rdn_hdr, MASK_BAND_NAMES)
+    if outfile is not None:
+        envi.write_envi_header(envi_header(outfile), hdr)
+
+    if compact_outfile is not None:
+        compact_hdr = mask_header(rdn_hdr, ['Mask Flags'], data_type=1, data_ignore_value=NODATA_FLAGS)
+        compact_hdr['flag bits'] = [MASK_BAND_NAMES[b] for b in FLAG_BANDS] + ['No Data']
+        envi.write_envi_header(envi_header(compact_outfile), compact_hdr)
+        envi.write_envi_header(envi_header(continuous_filename(compact_outfile)),
+                               mask_header(rdn_hdr, [MASK_BAND_NAMES[b] for b in CONTINUOUS_BANDS],
+                                           data_ignore_value=NODATA_VALUE))
+
+    return (scene_masks if keep_masks else None), hdr
+
+
+def main(input_args=None):
+
+    parser = argparse.ArgumentParser(description="Remove glint")
+    parser.add_argument('rdnfile', type=str, metavar='RADIANCE')
+    parser.add_argument('locfile', type=str, metavar='LOCATIONS')
+    parser.add_argument('obsfile', type=str, metavar='OBSERVATIONS')
+    parser.add_argument('atmfile', type=str, metavar='SUBSET_LABELS')
+    parser.add_argument('cloudfile', type=str, metavar='SPECTF_CLOUD_PROB')
+    parser.add_argument('irrfile', type=str, metavar='SOLAR_IRRADIANCE')
+    parser.add_argument('outfile', type=str, metavar='OUTPUT_MASKS')
+    parser.add_argument('--wavelengths', type=str, default=None)
+    parser.add_argument('--n_cores', type=int, default=-1,
+                        help='Number of worker threads, -1 to use all available cores')
+    parser.add_argument('--aerosol_threshold', type=float, default=0.5)
+    parser.add_argument('--chunk_lines', type=int, default=256,
+                        help='Number of downtrack lines read and processed at a time')
+    parser.add_argument('--irradiance_cache', type=str, default=None,
+                        help='Directory caching the parsed and resampled solar irradiance (see irradiance.py)')
+    parser.add_argument('--per_line_pixel_size', action='store_true',
+                        help='Use the downtrack pixel size of each line, rather than the scene center, for the cloud buffers')
+    parser.add_argument('--pixel_size_cache_dir', type=str, default=None,
+                        help='Directory caching the pixel size derived from the LOC file, for repeated runs over a scene')
+    parser.add_argument('--compact_outfile', type=str, default=None,
+                        help='Optional compact product: packed uint8 flags, with the float32 continuous bands '
+                             'written alongside as <name>_continuous')
+    parser.add_argument('--stage_cache_dir', type=str, default=None,
+                        help='Directory caching the intermediate results of this scene, so reruns only recompute '
+                             'the stages whose inputs or parameters changed')
+    parser.add_argument('--profile_file', type=str, default=None,
+                        help='JSON file with the wall time, CPU time, peak memory and I/O of each stage')
+    parser.add_argument('--profile_hotspots', action='store_true',
+                        help='With --profile_file, also capture cProfile statistics and traced allocations')
+    args = parser.parse_args(input_args)
+
+    with profiling.profiled('make_emit_masks', args.profile_file, args.profile_hotspots, vars(args)):
+        make_masks(args.rdnfile, args.locfile, args.obsfile, args.atmfile, args.cloudfile, args.irrfile,
+                   args.outfile, wavelengths=args.wavelengths, n_cores=args.n_cores,
+                   aerosol_threshold=args.aerosol_threshold, chunk_lines=args.chunk_lines,
+                   irradiance_cache=args.irradiance_cache, per_line_pixel_size=args.per_line_pixel_size,
+                   compact_outfile=args.compact_outfile, pixel_size_cache_dir=args.pixel_size_cache_dir,
+                   stage_cache=StageCache(args.stage_cache_dir) if args.stage_cache_dir is not None else None)
 
 
 if __name__ == "__main__":
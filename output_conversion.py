@@ -6,71 +6,308 @@ Authors: Philip G. Brodrick, philip.brodrick@jpl.nasa.gov
 
 import argparse
 from netCDF4 import Dataset
-from emit_utils.daac_converter import add_variable, makeDims, makeGlobalAttr, add_loc, add_glt
-from emit_utils.file_checks import netcdf_ext, envi_header
+from emit_utils.daac_converter import add_variable, makeGlobalAttr, add_loc, add_glt
+from emit_utils.file_checks import envi_header
 from spectral.io import envi
+from osgeo import gdal
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+import importlib.util
 import logging
+import os
+import zlib
 import numpy as np
+import profiling
 
 
-def main():
-    parser = argparse.ArgumentParser(formatter_class=argparse.RawTextHelpFormatter, description='''This script \
-    converts L2AMaskTf PGE output to DAAC compatable formats, with supporting metadata''', add_help=True)
+MASK_FILL_VALUE = -9999
 
-    parser.add_argument('mask_output_filename', type=str, help="Output Mask netcdf filename")
-    parser.add_argument('mask_file', type=str, help="EMIT L2A cloud mask ENVI file")
-    parser.add_argument('loc_file', type=str, help="EMIT L1B location data ENVI file")
-    parser.add_argument('glt_file', type=str, help="EMIT L1B glt ENVI file")
-    parser.add_argument('version', type=str, help="3 digit (with leading V) version number")
-    parser.add_argument('software_delivery_version', type=str, help="The extended build number at delivery time")
-    parser.add_argument('--ummg_file', type=str, help="Output UMMG filename")
-    parser.add_argument('--log_file', type=str, default=None, help="Logging file to write to")
-    parser.add_argument('--log_level', type=str, default="INFO", help="Logging level")
-    args = parser.parse_args()
+# Version of the netCDF product layout, part of its stage cache key in fused_pipeline.
+# Bump it whenever a code change alters the written file.
+DAAC_STAGE_VERSION = 1
 
-    if args.log_file is None:
-        logging.basicConfig(format='%(message)s', level=args.log_level)
+
+def make_dims(nc_ds, n_lines, n_samples, n_bands, glt_file):
+    """ Create the netCDF dimensions from the mask shape, rather than from an ENVI mask file
+
+    :param nc_ds: open netCDF4 Dataset
+    :param n_lines: number of downtrack lines
+    :param n_samples: number of crosstrack samples
+    :param n_bands: number of mask bands
+    :param glt_file: EMIT L1B glt ENVI file, for the orthorectified dimensions
+    """
+    glt_hdr = envi.read_envi_header(envi_header(glt_file))
+    nc_ds.createDimension('downtrack', int(n_lines))
+    nc_ds.createDimension('crosstrack', int(n_samples))
+    nc_ds.createDimension('bands', int(n_bands))
+    nc_ds.createDimension('ortho_y', int(glt_hdr['lines']))
+    nc_ds.createDimension('ortho_x', int(glt_hdr['samples']))
+    nc_ds.sync()
+
+
+def continuous_bands(band_names):
+    """ Indices of the mask bands holding continuous values rather than flags """
+    return [i for i, name in enumerate(band_names) if 'flag' not in name.lower()]
+
+
+def quantize(values, digits, nodata_value=MASK_FILL_VALUE):
+    """ Round values in place to a power of two multiple, keeping at least the given number of
+    decimal digits, as netCDF4 does for least_significant_digit.  The zeroed trailing mantissa
+    bits compress far better.  Nodata values are left untouched.
+
+    :param values: float array, modified in place
+    :param digits: number of decimal digits to keep
+    :param nodata_value: value to leave as is
+    """
+    scale = 2.0 ** np.ceil(np.log2(10.0 ** digits))
+    valid = values != nodata_value
+    values[valid] = np.around(values[valid] * scale) / scale
+
+
+def mask_slab(mask, start_line, stop_line, quantize_digits=None, quantize_bands=None):
+    """ One block of downtrack lines of the mask product, ready to write
+
+    :param mask: (downtrack, crosstrack, bands) array or memmap, or a MaskBlock from make_emit_masks
+    :param start_line: first line
+    :param stop_line: line after the last
+    :param quantize_digits: optional decimal digits kept in the quantized bands
+    :param quantize_bands: band indices to quantize
+
+    :return: float32 array, (lines, crosstrack, bands)
+    """
+    if hasattr(mask, 'to_bip'):
+        slab = mask.to_bip(start_line, stop_line)
     else:
-        logging.basicConfig(format='%(asctime)s %(levelname)s: %(message)s', level=args.log_level, filename=args.log_file)
+        slab = np.array(mask[start_line:stop_line], dtype=np.float32)
+    if quantize_digits is not None and quantize_bands:
+        values = slab[..., quantize_bands]
+        quantize(values, quantize_digits)
+        slab[..., quantize_bands] = values
+    return slab
+
+
+def _compress_chunk(slab, chunk_shape, dtype, complevel, shuffle):
+    """ Encode one chunk as the HDF5 filter pipeline would - shuffle, then deflate """
+    chunk = np.full(chunk_shape, MASK_FILL_VALUE, dtype=dtype)
+    chunk[:slab.shape[0]] = slab
+    data = chunk.tobytes()
+    if shuffle:
+        data = np.frombuffer(data, dtype=np.uint8).reshape(-1, dtype.itemsize).T.tobytes()
+    if complevel > 0:
+        data = zlib.compress(data, complevel)
+    return data
+
+
+def write_chunks_parallel(output_filename, var_name, get_slab, n_lines, chunk_lines, n_workers):
+    """ Write a variable created by netCDF4, but not yet written, one compressed chunk at a time.
+    HDF5 compresses on a single thread, so chunks are compressed on a thread pool here and
+    written directly with h5py, bypassing the filter pipeline.  The chunks are encoded with the
+    filters the variable was created with, as read back from the file.  At most 2 * n_workers
+    chunks are read and compressed ahead of the writer, to bound memory on long scenes.
+
+    :param output_filename: closed netCDF file
+    :param var_name: variable name, chunked along the first dimension only
+    :param get_slab: function of (start_line, stop_line) returning the variable data
+    :param n_lines: length of the first dimension
+    :param chunk_lines: chunk length along the first dimension
+    :param n_workers: number of compression threads
+    """
+    import h5py
+
+    with h5py.File(output_filename, 'r+') as h5_ds:
+        dset = h5_ds[var_name]
+        chunk_shape = dset.chunks
+        if chunk_shape[0] != chunk_lines or tuple(chunk_shape[1:]) != dset.shape[1:]:
+            raise ValueError(f'{var_name} must be chunked as whole line slabs for direct chunk writes')
+        # netCDF4 only adds the shuffle filter along with deflate, so the encoding must follow the file
+        if dset.compression not in (None, 'gzip') or dset.fletcher32 or dset.scaleoffset is not None:
+            raise ValueError(f'{var_name} uses filters other than shuffle and deflate, which cannot be written directly')
+        complevel = dset.compression_opts if dset.compression == 'gzip' else 0
+        shuffle = dset.shuffle
+
+        def _compress(start_line):
+            slab = get_slab(start_line, min(start_line + chunk_lines, n_lines))
+            return _compress_chunk(slab, chunk_shape, dset.dtype, complevel, shuffle)
+
+        def _write(start_line, data):
+            dset.id.write_direct_chunk((start_line,) + (0,) * (len(chunk_shape) - 1), data)
 
-    mask_ds = envi.open(envi_header(args.mask_file))
+        pending = deque()
+        with ThreadPoolExecutor(max_workers=n_workers) as executor:
+            for start_line in range(0, n_lines, chunk_lines):
+                pending.append((start_line, executor.submit(_compress, start_line)))
+                if len(pending) >= 2 * n_workers:
+                    start, future = pending.popleft()
+                    _write(start, future.result())
+            while pending:
+                start, future = pending.popleft()
+                _write(start, future.result())
 
+
+def add_mask_variable(nc_ds, mask, band_names, chunk_lines=32, complevel=9, shuffle=False, quantize_digits=None,
+                      n_workers=1):
+    """ Create the chunked mask variable and write it one slab of downtrack lines at a time.  With
+    several workers the chunks are only compressed and written once the dataset is closed, by
+    the returned function.
+
+    :param nc_ds: open netCDF4 Dataset, with the downtrack, crosstrack and bands dimensions
+    :param mask: float32 masks, (downtrack, crosstrack, bands), or a MaskBlock from make_emit_masks
+    :param band_names: mask band names
+    :param chunk_lines: downtrack lines per chunk; chunks span all samples and bands
+    :param complevel: zlib compression level, 0 for no compression
+    :param shuffle: apply the shuffle filter before compression
+    :param quantize_digits: optional decimal digits kept in the continuous bands
+    :param n_workers: number of threads compressing chunks; needs h5py when above 1
+
+    :return: function of the output filename, to call after the dataset is closed
+    """
+    n_lines, n_samples = mask.shape[:2]
+    chunk_lines = max(1, min(int(chunk_lines), n_lines))
+    if shuffle and complevel <= 0:
+        logging.warning('The shuffle filter is only applied with compression, writing the mask unshuffled')
+    mask_var = nc_ds.createVariable('mask', "f4", ("downtrack", "crosstrack", "bands"), zlib=complevel > 0,
+                                    complevel=max(complevel, 1), shuffle=shuffle,
+                                    chunksizes=(chunk_lines, n_samples, len(band_names)), fill_value=MASK_FILL_VALUE)
+    mask_var.long_name = "Masks"
+    mask_var.units = "unitless"
+
+    quantize_bands = continuous_bands(band_names)
+
+    def _get_slab(start_line, stop_line):
+        return mask_slab(mask, start_line, stop_line, quantize_digits, quantize_bands)
+
+    parallel = n_workers > 1 and importlib.util.find_spec('h5py') is not None
+    if n_workers > 1 and not parallel:
+        logging.warning('h5py is not available, compressing the mask on a single thread')
+    if not parallel:
+        for start_line in range(0, n_lines, chunk_lines):
+            stop_line = min(start_line + chunk_lines, n_lines)
+            mask_var[start_line:stop_line] = _get_slab(start_line, stop_line)
+        return lambda output_filename: None
+
+    def _finish(output_filename):
+        logging.debug(f'Compressing mask data on {n_workers} threads')
+        write_chunks_parallel(output_filename, 'mask', _get_slab, n_lines, chunk_lines, n_workers)
+    return _finish
+
+
+def write_mask_netcdf(output_filename, mask, band_names, primary_file, loc_file, glt_file, version,
+                      software_delivery_version, shade=None, chunk_lines=32, complevel=9, shuffle=False,
+                      quantize_digits=None, n_workers=1):
+    """ Write the DAAC mask product from masks in memory or memory mapped
+
+    :param output_filename: output netCDF filename
+    :param mask: float32 masks, (downtrack, crosstrack, bands), or a MaskBlock from make_emit_masks
+    :param band_names: mask band names
+    :param primary_file: ENVI file supplying the global attributes - the mask file, or the radiance it was built from
+    :param loc_file: EMIT L1B location data ENVI file
+    :param glt_file: EMIT L1B glt ENVI file
+    :param version: 3 digit (with leading V) version number
+    :param software_delivery_version: the extended build number at delivery time
+    :param shade: optional cloud shadow distance, (downtrack, crosstrack)
+    :param chunk_lines: downtrack lines per chunk of the mask variable; chunks span all samples and bands
+    :param complevel: zlib compression level, 0 for no compression
+    :param shuffle: apply the shuffle filter before compression
+    :param quantize_digits: optional decimal digits kept in the continuous bands, for lossy but smaller files
+    :param n_workers: number of threads compressing chunks; needs h5py when above 1
+    """
     # Start Mask File
     # make the netCDF4 file
-    logging.info(f'Creating netCDF4 file: {args.mask_output_filename}')
-    nc_ds = Dataset(args.mask_output_filename, 'w', clobber=True, format='NETCDF4')
+    logging.info(f'Creating netCDF4 file: {output_filename}')
+    nc_ds = Dataset(output_filename, 'w', clobber=True, format='NETCDF4')
 
     # make global attributes
     logging.debug('Creating global attributes')
-    makeGlobalAttr(nc_ds, args.mask_file, args.software_delivery_version, glt_envi_file=args.glt_file)
+    makeGlobalAttr(nc_ds, primary_file, software_delivery_version, glt_envi_file=glt_file)
 
     #TODO: UPDATE TITLE AND SUMMARY
-    nc_ds.title = "EMIT L2A Masks 60 m " + args.version   
+    nc_ds.title = "EMIT L2A Masks 60 m " + version
     nc_ds.summary = nc_ds.summary + \
         f"\\n\\nThis file contains masks for L2A estimated clouds and cloud shadow masks and geolocation data. \
 Geolocation data (latitude, longitude, height) and a lookup table to project the data are also included."
     nc_ds.sync()
 
     logging.debug('Creating dimensions')
-    makeDims(nc_ds, args.mask_file, args.glt_file)
+    n_lines, n_samples = mask.shape[:2]
+    make_dims(nc_ds, n_lines, n_samples, len(band_names), glt_file)
 
     logging.debug('Creating and writing mask metadata')
     add_variable(nc_ds, "sensor_band_parameters/mask_bands", str, "Mask Band Names", None,
-                 mask_ds.metadata['band names'], {"dimensions": ("bands",)}, fill_value = None)
+                 band_names, {"dimensions": ("bands",)}, fill_value = None)
 
     logging.debug('Creating and writing location data')
-    add_loc(nc_ds, args.loc_file)
+    with profiling.stage('location'):
+        add_loc(nc_ds, loc_file)
 
     logging.debug('Creating and writing glt data')
-    add_glt(nc_ds, args.glt_file)
+    with profiling.stage('glt'):
+        add_glt(nc_ds, glt_file)
 
     logging.debug('Write mask data')
-    add_variable(nc_ds, 'mask', "f4", "Masks", "unitless", mask_ds.open_memmap(interleave='bip')[...].copy(),
-                 {"dimensions":("downtrack", "crosstrack", "bands"), "zlib": True, "complevel": 9}, fill_value = -9999)
-    nc_ds.sync()
-    nc_ds.close()
-    del nc_ds
-    logging.debug(f'Successfully created {args.mask_output_filename}')
+    with profiling.stage('mask'):
+        finish_mask = add_mask_variable(nc_ds, mask, band_names, chunk_lines=chunk_lines, complevel=complevel,
+                                        shuffle=shuffle, quantize_digits=quantize_digits, n_workers=n_workers)
+
+    if shade is not None:
+        logging.debug('Write cloud shadow data')
+        with profiling.stage('cloud_shadow'):
+            add_variable(nc_ds, 'cloud_shadow_distance', "f4", "Distance to Shading Cloud", "pixels", shade,
+                         {"dimensions":("downtrack", "crosstrack"), "zlib": True, "complevel": 9}, fill_value = None)
+    with profiling.stage('close'):
+        nc_ds.sync()
+        nc_ds.close()
+        del nc_ds
+
+    with profiling.stage('compress_mask_chunks'):
+        finish_mask(output_filename)
+    logging.debug(f'Successfully created {output_filename}')
+
+
+def main(input_args=None):
+    parser = argparse.ArgumentParser(formatter_class=argparse.RawTextHelpFormatter, description='''This script \
+    converts L2AMaskTf PGE output to DAAC compatable formats, with supporting metadata''', add_help=True)
+
+    parser.add_argument('mask_output_filename', type=str, help="Output Mask netcdf filename")
+    parser.add_argument('mask_file', type=str, help="EMIT L2A cloud mask ENVI file")
+    parser.add_argument('loc_file', type=str, help="EMIT L1B location data ENVI file")
+    parser.add_argument('glt_file', type=str, help="EMIT L1B glt ENVI file")
+    parser.add_argument('version', type=str, help="3 digit (with leading V) version number")
+    parser.add_argument('software_delivery_version', type=str, help="The extended build number at delivery time")
+    parser.add_argument('--ummg_file', type=str, help="Output UMMG filename")
+    parser.add_argument('--shade_file', type=str, default=None, help="Optional cloud shade output, added as cloud_shadow_distance")
+    parser.add_argument('--chunk_lines', type=int, default=32, help="Downtrack lines per chunk of the mask variable")
+    parser.add_argument('--complevel', type=int, default=9, help="zlib compression level, 0 for none")
+    parser.add_argument('--shuffle', action='store_true', help="Apply the shuffle filter before compression")
+    parser.add_argument('--quantize_digits', type=int, default=None,
+                        help="Decimal digits kept in the continuous mask bands (lossy); all bits kept if not set")
+    parser.add_argument('--n_workers', type=int, default=1, help="Number of threads compressing the mask, -1 to use all available cores")
+    parser.add_argument('--profile_file', type=str, default=None,
+                        help="JSON file with the wall time, CPU time, peak memory and I/O of each stage")
+    parser.add_argument('--profile_hotspots', action='store_true',
+                        help="With --profile_file, also capture cProfile statistics and traced allocations")
+    parser.add_argument('--log_file', type=str, default=None, help="Logging file to write to")
+    parser.add_argument('--log_level', type=str, default="INFO", help="Logging level")
+    args = parser.parse_args(input_args)
+
+    if args.log_file is None:
+        logging.basicConfig(format='%(message)s', level=args.log_level)
+    else:
+        logging.basicConfig(format='%(asctime)s %(levelname)s: %(message)s', level=args.log_level, filename=args.log_file)
+
+    with profiling.profiled('output_conversion', args.profile_file, args.profile_hotspots, vars(args)):
+        with profiling.stage('read_inputs'):
+            mask_ds = envi.open(envi_header(args.mask_file))
+            shade = None
+            if args.shade_file is not None:
+                shade = gdal.Open(args.shade_file, gdal.GA_ReadOnly).ReadAsArray()
+
+        n_workers = os.cpu_count() if args.n_workers == -1 else args.n_workers
+        with profiling.stage('write_netcdf'):
+            write_mask_netcdf(args.mask_output_filename, mask_ds.open_memmap(interleave='bip'),
+                              mask_ds.metadata['band names'], args.mask_file, args.loc_file, args.glt_file,
+                              args.version, args.software_delivery_version, shade=shade,
+                              chunk_lines=args.chunk_lines, complevel=args.complevel, shuffle=args.shuffle,
+                              quantize_digits=args.quantize_digits, n_workers=n_workers)
 
     return
 
@@ -0,0 +1,231 @@
+"""
+Per-stage instrumentation of the mask command line tools.  A run is profiled by entering
+profiled(); the named stages it passes through with stage() then record their wall time,
+CPU time, peak resident memory and bytes read and written, and the profile is written as a
+JSON file when the run ends.  Outside of a profiled run, stage() does nothing.
+
+Resident memory and I/O counters come from /proc, so are only available on Linux; elsewhere
+the peak resident memory falls back to the process high-water mark and I/O is not reported.
+"""
+
+import contextlib
+import cProfile
+import io
+import json
+import logging
+import os
+import pstats
+import resource
+import sys
+import threading
+import time
+import tracemalloc
+
+
+# The profile of the current run, if any
+_active = None
+
+
+def _read_proc_io():
+    """ I/O counters of this process: bytes passed through read and write calls, and bytes
+    fetched from or sent to storage, which includes memory mapped reads """
+    try:
+        with open('/proc/self/io', 'r') as fin:
+            counters = dict(line.split(':') for line in fin if ':' in line)
+        return {k: int(counters[k]) for k in ['rchar', 'wchar', 'read_bytes', 'write_bytes']}
+    except (OSError, KeyError, ValueError):
+        return None
+
+
+def _reset_peak_rss():
+    """ Reset the resident memory high-water mark of this process; False if not supported """
+    try:
+        with open('/proc/self/clear_refs', 'w') as fout:
+            fout.write('5')
+        return True
+    except OSError:
+        return False
+
+
+def _peak_rss():
+    """ Resident memory high-water mark of this process, in bytes """
+    try:
+        with open('/proc/self/status', 'r') as fin:
+            for line in fin:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1]) * 1024
+    except (OSError, ValueError, IndexError):
+        pass
+    # ru_maxrss is in kB on Linux, and in bytes on macOS
+    maxrss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return maxrss if sys.platform == 'darwin' else maxrss * 1024
+
+
+class _Stage:
+    """ Counters of one stage, while it runs """
+
+    def __init__(self, name, hotspots, run_start):
+        self.name = name
+        self.run_start = run_start
+        self.hotspots = hotspots
+        self.peak_rss = 0
+        self.peak_traced = 0
+        self.wall = time.perf_counter()
+        self.cpu = time.process_time()
+        self.io = _read_proc_io()
+
+    def result(self):
+        wall = time.perf_counter() - self.wall
+        cpu = time.process_time() - self.cpu
+        record = {'stage': self.name, 'start_s': self.wall - self.run_start, 'wall_s': wall, 'cpu_s': cpu,
+                  'cpu_utilization': cpu / wall if wall > 0 else None,
+                  'peak_rss_mb': self.peak_rss / 1e6}
+        end_io = _read_proc_io()
+        if self.io is not None and end_io is not None:
+            record.update({'bytes_read': end_io['rchar'] - self.io['rchar'],
+                           'bytes_written': end_io['wchar'] - self.io['wchar'],
+                           'storage_bytes_read': end_io['read_bytes'] - self.io['read_bytes'],
+                           'storage_bytes_written': end_io['write_bytes'] - self.io['write_bytes']})
+        if self.hotspots:
+            record['peak_traced_mb'] = self.peak_traced / 1e6
+        return record
+
+
+class Profile:
+    """ Stage records of one run.  Stages may nest; a nested stage is named by its path, as in
+    'masks/cloud_buffer', and the counters of a stage include those of the stages within it.
+    Only stages entered from the thread that started the run are recorded.
+
+    :param command: name of the profiled command
+    :param hotspots: also run cProfile, and trace Python memory allocations with tracemalloc
+    :param top: number of functions listed from cProfile
+    :param arguments: optional dictionary of run arguments, stored with the profile
+    """
+
+    def __init__(self, command, hotspots=False, top=30, arguments=None):
+        self.command = command
+        self.arguments = arguments or {}
+        self.status = 'running'
+        self.hotspots = hotspots
+        self.top = top
+        self.stages = []
+        self._open = []
+        self._thread = threading.get_ident()
+        self._resettable = _reset_peak_rss()
+        self._cprofile = None
+        self._start = None
+        self._run = None
+
+    def _fold_peaks(self):
+        """ Fold the current high-water marks into every open stage, before they are reset """
+        peak_rss = _peak_rss()
+        peak_traced = tracemalloc.get_traced_memory()[1] if self.hotspots else 0
+        for open_stage in self._open:
+            open_stage.peak_rss = max(open_stage.peak_rss, peak_rss)
+            open_stage.peak_traced = max(open_stage.peak_traced, peak_traced)
+
+    def _reset_peaks(self):
+        if self._resettable:
+            _reset_peak_rss()
+        if self.hotspots:
+            tracemalloc.reset_peak()
+
+    @contextlib.contextmanager
+    def stage(self, name):
+        """ Record the counters of a named stage """
+        if threading.get_ident() != self._thread:
+            yield
+            return
+        self._fold_peaks()
+        self._reset_peaks()
+        parent = self._open[-1] if len(self._open) > 0 and self._open[-1] is not self._run else None
+        path = name if parent is None else f'{parent.name}/{name}'
+        self._open.append(_Stage(path, self.hotspots, self._start))
+        try:
+            yield
+        finally:
+            self._fold_peaks()
+            self.stages.append(self._open.pop().result())
+
+    def start(self):
+        if self.hotspots:
+            tracemalloc.start()
+            self._cprofile = cProfile.Profile()
+            self._cprofile.enable()
+        self._start = time.perf_counter()
+        self._run = _Stage('total', self.hotspots, self._start)
+        self._open.append(self._run)
+
+    def stop(self):
+        self._fold_peaks()
+        self._open.remove(self._run)
+        self._run = self._run.result()
+        if self.hotspots:
+            self._cprofile.disable()
+            tracemalloc.stop()
+
+    def report(self):
+        """ The profile as a dictionary """
+        report = {'command': self.command, 'status': self.status, 'arguments': self.arguments,
+                  'pid': os.getpid(), 'cpu_count': os.cpu_count(), 'peak_rss_per_stage': self._resettable,
+                  'total': self._run, 'stages': sorted(self.stages, key=lambda s: s['start_s'])}
+        if self.hotspots:
+            stats = pstats.Stats(self._cprofile, stream=io.StringIO()).sort_stats('cumulative')
+            hot = []
+            for (filename, line, function), (_, n_calls, tottime, cumtime, _) in stats.stats.items():
+                hot.append({'function': f'{os.path.basename(filename)}:{line}({function})', 'calls': n_calls,
+                            'tottime_s': tottime, 'cumtime_s': cumtime})
+            report['hotspots'] = sorted(hot, key=lambda h: h['cumtime_s'], reverse=True)[:self.top]
+        return report
+
+    def write(self, profile_file):
+        """ Write the profile as JSON, along with the cProfile statistics if captured
+
+        :param profile_file: output JSON file; the cProfile statistics go to the same name with .prof
+        """
+        with open(profile_file, 'w') as fout:
+            json.dump(self.report(), fout, indent=2)
+        if self.hotspots:
+            self._cprofile.dump_stats(os.path.splitext(profile_file)[0] + '.prof')
+        logging.info(f'Wrote profile to {profile_file}')
+
+
+@contextlib.contextmanager
+def profiled(command, profile_file=None, hotspots=False, arguments=None):
+    """ Profile the stages of a run, and write the profile when it ends, also on failure.
+    Nothing is recorded if profile_file is None.
+
+    :param command: name of the profiled command
+    :param profile_file: output JSON profile
+    :param hotspots: also capture cProfile statistics and traced Python allocations
+    :param arguments: optional dictionary of run arguments, stored with the profile
+
+    :return: context manager yielding the Profile, or None
+    """
+    global _active
+    if profile_file is None or _active is not None:
+        yield None
+        return
+    profile = Profile(command, hotspots=hotspots, arguments=arguments)
+    _active = profile
+    profile.start()
+    try:
+        yield profile
+        profile.status = 'ok'
+    except BaseException as e:
+        profile.status = f'failed: {type(e).__name__}: {e}'
+        raise
+    finally:
+        _active = None
+        profile.stop()
+        profile.write(profile_file)
+
+
+@contextlib.contextmanager
+def stage(name):
+    """ Record a named stage of the current profiled run, if there is one """
+    if _active is None:
+        yield
+        return
+    with _active.stage(name):
+        yield
@@ -0,0 +1,97 @@
+"""
+Scene file descriptors - each ENVI header is parsed once, the file layout is kept with it,
+and the data is memory mapped at most once, so every stage of a run can share them.
+"""
+
+import os
+
+import numpy as np
+from spectral.io import envi
+from emit_utils.file_checks import envi_header
+
+
+# ENVI data type codes
+ENVI_DTYPES = {1: np.uint8, 2: np.int16, 3: np.int32, 4: np.float32, 5: np.float64,
+               12: np.uint16, 13: np.uint32, 14: np.int64, 15: np.uint64}
+
+# Axis order of each interleave, in terms of (lines, bands, samples)
+INTERLEAVE_AXES = {'bil': (0, 1, 2), 'bip': (0, 2, 1), 'bsq': (1, 0, 2)}
+
+
+class EnviFile:
+    """ An ENVI file, described from a single read of its header
+
+    :param path: path of the ENVI data file
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.header = envi.read_envi_header(envi_header(path))
+        self.lines = int(self.header['lines'])
+        self.samples = int(self.header['samples'])
+        self.bands = int(self.header['bands'])
+        self.interleave = self.header.get('interleave', 'bsq').strip().lower()
+        self.header_offset = int(self.header.get('header offset', 0))
+        byte_order = '>' if int(self.header.get('byte order', 0)) == 1 else '<'
+        self.dtype = np.dtype(ENVI_DTYPES[int(self.header['data type'])]).newbyteorder(byte_order)
+        self._memmap = None
+
+    @property
+    def band_names(self):
+        return self.header.get('band names', [])
+
+    @property
+    def nbytes(self):
+        """ Size of the data, without the header offset """
+        return self.lines * self.samples * self.bands * self.dtype.itemsize
+
+    def memmap(self, interleave='bil'):
+        """ Read-only memory map of the data, mapped once and viewed in any interleave
+
+        :param interleave: 'bil' (lines, bands, samples), 'bip' (lines, samples, bands)
+                           or 'bsq' (bands, lines, samples)
+
+        :return: memmap view
+        """
+        if self._memmap is None:
+            file_shape = tuple(np.array([self.lines, self.bands, self.samples])[list(INTERLEAVE_AXES[self.interleave])])
+            self._memmap = np.memmap(self.path, dtype=self.dtype, mode='r', offset=self.header_offset,
+                                     shape=file_shape)
+        # axes of the requested interleave, in the order they are stored in the file
+        stored = INTERLEAVE_AXES[self.interleave]
+        return self._memmap.transpose([stored.index(a) for a in INTERLEAVE_AXES[interleave]])
+
+    def check_size(self):
+        """ Raise a ValueError if the data file is smaller than its header describes """
+        size = os.stat(self.path).st_size
+        if size < self.header_offset + self.nbytes:
+            raise ValueError(f'{self.path} holds {size} bytes, but its header describes '
+                             f'{self.header_offset + self.nbytes}.')
+
+
+def describe_scene(rdnfile, locfile, obsfile, atmfile):
+    """ Describe and validate the ENVI inputs of a scene
+
+    :param rdnfile: radiance ENVI file
+    :param locfile: EMIT L1B location data ENVI file
+    :param obsfile: observation ENVI file
+    :param atmfile: atmospheric state (subset labels) ENVI file
+
+    :return: dict of EnviFile, keyed 'rdn', 'loc', 'obs' and 'atm'
+    """
+    scene = {'rdn': EnviFile(rdnfile), 'loc': EnviFile(locfile), 'obs': EnviFile(obsfile),
+             'atm': EnviFile(atmfile)}
+    rdn = scene['rdn']
+
+    # Check file size consistency
+    if scene['loc'].lines != rdn.lines or scene['loc'].samples != rdn.samples:
+        raise ValueError('LOC and input file dimensions do not match.')
+    if scene['atm'].lines != rdn.lines or scene['atm'].samples != rdn.samples:
+        raise ValueError('Label and input file dimensions do not match.')
+    if scene['obs'].lines != rdn.lines or scene['obs'].samples != rdn.samples:
+        raise ValueError('OBS and input file dimensions do not match.')
+    if scene['loc'].bands != 3:
+        raise ValueError('LOC file should have three bands.')
+    for ds in scene.values():
+        ds.check_size()
+    return scene
@@ -0,0 +1,160 @@
+"""
+Scene geometry shared by the mask CLIs - pixel sizes from ENVI map info, GDAL
+geotransforms, or the LOC file, optionally cached in a directory of their own.
+"""
+
+import hashlib
+import json
+import logging
+import os
+
+import numpy as np
+from osgeo import osr
+from spectral.io import envi
+from emit_utils.file_checks import envi_header
+
+
+EARTH_RADIUS = 6335439
+
+# Version of the LOC-derived pixel size, part of its cache key
+LOC_PIXEL_SIZE_VERSION = 2
+
+
+def haversine_distance(lon1, lat1, lon2, lat2, radius=EARTH_RADIUS):
+    """ Approximate the great circle distance using Haversine formula
+
+    :param lon1: point one longitude
+    :param lat1: point one latitude
+    :param lon2: point two longitude
+    :param lat2: point two latitude
+    :param radius: radius to use (default is approximate radius at equator)
+
+    :return: great circle distance in radius units
+    """
+    # convert decimal degrees to radians
+    lon1, lat1, lon2, lat2 = map(np.radians, [lon1, lat1, lon2, lat2])
+
+    # haversine formula
+    delta_lon = lon2 - lon1
+    delta_lat = lat2 - lat1
+
+    d = 2 * radius * np.arcsin(np.sqrt(np.sin(delta_lat/2)**2 + np.cos(lat1)
+                               * np.cos(lat2) * np.sin(delta_lon/2)**2))
+
+    return d
+
+
+def map_info_pixel_size(map_info):
+    """ Pixel size from an ENVI 'map info' entry
+
+    :param map_info: list of 'map info' strings
+
+    :return: pixel size in m; degrees of a Geographic Lat/Lon grid are converted along a meridian
+    """
+    pixel_size = float(map_info[5].strip())
+    if map_info[0].strip().lower().startswith('geographic'):
+        pixel_size = float(np.radians(pixel_size) * EARTH_RADIUS)
+    return pixel_size
+
+
+def geotransform_pixel_size(geotransform, projection):
+    """ Pixel size from a GDAL geotransform
+
+    :param geotransform: GDAL geotransform
+    :param projection: projection WKT
+
+    :return: pixel size in m; degrees of a geographic grid are converted along a meridian
+    """
+    pixel_size = abs(float(geotransform[1]))
+    srs = osr.SpatialReference(wkt=projection) if projection else None
+    if srs is not None and srs.IsGeographic():
+        pixel_size = float(np.radians(pixel_size) * EARTH_RADIUS)
+    return pixel_size
+
+
+def loc_pixel_size(loc_file, per_line=False, loc_ds=None):
+    """ Downtrack pixel size from the LOC file, between consecutive lines at the center sample
+
+    :param loc_file: EMIT L1B location data ENVI file (longitude, latitude, elevation)
+    :param per_line: return the spacing of every line rather than only the scene center
+    :param loc_ds: optional scene_files.EnviFile of the LOC file, to reuse its memory map
+
+    :return: pixel size in m, either a scalar or an array with one value per line
+    """
+    if loc_ds is not None:
+        loc_memmap = loc_ds.memmap('bip')
+    else:
+        loc_memmap = envi.open(envi_header(loc_file)).open_memmap(interleave='bip')
+    center_y = int(loc_memmap.shape[0]/2)
+    center_x = int(loc_memmap.shape[1]/2)
+    # LOC band 0 is longitude and band 1 latitude
+    if not per_line:
+        center_pixels = loc_memmap[center_y-1:center_y+1, center_x, :2]
+        return haversine_distance(
+            center_pixels[0, 0], center_pixels[0, 1], center_pixels[1, 0], center_pixels[1, 1])
+
+    center_pixels = np.array(loc_memmap[:, center_x, :2], dtype=np.float64)
+    spacing = haversine_distance(center_pixels[:-1, 0], center_pixels[:-1, 1],
+                                 center_pixels[1:, 0], center_pixels[1:, 1])
+    return np.append(spacing, spacing[-1:])
+
+
+def pixel_size_cache_file(loc_file, cache_dir):
+    """ Path of the pixel size cache of a LOC file, keyed by its path, modification time and size,
+    and LOC_PIXEL_SIZE_VERSION
+
+    :param loc_file: EMIT L1B location data ENVI file
+    :param cache_dir: cache directory
+
+    :return: path of the JSON cache file
+    """
+    stat = os.stat(loc_file)
+    key = f'{os.path.abspath(loc_file)}:{stat.st_mtime_ns}:{stat.st_size}:{LOC_PIXEL_SIZE_VERSION}'
+    return os.path.join(cache_dir, f'pixel_size_{hashlib.sha1(key.encode()).hexdigest()}.json')
+
+
+def scene_pixel_size(loc_file, map_info=None, per_line=False, cache_dir=None, loc_ds=None):
+    """ Pixel size of a scene, from map info when available and otherwise from the LOC file.
+    With a cache directory, LOC-derived values are cached there (see pixel_size_cache_file);
+    nothing is written next to the LOC file.
+
+    :param loc_file: EMIT L1B location data ENVI file
+    :param map_info: optional ENVI 'map info' entry of the scene
+    :param per_line: return one value per line when derived from the LOC file
+    :param cache_dir: optional directory caching the LOC-derived pixel size
+    :param loc_ds: optional scene_files.EnviFile of the LOC file, to reuse its memory map
+
+    :return: pixel size in m, either a scalar or an array with one value per line
+    """
+    if map_info is not None:
+        return map_info_pixel_size(map_info)
+
+    field = 'line_pixel_size' if per_line else 'pixel_size'
+    cache_file = None
+    cached = {}
+    if cache_dir is not None:
+        cache_file = pixel_size_cache_file(loc_file, cache_dir)
+        if os.path.isfile(cache_file):
+            try:
+                with open(cache_file, 'r') as fin:
+                    cached = json.load(fin)
+            except (OSError, ValueError):
+                cached = {}
+            if field in cached:
+                logging.debug(f'Using cached pixel size from {cache_file}')
+                # np.float64, as computed from the LOC file
+                return np.array(cached[field], dtype=np.float64) if per_line else np.float64(cached[field])
+
+    pixel_size = loc_pixel_size(loc_file, per_line, loc_ds)
+
+    if cache_file is not None:
+        cached[field] = pixel_size.tolist() if per_line else float(pixel_size)
+        try:
+            os.makedirs(cache_dir, exist_ok=True)
+            tmp_file = f'{cache_file}.{os.getpid()}.tmp'
+            with open(tmp_file, 'w') as fout:
+                json.dump(cached, fout)
+            os.replace(tmp_file, cache_file)
+        except OSError as e:
+            logging.warning(f'Could not write pixel size cache {cache_file}: {e}')
+    return pixel_size
@@ -0,0 +1,158 @@
+"""
+Per-scene cache of pipeline stage outputs, for incremental reruns.  Each stage is keyed by a
+hash of its algorithm version, the software version, its input files (path, modification time
+and size), its parameters, and the keys of the stages it depends on; a rerun recomputes a stage
+only when that key changes.
+"""
+
+import hashlib
+import json
+import logging
+import os
+import shutil
+import time
+
+import numpy as np
+
+
+# Version of the key and file layout of the cache itself
+STAGE_CACHE_VERSION = 2
+
+def file_key(path):
+    """ Cache key component identifying a file by path, modification time and size """
+    if path is None:
+        return 'None'
+    stat = os.stat(path)
+    return f'{os.path.abspath(path)}:{stat.st_mtime_ns}:{stat.st_size}'
+
+
+def _param_default(value):
+    """ JSON encoding of parameter values that json cannot encode itself """
+    if isinstance(value, np.ndarray):
+        return f'{value.dtype}{value.shape}:{hashlib.sha1(np.ascontiguousarray(value).tobytes()).hexdigest()}'
+    if isinstance(value, np.generic):
+        return value.item()
+    raise TypeError(f'Cannot hash parameter of type {type(value).__name__}')
+
+
+class StageCache:
+    """ Stage outputs of one scene, stored as a directory of .npy files per stage alongside a
+    manifest.json recording the key of each stage, its inputs and parameters, and when it was
+    computed.  Arrays are memory mapped on load, and can be written a block at a time through
+    create and commit, so a stage never needs to be held in memory whole.
+
+    :param cache_dir: directory for the cache of this scene
+    :param software_version: optional version of the software, such as the software delivery version,
+                             added to every key so that an upgrade recomputes all stages
+    """
+
+    def __init__(self, cache_dir, software_version=None):
+        self.cache_dir = cache_dir
+        self.software_version = software_version
+        self.manifest_file = os.path.join(cache_dir, 'manifest.json')
+        self.manifest = {}
+        self.current = {}
+        self.inputs = {}
+        if os.path.isfile(self.manifest_file):
+            try:
+                with open(self.manifest_file, 'r') as fin:
+                    self.manifest = json.load(fin)
+            except (OSError, ValueError):
+                logging.warning(f'Ignoring unreadable stage manifest {self.manifest_file}')
+
+    def key(self, stage, version, upstream=(), files=(), params=None):
+        """ Compute and hold the key of a stage for this run
+
+        :param stage: stage name
+        :param version: algorithm version of the stage, to be bumped by any code change that alters its output
+        :param upstream: names of the stages this one depends on, keyed earlier in the run
+        :param files: input file paths
+        :param params: dictionary of parameter values; numpy arrays are hashed by content
+
+        :return: hex digest key
+        """
+        description = {'cache_version': STAGE_CACHE_VERSION, 'software_version': self.software_version,
+                       'version': version,
+                       'upstream': {s: self.current[s] for s in upstream},
+                       'files': [file_key(f) for f in files],
+                       'params': params or {}}
+        encoded = json.dumps(description, sort_keys=True, default=_param_default)
+        self.current[stage] = hashlib.sha1(f'{stage}:{encoded}'.encode()).hexdigest()
+        self.inputs[stage] = json.loads(encoded)
+        return self.current[stage]
+
+    def _stage_dir(self, stage):
+        return os.path.join(self.cache_dir, stage)
+
+    def _array_files(self, stage, names):
+        return [os.path.join(self._stage_dir(stage), f'{name}.npy') for name in names]
+
+    def is_current(self, stage, outputs=()):
+        """ Whether the recorded run of a stage matches its key for this run, and its outputs exist """
+        record = self.manifest.get(stage)
+        if record is None or record['key'] != self.current.get(stage):
+            return False
+        return all(os.path.isfile(f) for f in list(outputs) + record.get('outputs', []))
+
+    def load(self, stage):
+        """ Arrays of a stage, if cached under its key for this run
+
+        :return: dictionary of read-only memory mapped arrays, or None
+        """
+        names = self.manifest.get(stage, {}).get('arrays')
+        if not names or not self.is_current(stage, self._array_files(stage, names)):
+            return None
+        logging.info(f'Reusing cached stage {stage}')
+        return {name: np.load(f, mmap_mode='r') for name, f in zip(names, self._array_files(stage, names))}
+
+    def create(self, stage, **specs):
+        """ Writable arrays of a stage, memory mapped in a temporary directory until commit
+
+        :param stage: stage name
+        :param specs: (shape, dtype) of each array, by name
+
+        :return: dictionary of memory mapped arrays, to fill and pass to commit
+        """
+        tmp_dir = f'{self._stage_dir(stage)}.{os.getpid()}.tmp'
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+        os.makedirs(tmp_dir)
+        return {name: np.lib.format.open_memmap(os.path.join(tmp_dir, f'{name}.npy'), mode='w+', dtype=dtype,
+                                                shape=shape)
+                for name, (shape, dtype) in specs.items()}
+
+    def commit(self, stage, arrays):
+        """ Store the arrays from create under the key of a stage for this run, replacing any earlier ones """
+        for array in arrays.values():
+            array.flush()
+        tmp_dir = f'{self._stage_dir(stage)}.{os.getpid()}.tmp'
+        stage_dir = self._stage_dir(stage)
+        # Directories cannot be replaced atomically while they hold files, so the old one is moved aside
+        if os.path.isdir(stage_dir):
+            old_dir = f'{stage_dir}.{os.getpid()}.old'
+            os.replace(stage_dir, old_dir)
+            shutil.rmtree(old_dir, ignore_errors=True)
+        os.replace(tmp_dir, stage_dir)
+        self.record(stage, arrays=list(arrays))
+
+    def save(self, stage, **arrays):
+        """ Store the arrays of a stage under its key for this run """
+        stored = self.create(stage, **{name: (np.shape(a), np.asarray(a).dtype) for name, a in arrays.items()})
+        for name, array in arrays.items():
+            stored[name][...] = array
+        self.commit(stage, stored)
+
+    def record(self, stage, outputs=(), arrays=()):
+        """ Record a stage as computed under its key for this run
+
+        :param stage: stage name
+        :param outputs: output files the stage wrote, which must still exist for it to be reused
+        :param arrays: names of the arrays stored for the stage in the cache
+        """
+        self.manifest[stage] = {'key': self.current[stage], 'inputs': self.inputs.get(stage, {}),
+                                'outputs': list(outputs), 'arrays': list(arrays),
+                                'time': time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime())}
+        os.makedirs(self.cache_dir, exist_ok=True)
+        tmp_file = f'{self.manifest_file}.{os.getpid()}.tmp'
+        with open(tmp_file, 'w') as fout:
+            json.dump(self.manifest, fout, indent=2)
+        os.replace(tmp_file, self.manifest_file)
@@ -0,0 +1,68 @@
+import argparse
+import csv
+import sys
+
+import numpy as np
+import pytest
+
+netCDF4 = pytest.importorskip('netCDF4')
+
+import batch_masks
+from benchmarks.synthetic import write_synthetic_scene
+
+
+def batch_args(stages=batch_masks.STAGES, fused=False):
+    return argparse.Namespace(stages=stages, fused=fused, keep_intermediate=False, scene_cores=1, wavelengths=None,
+                              aerosol_threshold=0.5, chunk_lines=16, irradiance_cache=None, glt_cache_dir=None,
+                              pixel_size_cache_dir=None, stage_cache_dir=None, version='V001',
+                              software_delivery_version='test', log_level='WARNING')
+
+
+@pytest.fixture
+def scene(tmp_path):
+    """ Manifest entry of a small synthetic scene, without a binary cloud product to cast shadows from """
+    files = write_synthetic_scene(str(tmp_path / 'scene'), n_lines=60, n_samples=50, n_bands=60, cloud_fraction=0.15,
+                                  seed=3)
+    entry = {'scene_id': 'synthetic', 'maskfile': str(tmp_path / 'mask'), 'shadefile': str(tmp_path / 'shade.tif'),
+             'ncfile': str(tmp_path / 'mask.nc')}
+    entry.update({f: files[f] for f in batch_masks.SCENE_FIELDS if f in files})
+    with open(tmp_path / 'manifest.csv', 'w', newline='') as fout:
+        writer = csv.DictWriter(fout, fieldnames=batch_masks.SCENE_FIELDS)
+        writer.writeheader()
+        writer.writerow(entry)
+    scenes = batch_masks.read_manifest(str(tmp_path / 'manifest.csv'))
+    assert len(scenes) == 1 and not scenes[0].get('shade_cloudfile')
+    return scenes[0], files['irrfile']
+
+
+def read_netcdf(path):
+    with netCDF4.Dataset(path) as nc_ds:
+        return np.array(nc_ds['mask'][:]), np.array(nc_ds['cloud_shadow_distance'][:])
+
+
+def test_fused_matches_stages(scene, tmp_path):
+    scene, irrfile = scene
+    args = batch_args()
+    args.irrfile = irrfile
+    result = batch_masks.process_scene(scene, args)
+    assert result['status'] == 'ok', result.get('error')
+    staged_mask, staged_shade = read_netcdf(scene['ncfile'])
+
+    fused_scene = dict(scene, ncfile=str(tmp_path / 'fused.nc'))
+    args.fused = True
+    result = batch_masks.process_scene(fused_scene, args)
+    assert result['status'] == 'ok', result.get('error')
+    fused_mask, fused_shade = read_netcdf(fused_scene['ncfile'])
+
+    # Shadows are cast from the SpecTf-Cloud probability above the threshold of the SpecTf-Cloud Flag
+    assert np.any(staged_shade > 0)
+    np.testing.assert_array_equal(fused_mask, staged_mask)
+    np.testing.assert_array_equal(fused_shade, staged_shade)
+
+
+def test_fused_needs_masks_and_daac(monkeypatch, tmp_path):
+    monkeypatch.setattr(sys, 'argv', ['batch_masks.py', str(tmp_path / 'manifest.csv'), 'irradiance.txt',
+                                      '--fused', '--stages', 'masks', 'shade'])
+    with pytest.raises(SystemExit) as excinfo:
+        batch_masks.main()
+    assert excinfo.value.code == 2
@@ -0,0 +1,63 @@
+import numpy as np
+import pytest
+
+import bresenham_line
+
+
+def baseline_bresenhamline(start, end, max_iter):
+    """ bresenhamline before the clipping fix, which only clipped the steps along +x """
+    bl_out = bresenham_line._bresenhamlines(start, end, max_iter).reshape(-1, start.shape[-1])
+    return bl_out[bl_out[:, 0] < start[:, 0] + max_iter]
+
+
+# Steps the baseline traced for lengths 2 and 2.5: one short at whole lengths along +x, one long
+# at fractional lengths in any other direction
+@pytest.mark.parametrize('direction, baseline_steps', [((3, 0), (1, 2)), ((3, 3), (1, 2)), ((3, -1), (1, 2)),
+                                                       ((-3, 0), (2, 3)), ((0, 3), (2, 3)), ((0, -3), (2, 3)),
+                                                       ((-3, -1), (2, 3))])
+def test_bresenhamline_rounds_length_down_in_every_direction(direction, baseline_steps):
+    start = np.array([[5, 5]])
+    end = start + np.array([direction])
+    steps = np.arange(1, 4)[:, np.newaxis] * np.array(direction) / np.max(np.abs(direction))
+    pixels = np.rint(start + steps).astype(int)
+
+    for max_iter, n_baseline in zip([2.0, 2.5], baseline_steps):
+        np.testing.assert_array_equal(bresenham_line.bresenhamline(start, end, max_iter), pixels[:2])
+        np.testing.assert_array_equal(baseline_bresenhamline(start, end, max_iter), pixels[:n_baseline])
+
+
+def random_rays(n_rays=200, seed=0):
+    rng = np.random.default_rng(seed)
+    start = rng.integers(0, 50, (n_rays, 2))
+    end = start + rng.integers(-30, 30, (n_rays, 2))
+    lengths = rng.uniform(-2, 40, n_rays)
+    lengths[:3] = [np.inf, np.nan, 0]
+    return start, end, lengths
+
+
+def traced_pixels(start, end, lengths, chunk_size):
+    pixels = set()
+    for ray, records in bresenham_line.trace_rays(start, end, lengths, shape=(50, 40), chunk_size=chunk_size):
+        assert len(ray) <= chunk_size
+        pixels.update(zip(ray.tolist(), map(tuple, records.tolist())))
+    return pixels
+
+
+def test_trace_rays_matches_bresenhamline():
+    start, end, lengths = random_rays()
+    reference = set()
+    for n in np.flatnonzero(np.isfinite(lengths) & (lengths > 0)):
+        line = bresenham_line.bresenhamline(start[n:n + 1], end[n:n + 1], lengths[n])
+        for step, (x, y) in enumerate(line.tolist(), start=1):
+            if 0 <= x < 40 and 0 <= y < 50:
+                reference.add((int(n), (y, x, step)))
+    assert len(reference) > 0
+    assert traced_pixels(start, end, lengths, 2**18) == reference
+
+
+def test_trace_rays_independent_of_chunks():
+    start, end, lengths = random_rays()
+    whole = traced_pixels(start, end, lengths, 2**18)
+    assert len(whole) > 0
+    for chunk_size in [1, 13, 1000]:
+        assert traced_pixels(start, end, lengths, chunk_size) == whole
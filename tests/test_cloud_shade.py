@@ -0,0 +1,210 @@
+import numpy as np
+import pytest
+from osgeo import gdal
+from scipy.ndimage import distance_transform_edt
+
+import bresenham_line
+import cloud_shade
+from glt_index import GltIndex
+from benchmarks.synthetic import synthetic_cloud_field, synthetic_geometry
+
+
+PIXEL_SIZE = 60.0
+
+
+def solar_angles(shape, azimuth, zenith=30.0):
+    """ Solar azimuth varying across track and zenith along track, around the given angles """
+    solar_azimuth = np.broadcast_to(azimuth + np.linspace(-3, 3, shape[1]), shape)
+    solar_zenith = np.broadcast_to(zenith + np.linspace(-5, 5, shape[0])[:, np.newaxis], shape)
+    return solar_azimuth, solar_zenith
+
+
+@pytest.mark.parametrize('azimuth', [10, 100, 150, 200, 250, 330])
+@pytest.mark.parametrize('max_chunk_pixels', [97, 2**18])
+def test_cast_shadows_matches_loop(azimuth, max_chunk_pixels):
+    clouds = synthetic_cloud_field((150, 130), 0.1)
+    solar_azimuth, solar_zenith = solar_angles(clouds.shape, azimuth)
+
+    reference = cloud_shade._cast_shadows_loop(clouds, solar_azimuth, solar_zenith, PIXEL_SIZE)
+    out_mask = cloud_shade.cast_shadows(clouds, solar_azimuth, solar_zenith, PIXEL_SIZE,
+                                        max_chunk_pixels=max_chunk_pixels)
+    assert np.any(reference > 0)
+    # Same pixels; distances from np.hypot rather than np.sqrt may differ in the last bit
+    np.testing.assert_array_equal(out_mask > 0, reference > 0)
+    np.testing.assert_allclose(out_mask, reference, rtol=1e-12)
+
+
+@pytest.mark.parametrize('rotation', [12, -40])
+@pytest.mark.parametrize('azimuth', [10, 60, 100, 150, 200, 250, 300, 330])
+def test_raw_geometry_agrees_with_ortho(rotation, azimuth):
+    shape = (150, 130)
+    loc, glt, _ = synthetic_geometry(*shape, pixel_size=PIXEL_SIZE, rotation=rotation)
+    glt_index = GltIndex.from_glt(glt.transpose((0, 2, 1)), shape)
+    clouds = synthetic_cloud_field(shape, 0.1)
+    solar = np.stack([np.full(shape, float(azimuth)), np.full(shape, 30.0)], axis=-1)
+
+    reference = cloud_shade.shade_distance(clouds, solar, glt_index, PIXEL_SIZE)
+    raw = cloud_shade.raw_shade_distance(clouds, solar, loc.transpose((0, 2, 1)), PIXEL_SIZE)
+    # Measured IoU 0.86 to 0.96 and distance agreement 0.90 to 0.97; rays 10 degrees off give an IoU below 0.55
+    agreement = cloud_shade.shade_agreement(raw, reference, tolerance=1.5)
+    assert agreement['shadow_iou'] > 0.85
+    assert agreement['distance_agreement'] > 0.88
+
+
+def test_loc_jacobian():
+    theta = np.radians(30.0)
+    loc, _, _ = synthetic_geometry(20, 15, pixel_size=PIXEL_SIZE, rotation=30.0, lon=179.995)
+    loc = loc.transpose((0, 2, 1))
+    # Across the antimeridian
+    loc[..., 0] = (loc[..., 0] + 180) % 360 - 180
+    assert np.any(loc[..., 0] < 0) and np.any(loc[..., 0] > 0)
+
+    lines, samples = np.meshgrid(np.arange(20), np.arange(15), indexing='ij')
+    jacobian = cloud_shade.loc_jacobian(loc, lines.ravel(), samples.ravel())
+    # East and north per sample step, then per line step, of the rotated grid; first-order at the edges
+    expected = PIXEL_SIZE * np.array([[np.cos(theta), -np.sin(theta)], [-np.sin(theta), -np.cos(theta)]])
+    np.testing.assert_allclose(jacobian, np.broadcast_to(expected, jacobian.shape), rtol=2e-3, atol=0.05)
+
+
+def test_shade_agreement():
+    reference = np.array([[0, 2, 3, 4, 0, 0]], dtype=np.float32)
+    shade = np.array([[0, 2.5, 6, 0, 1, 0]], dtype=np.float32)
+    agreement = cloud_shade.shade_agreement(shade, reference, tolerance=1.0)
+    # Shaded in either: 4 pixels, in both: 2, of which 1 within the tolerance
+    assert agreement == {'shadow_iou': 0.5, 'distance_agreement': 0.5, 'agreement': 0.25}
+    assert cloud_shade.shade_agreement(np.zeros((2, 2)), np.zeros((2, 2))) == \
+        {'shadow_iou': 1.0, 'distance_agreement': 1.0, 'agreement': 1.0}
+
+
+def baseline_loop(clouds, solar_azimuth, solar_zenith, pixel_size):
+    """ _cast_shadows_loop before the clipping fix: bresenhamline clipped along +x only, negative pixels
+    indexed from the far edge, and the last row and column were never shaded """
+    bounds = (0, 0, clouds.shape[1] - 1, clouds.shape[0] - 1)
+    clouds_loc = np.where(clouds)
+    edge_x, edge_y, antisolar_s = cloud_shade.edge_coords_from_target(
+        clouds_loc[1], clouds_loc[0], cloud_shade.cwn_to_math(solar_azimuth[clouds] - 180), bounds)
+    num_x_pixels = cloud_shade.distance_of_ray(solar_zenith[clouds], antisolar_s, pixel_size)
+    out_mask = np.full(clouds.shape, 1e6)
+    for _l in range(len(clouds_loc[0])):
+        start = np.array([[clouds_loc[1][_l], clouds_loc[0][_l]]])
+        linepx = bresenham_line._bresenhamlines(start, np.array([[edge_x[_l], edge_y[_l]]]), num_x_pixels[_l])[0]
+        linepx = linepx[linepx[:, 0] < start[0, 0] + num_x_pixels[_l]]
+        linepx = linepx[(linepx[:, 0] < bounds[2]) & (linepx[:, 1] < bounds[3])]
+        px_dist = np.sqrt((linepx[:, 0] - start[0, 0])**2 + (linepx[:, 1] - start[0, 1])**2)
+        out_mask[linepx[:, 1], linepx[:, 0]] = np.minimum(px_dist, out_mask[linepx[:, 1], linepx[:, 0]])
+    out_mask[out_mask == 1e6] = 0
+    out_mask[clouds_loc[0], clouds_loc[1]] = 0
+    return out_mask
+
+
+# One cloud pixel of a 10 x 10 image, its solar azimuth, and the shaded pixels and their distances after
+# and before the clipping fix, with rays 5.5 pixels long along x
+CLIPPING_CASES = [
+    # Up to the last column, and the last row
+    ((5, 6), 270, {(5, 7): 1, (5, 8): 2, (5, 9): 3}, {(5, 7): 1, (5, 8): 2}),
+    ((6, 6), 315, {(7, 7): 2**0.5, (8, 8): 8**0.5, (9, 9): 18**0.5}, {(7, 7): 2**0.5, (8, 8): 8**0.5}),
+    # Out of the first column or row, once wrapped to the far edge
+    ((5, 2), 90, {(5, 1): 1, (5, 0): 2}, {(5, 1): 1, (5, 0): 2, (5, 9): 3, (5, 8): 4, (5, 7): 5, (5, 6): 6}),
+    ((2, 2), 135, {(1, 1): 2**0.5, (0, 0): 8**0.5}, {(1, 1): 2**0.5, (0, 0): 8**0.5, (9, 9): 18**0.5,
+                                                     (8, 8): 32**0.5}),
+    # Ray tips: 3.9 diagonal steps towards -x, and 0.95 steps along y
+    ((8, 8), 135, {(7, 7): 2**0.5, (6, 6): 8**0.5, (5, 5): 18**0.5},
+     {(7, 7): 2**0.5, (6, 6): 8**0.5, (5, 5): 18**0.5, (4, 4): 32**0.5}),
+    ((1, 5), 10, {}, {(2, 5): 1}),
+]
+
+
+@pytest.mark.parametrize('cloud, azimuth, shaded, baseline_shaded', CLIPPING_CASES)
+def test_loop_clipping_at_ray_tips_and_image_edges(cloud, azimuth, shaded, baseline_shaded):
+    clouds = np.zeros((10, 10), dtype=bool)
+    clouds[cloud] = True
+    solar_azimuth, solar_zenith = np.full(clouds.shape, float(azimuth)), np.zeros(clouds.shape)
+    pixel_size = cloud_shade.SHADOW_CLOUD_HEIGHT / 5.5
+
+    def _shaded(out_mask):
+        return {tuple(int(i) for i in px): float(out_mask[tuple(px)]) for px in np.argwhere(out_mask > 0)}
+
+    assert _shaded(cloud_shade._cast_shadows_loop(clouds, solar_azimuth, solar_zenith, pixel_size)) == \
+        pytest.approx(shaded)
+    assert _shaded(baseline_loop(clouds, solar_azimuth, solar_zenith, pixel_size)) == pytest.approx(baseline_shaded)
+
+
+def write_glt(glt):
+    """ In-memory 2 band GLT dataset, from a (rows, 2, cols) array """
+    glt_set = gdal.GetDriverByName('MEM').Create('', glt.shape[2], glt.shape[0], 2, gdal.GDT_Int32)
+    for band in range(2):
+        glt_set.GetRasterBand(band + 1).WriteArray(glt[:, band, :])
+    return glt_set
+
+
+@pytest.mark.parametrize('tile_size', [37, 64, 1024])
+@pytest.mark.parametrize('edge_only', [False, True])
+def test_tiled_shade_distance_matches_whole(tile_size, edge_only):
+    shape = (160, 140)
+    _, glt, _ = synthetic_geometry(*shape, pixel_size=PIXEL_SIZE, rotation=-40)
+    glt_index = GltIndex.from_glt(glt.transpose((0, 2, 1)), shape)
+    clouds = synthetic_cloud_field(shape, 0.15)
+    solar_azimuth, solar_zenith = solar_angles(shape, 150)
+
+    whole = cloud_shade.shade_distance(clouds, np.stack((solar_azimuth, solar_zenith), axis=-1), glt_index,
+                                       PIXEL_SIZE, edge_only=edge_only)
+    tiled = cloud_shade.tiled_shade_distance(clouds, solar_azimuth, solar_zenith, write_glt(glt), PIXEL_SIZE,
+                                             tile_size=tile_size, edge_only=edge_only)
+    assert np.any(whole > 0)
+    np.testing.assert_array_equal(tiled, whole)
+
+
+@pytest.mark.parametrize('azimuth', [10.5, 45.5, 90.5, 150.5, 250.5, 330.5])
+@pytest.mark.parametrize('zenith', [30.5, 50.5])
+def test_binned_at_bin_centers_matches_exact(azimuth, zenith):
+    clouds = synthetic_cloud_field((150, 130), 0.1)
+    solar_azimuth, solar_zenith = np.full(clouds.shape, azimuth), np.full(clouds.shape, zenith)
+
+    reference = cloud_shade.cast_shadows(clouds, solar_azimuth, solar_zenith, PIXEL_SIZE)
+    binned = cloud_shade.cast_shadows_binned(clouds, solar_azimuth, solar_zenith, PIXEL_SIZE, angle_bins=(1, 1))
+    shaded, reference_shaded = binned > 0, reference > 0
+    assert np.any(reference_shaded)
+    # Rays only differ in their rasterization, so each shadow is within a pixel of the other
+    assert np.all(distance_transform_edt(~(reference_shaded | clouds))[shaded] <= 1)
+    assert np.all(distance_transform_edt(~(shaded | clouds))[reference_shaded] <= 1)
+    # Distances may come from another cloud where the rays differ; measured 0.90 to 1.0 within a pixel
+    both = shaded & reference_shaded
+    assert np.mean(np.abs(binned[both] - reference[both]) <= 1) > 0.85
+
+
+@pytest.mark.parametrize('edge_only', [False, True])
+def test_binned_scatter_matches_dense(monkeypatch, edge_only):
+    clouds = synthetic_cloud_field((150, 130), 0.1)
+    solar_azimuth, solar_zenith = solar_angles(clouds.shape, 200)
+
+    def _binned(scatter_cost):
+        monkeypatch.setattr(cloud_shade, 'BINNED_SCATTER_COST', scatter_cost)
+        return cloud_shade.cast_shadows_binned(clouds, solar_azimuth, solar_zenith, PIXEL_SIZE, angle_bins=(2, 1),
+                                               edge_only=edge_only, return_height=True)
+
+    # Every bin scattered, then every bin dilated over its bounding box
+    scattered, dense = _binned(0), _binned(10**9)
+    assert np.any(dense[0] > 0)
+    for scattered_band, dense_band in zip(scattered, dense):
+        np.testing.assert_array_equal(scattered_band, dense_band)
+
+
+@pytest.mark.parametrize('azimuth', [10, 100, 150, 200, 250, 330])
+@pytest.mark.parametrize('angle_bins', [None, (2, 1)])
+@pytest.mark.parametrize('edge_only', [False, True])
+def test_height_flags_match_separate_runs(azimuth, angle_bins, edge_only):
+    clouds = synthetic_cloud_field((150, 130), 0.1)
+    solar_azimuth, solar_zenith = solar_angles(clouds.shape, azimuth)
+    heights = [700.0, 1500.0, 2500.0, 4000.0]
+
+    distance, shade_height = cloud_shade.cast_shadows(clouds, solar_azimuth, solar_zenith, PIXEL_SIZE,
+                                                      angle_bins=angle_bins, edge_only=edge_only,
+                                                      cloud_height=max(heights), return_height=True)
+    flags, probability = cloud_shade.height_shadow_bands(shade_height, heights, weights=[1, 2, 3, 4])
+    np.testing.assert_array_equal(flags[-1], distance > 0)
+    for flag, cloud_height in zip(flags, heights):
+        separate = cloud_shade.cast_shadows(clouds, solar_azimuth, solar_zenith, PIXEL_SIZE, angle_bins=angle_bins,
+                                            edge_only=edge_only, cloud_height=cloud_height)
+        np.testing.assert_array_equal(flag, separate > 0)
+    assert np.all(np.diff(flags, axis=0) >= 0) and np.any(flags[0] < flags[-1])
+    np.testing.assert_allclose(probability, np.tensordot([0.1, 0.2, 0.3, 0.4], flags, axes=1), rtol=1e-6)
@@ -0,0 +1,57 @@
+import numpy as np
+import pytest
+from osgeo import gdal
+
+netCDF4 = pytest.importorskip('netCDF4')
+
+import cloud_shade
+import fused_pipeline
+import make_emit_masks
+import output_conversion
+from benchmarks.synthetic import write_synthetic_scene
+
+
+def read_netcdf(path):
+    """ Every variable of a netCDF file, by group and name """
+    variables = {}
+    with netCDF4.Dataset(path) as nc_ds:
+        groups = [nc_ds]
+        while groups:
+            group = groups.pop()
+            groups.extend(group.groups.values())
+            for name, variable in group.variables.items():
+                variables[f'{group.path.rstrip("/")}/{name}'] = np.array(variable[:])
+    return variables
+
+
+@pytest.mark.parametrize('shade_args', [[], ['--edge_only', '--angle_bins', '2', '1']])
+def test_fused_matches_stage_clis(tmp_path, shade_args):
+    files = write_synthetic_scene(str(tmp_path / 'scene'), n_lines=60, n_samples=50, n_bands=60, cloud_fraction=0.15,
+                                  seed=5, solar_azimuth=250.0)
+    inputs = [files[f] for f in ['rdnfile', 'locfile', 'obsfile', 'atmfile', 'cloudfile']]
+    mask_file, shade_file = str(tmp_path / 'mask'), str(tmp_path / 'shade.tif')
+
+    make_emit_masks.main(inputs + [files['irrfile'], mask_file, '--n_cores', '1', '--chunk_lines', '16'])
+    cloud_shade.main.main(args=[files['cloudfile'], files['obsfile'], files['gltfile'], shade_file,
+                                '--cloud_threshold', str(make_emit_masks.SPECTF_THRESHOLD)] + shade_args,
+                          standalone_mode=False)
+    output_conversion.main([str(tmp_path / 'staged.nc'), mask_file, files['locfile'], files['gltfile'], 'V001',
+                            'test', '--shade_file', shade_file])
+
+    fused_mask_file, fused_shade_file = str(tmp_path / 'fused_mask'), str(tmp_path / 'fused_shade.tif')
+    fused_pipeline.main(inputs + [files['gltfile'], files['irrfile'], str(tmp_path / 'fused.nc'), 'V001', 'test',
+                                  '--mask_outfile', fused_mask_file, '--shade_outfile', fused_shade_file,
+                                  '--n_cores', '1', '--chunk_lines', '16'] + shade_args)
+
+    # Intermediate products, then every variable of the netCDF
+    with open(mask_file, 'rb') as staged, open(fused_mask_file, 'rb') as fused:
+        assert staged.read() == fused.read()
+    staged_shade = gdal.Open(shade_file).ReadAsArray()
+    assert np.any(staged_shade > 0)
+    np.testing.assert_array_equal(gdal.Open(fused_shade_file).ReadAsArray(), staged_shade)
+
+    staged, fused = read_netcdf(str(tmp_path / 'staged.nc')), read_netcdf(str(tmp_path / 'fused.nc'))
+    assert sorted(fused) == sorted(staged)
+    assert '/cloud_shadow_distance' in fused
+    for name in staged:
+        np.testing.assert_array_equal(fused[name], staged[name], err_msg=name)
@@ -0,0 +1,38 @@
+import numpy as np
+
+from glt_index import GltIndex
+from benchmarks.synthetic import synthetic_geometry
+
+
+def test_ortho_unortho_round_trip():
+    shape = (90, 70)
+    _, glt, _ = synthetic_geometry(*shape, rotation=25)
+    glt_index = GltIndex.from_glt(glt.transpose((0, 2, 1)), shape)
+    img = np.random.default_rng(0).random(shape + (3,)).astype(np.float32)
+
+    ortho = glt_index.ortho(img)
+    assert ortho.shape == glt_index.ortho_shape + (3,)
+    assert ortho.dtype == np.float32
+    raw = glt_index.unortho(ortho)
+
+    # Every raw pixel with a GLT entry comes back unchanged, the others are nodata
+    mapped = (glt_index.inverse >= 0).reshape(shape)
+    assert np.any(mapped)
+    np.testing.assert_array_equal(raw[mapped], img[mapped])
+    assert np.all(np.isnan(raw[~mapped]))
+
+    filled = glt_index.unortho(ortho, interpolate=True)
+    np.testing.assert_array_equal(filled[mapped], img[mapped])
+    assert not np.any(np.isnan(filled))
+
+
+def test_ortho_matches_glt_lookup():
+    shape = (40, 30)
+    _, glt, _ = synthetic_geometry(*shape, rotation=-10)
+    glt = glt.transpose((0, 2, 1))
+    img = np.arange(np.prod(shape), dtype=np.int32).reshape(shape)
+
+    ortho = GltIndex.from_glt(glt, shape).ortho(img, nodata_value=-1)
+    valid = np.all(glt != 0, axis=-1)
+    np.testing.assert_array_equal(ortho[valid], img[glt[valid, 1] - 1, glt[valid, 0] - 1])
+    assert np.all(ortho[~valid] == -1)
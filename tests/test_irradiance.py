@@ -0,0 +1,81 @@
+import os
+
+import numpy as np
+import pytest
+
+import irradiance
+
+
+@pytest.fixture
+def irr_file(tmp_path, monkeypatch):
+    """ Irradiance text file, with the in-process cache cleared around each test """
+    monkeypatch.setattr(irradiance, '_resampled', {})
+    irr_wl = np.arange(350.0, 2550.0, 0.5)
+    spectrum = np.stack([irr_wl, 1000 + 500 * np.sin(irr_wl / 100)], axis=1)
+    path = str(tmp_path / 'irradiance.txt')
+    np.savetxt(path, spectrum, header='wavelength irradiance')
+    return path
+
+
+@pytest.fixture
+def grid():
+    wl = np.linspace(380, 2500, 40)
+    return wl, np.full(wl.shape, 8.0)
+
+
+def cached_files(cache_dir, prefix):
+    return sorted(f for f in os.listdir(cache_dir) if f.startswith(prefix))
+
+
+def test_load_irradiance_cache(irr_file, tmp_path):
+    cache_dir = str(tmp_path / 'cache')
+    irr_wl, irr = irradiance.load_irradiance(irr_file)
+    assert not os.path.exists(cache_dir)
+
+    cached_wl, cached = irradiance.load_irradiance(irr_file, cache_dir)
+    assert len(cached_files(cache_dir, 'irradiance_')) == 1
+    np.testing.assert_array_equal(cached_wl, irr_wl)
+    np.testing.assert_array_equal(cached, irr)
+    np.testing.assert_array_equal(irradiance.load_irradiance(irr_file, cache_dir)[1], irr)
+    assert len(cached_files(cache_dir, 'irradiance_')) == 1
+
+
+def test_resampled_irradiance_cache(irr_file, grid, tmp_path, monkeypatch):
+    wl, fwhm = grid
+    cache_dir = str(tmp_path / 'cache')
+    irr_resamp = irradiance.resampled_irradiance(irr_file, wl, fwhm, cache_dir)
+    assert irr_resamp.dtype == np.float32 and irr_resamp.shape == wl.shape
+    assert not irr_resamp.flags.writeable
+    resampled_files = cached_files(cache_dir, 'irradiance_resampled_')
+    assert len(resampled_files) == 1
+
+    # Reused from memory, then from disk in a fresh process, without resampling again
+    def _not_cached(*args, **kwargs):
+        raise AssertionError('irradiance resampled despite the cache')
+
+    monkeypatch.setattr(irradiance, 'resample_spectrum', _not_cached)
+    assert irradiance.resampled_irradiance(irr_file, wl, fwhm, cache_dir) is irr_resamp
+    irradiance._resampled.clear()
+    from_disk = irradiance.resampled_irradiance(irr_file, wl, fwhm, cache_dir)
+    assert isinstance(from_disk, np.memmap)
+    np.testing.assert_array_equal(from_disk, irr_resamp)
+
+    # A changed wavelength grid or irradiance file is a different key
+    with pytest.raises(AssertionError):
+        irradiance.resampled_irradiance(irr_file, wl + 0.1, fwhm, cache_dir)
+    with pytest.raises(AssertionError):
+        irradiance.resampled_irradiance(irr_file, wl, fwhm + 0.1, cache_dir)
+    stat = os.stat(irr_file)
+    os.utime(irr_file, ns=(stat.st_atime_ns, stat.st_mtime_ns + 10**9))
+    with pytest.raises(AssertionError):
+        irradiance.resampled_irradiance(irr_file, wl, fwhm, cache_dir)
+    assert cached_files(cache_dir, 'irradiance_resampled_') == resampled_files
+
+
+def test_resampled_irradiance_without_cache_dir(irr_file, grid, tmp_path):
+    wl, fwhm = grid
+    uncached = irradiance.resampled_irradiance(irr_file, wl, fwhm)
+    irradiance._resampled.clear()
+    cached = irradiance.resampled_irradiance(irr_file, wl, fwhm, str(tmp_path / 'cache'))
+    np.testing.assert_array_equal(uncached, cached)
+    assert sorted(os.listdir(tmp_path)) == ['cache', 'irradiance.txt']
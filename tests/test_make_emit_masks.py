@@ -0,0 +1,195 @@
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import pytest
+from scipy.ndimage import distance_transform_edt
+
+import make_emit_masks
+
+
+class ArrayDataset:
+    """ The ReadAsArray window of a gdal dataset, over an array """
+
+    def __init__(self, data):
+        self.data = data
+
+    def ReadAsArray(self, xoff=0, yoff=0, xsize=None, ysize=None):
+        return self.data[yoff:yoff + ysize, xoff:xoff + xsize]
+
+
+def whole_cube_masks(rdn, zen_deg, atm, tf_prob, irr, wl, aod_bands, h2o_band, pixel_size, aerosol_threshold):
+    """ The mask product computed over the whole (lines, samples, bands) cube at once, as before streaming """
+    bands = [np.argmin(abs(wl - w)) for w in make_emit_masks.THRESHOLD_WAVELENGTHS]
+    b450, b762, b780, b1000, b1250, b1380, b1650 = bands
+    zen = np.radians(zen_deg)
+    rho = rdn * np.pi / irr[np.newaxis, np.newaxis, :] / np.cos(zen)[..., np.newaxis]
+    bad = rdn[..., 0] <= -9990
+    rho[bad, :] = -9999.0
+
+    mask = np.zeros(rdn.shape[:2] + (len(make_emit_masks.MASK_BAND_NAMES),))
+    mask[..., 0] = (rho[..., b450] > 0.28) & (rho[..., b1250] > 0.46) & (rho[..., b1650] > 0.22)
+    mask[..., 1] = rho[..., b1380] > 0.1
+    mask[..., 2] = rho[..., b1000] < 0.05
+    mask[..., 3] = rho[..., b762] / rho[..., b780] > 0.8
+    cloud_projection_dist = np.tan(zen) * make_emit_masks.MAX_CLOUD_HEIGHT / pixel_size
+    mask[..., 5] = atm[..., aod_bands].sum(axis=2)
+    mask[..., 6] = atm[..., h2o_band].squeeze(axis=2)
+    mask[np.logical_or(mask[..., 0] == 1, mask[..., 1] == 1), 2:4] = 0
+
+    cloudinv = np.logical_not(np.logical_or(mask[..., 0], mask[..., 1]))
+    cloudinv[bad] = 1
+    mask[..., 4] = cloud_projection_dist >= distance_transform_edt(cloudinv)
+    mask[..., 7] = np.logical_or(np.sum(mask[..., 0:5], axis=-1) > 0, mask[..., 5] > aerosol_threshold)
+    mask[..., 8] = tf_prob
+    mask[..., 9] = mask[..., 8] > make_emit_masks.SPECTF_THRESHOLD
+
+    tfinv = np.logical_not(mask[..., 9])
+    tfinv[bad] = 1
+    tf_distance = distance_transform_edt(tfinv)
+    tf_distance[cloud_projection_dist <= tf_distance] = -1
+    mask[..., 10] = tf_distance
+    mask[bad, :] = make_emit_masks.NODATA_VALUE
+    return mask.astype(np.float32)
+
+
+def synthetic_inputs(n_lines=120, n_samples=90, n_bands=60, seed=0):
+    rng = np.random.default_rng(seed)
+    wl = np.linspace(380, 2500, n_bands)
+    irr = rng.uniform(50, 200, n_bands).astype(np.float32)
+    base = rng.uniform(0, 0.6, (n_lines, n_samples, 1)).astype(np.float32)
+    rdn = (base * irr / np.pi * rng.uniform(0.5, 1.2, (n_lines, n_samples, n_bands))).astype(np.float32)
+    rdn[rng.random((n_lines, n_samples)) < 0.01, :] = -9999
+    rdn[:3] = -9999
+    zen = rng.uniform(10, 60, (n_lines, n_samples)).astype(np.float32)
+    atm = rng.uniform(0, 1, (n_lines, n_samples, 3)).astype(np.float32)
+    tf_prob = rng.uniform(0, 1, (n_lines, n_samples)).astype(np.float32)
+    tf_prob[rng.random((n_lines, n_samples)) < 0.3] = 0.51
+    return rdn, zen, atm, tf_prob, irr, wl
+
+
+@pytest.mark.parametrize('chunk_lines', [1, 7, 64, 1000])
+@pytest.mark.parametrize('n_cores', [1, 3])
+def test_streamed_masks_match_whole_cube(chunk_lines, n_cores):
+    rdn, zen, atm, tf_prob, irr, wl = synthetic_inputs()
+    obs = np.zeros(zen.shape + (6,), dtype=np.float32)
+    obs[..., 4] = zen
+    pixel_size = np.float64(57.3)
+
+    reference = whole_cube_masks(rdn, zen, atm, tf_prob, irr, wl, [0, 1], [2], pixel_size, 0.5)
+    blocks = make_emit_masks.generate_mask_blocks(
+        rdn.transpose((0, 2, 1)), obs.transpose((0, 2, 1)), atm.transpose((0, 2, 1)), ArrayDataset(tf_prob), irr,
+        make_emit_masks.get_band_indices(wl), [0, 1], [2], pixel_size, 0.5, chunk_lines, n_cores=n_cores)
+    streamed = np.concatenate([mask.to_bip() for _, _, mask in blocks])
+    assert streamed.tobytes() == reference.tobytes()
+
+
+@pytest.mark.parametrize('tile_size', [16, 50, 256])
+def test_threaded_buffer_tiles_match_serial(tile_size):
+    rng = np.random.default_rng(1)
+    featureless = rng.random((130, 110)) > 0.01
+
+    serial = make_emit_masks.buffer_distance(featureless, 12, tile_size=tile_size)
+    with ThreadPoolExecutor(max_workers=4) as executor:
+        threaded = make_emit_masks.buffer_distance(featureless, 12, executor, tile_size=tile_size)
+    assert threaded.tobytes() == serial.tobytes()
+
+
+def full_product(n_lines=23, n_samples=17, seed=2):
+    """ Random full float32 mask product, with every flag band varying and some no data pixels """
+    rng = np.random.default_rng(seed)
+    full = rng.uniform(-1, 5, (n_lines, n_samples, len(make_emit_masks.MASK_BAND_NAMES))).astype(np.float32)
+    full[..., make_emit_masks.FLAG_BANDS] = rng.integers(0, 2, (n_lines, n_samples, len(make_emit_masks.FLAG_BANDS)))
+    full[rng.random((n_lines, n_samples)) < 0.1] = make_emit_masks.NODATA_VALUE
+    return full
+
+
+def pack(full):
+    """ MaskBlock of a full product, packed bit by bit """
+    flags = np.zeros(full.shape[:2], dtype=np.uint8)
+    for bit, band in enumerate(make_emit_masks.FLAG_BANDS):
+        flags |= (full[..., band] == 1).astype(np.uint8) << bit
+    bad = full[..., 0] == make_emit_masks.NODATA_VALUE
+    flags[bad] = make_emit_masks.NODATA_FLAGS
+    continuous = np.ascontiguousarray(np.moveaxis(full[..., make_emit_masks.CONTINUOUS_BANDS], -1, 1))
+    return make_emit_masks.MaskBlock(flags, continuous)
+
+
+def test_compact_masks_round_trip(tmp_path):
+    full = full_product()
+    bad = full[..., 0] == make_emit_masks.NODATA_VALUE
+    assert np.any(bad) and not np.all(bad)
+    mask = pack(full)
+    assert mask.shape == full.shape
+    assert np.all(mask.flags[bad] >> make_emit_masks.NODATA_BIT == 1)
+    assert not np.any(mask.flags[~bad] >> make_emit_masks.NODATA_BIT)
+
+    assert mask.to_bip().tobytes() == full.tobytes()
+    assert mask.to_bip(5, 11).tobytes() == full[5:11].tobytes()
+    assert mask.to_bil().tobytes() == full.transpose((0, 2, 1)).tobytes()
+    for line in [0, 7, full.shape[0] - 1]:
+        assert mask.bil_line(line).tobytes() == full[line].T.tobytes()
+    for band in make_emit_masks.FLAG_BANDS:
+        np.testing.assert_array_equal(mask.flag(band), full[..., band] == 1)
+
+    with open(tmp_path / 'full', 'wb') as fout:
+        mask.write_bil(fout)
+    assert (tmp_path / 'full').read_bytes() == full.transpose((0, 2, 1)).tobytes()
+
+    compact_file = str(tmp_path / 'compact')
+    with open(compact_file, 'wb') as flag_out, \
+            open(make_emit_masks.continuous_filename(compact_file), 'wb') as continuous_out:
+        mask.write_compact(flag_out, continuous_out)
+    flags = np.fromfile(compact_file, dtype=np.uint8).reshape(full.shape[:2])
+    continuous = np.fromfile(make_emit_masks.continuous_filename(compact_file), dtype=np.float32)
+    read_back = make_emit_masks.MaskBlock(flags, continuous.reshape(mask.continuous.shape))
+    assert read_back.to_bip().tobytes() == full.tobytes()
+
+
+def test_concatenated_blocks_match_scene():
+    full = full_product()
+    blocks = [pack(full[start:stop]) for start, stop in make_emit_masks.block_ranges(full.shape[0], 6)]
+    assert make_emit_masks.MaskBlock.concatenate(blocks).to_bip().tobytes() == full.tobytes()
+
+
+@pytest.mark.parametrize('halo', [3, 12])
+@pytest.mark.parametrize('tile_size', [1, 16, 50, 256])
+def test_buffer_distance_exact_within_halo(halo, tile_size):
+    rng = np.random.default_rng(3)
+    featureless = rng.random((130, 110)) > 0.002
+    featureless[:, 60:] = True
+    reference = distance_transform_edt(featureless)
+    assert np.any(reference > 2 * halo)
+
+    distance = make_emit_masks.buffer_distance(featureless, halo, tile_size=tile_size)
+    near = reference <= halo
+    np.testing.assert_array_equal(distance[near], reference[near])
+    assert np.all(distance[~near] > halo)
+    if tile_size <= 50:
+        assert np.any(np.isinf(distance))
+
+    np.testing.assert_array_equal(make_emit_masks.buffer_distance(np.ones((20, 30), dtype=bool), halo),
+                                  distance_transform_edt(np.ones((20, 30), dtype=bool)))
+
+
+def test_spacecraft_flag_needs_780_reflectance():
+    # Reflectance at 762 and 780 nm, with the solar zenith at 0 and unit irradiance
+    rho_762 = np.array([[0.45, 0.25, 0.9, 0.0, 0.3, 0.0]], dtype=np.float32)
+    rho_780 = np.array([[0.5, 0.5, 0.0, 0.0, -0.1, 0.3]], dtype=np.float32)
+    spacecraft = np.array([[True, False, False, False, False, False]])
+    rdn = np.full(rho_762.shape + (len(make_emit_masks.THRESHOLD_WAVELENGTHS),), 0.3 / np.pi, dtype=np.float32)
+    rdn[..., 1] = rho_762 / np.pi
+    rdn[..., 2] = rho_780 / np.pi
+    zen = np.zeros(rho_762.shape, dtype=np.float32)
+    irr = np.ones(rdn.shape[-1], dtype=np.float32)
+    bit = make_emit_masks.flag_bits(3)
+
+    # Work planes left holding a ratio above the threshold everywhere by an earlier block
+    scratch = make_emit_masks.ThresholdScratch(rho_762.size, np.float32)
+    earlier = rdn.copy()
+    earlier[..., 1] = 0.9 / np.pi
+    earlier[..., 2] = 0.5 / np.pi
+    assert np.all(make_emit_masks.threshold_flags(earlier, earlier[..., 0], zen, irr, scratch) & bit)
+
+    for block_scratch in [None, scratch]:
+        flags = make_emit_masks.threshold_flags(rdn, rdn[..., 0], zen, irr, block_scratch)
+        np.testing.assert_array_equal(flags & bit == bit, spacecraft)
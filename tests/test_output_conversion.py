@@ -0,0 +1,74 @@
+import threading
+
+import numpy as np
+import pytest
+
+netCDF4 = pytest.importorskip('netCDF4')
+pytest.importorskip('h5py')
+
+from output_conversion import add_mask_variable, write_chunks_parallel
+
+
+BAND_NAMES = ['Cloud flag', 'Cirrus flag', 'Water flag', 'Spacecraft flag', 'Dilated cloud flag', 'AOD550',
+              'H2O (g cm-2)', 'Aggregate flag']
+
+
+def write_mask(path, mask, complevel, shuffle, n_workers):
+    nc_ds = netCDF4.Dataset(path, 'w', format='NETCDF4')
+    nc_ds.createDimension('downtrack', mask.shape[0])
+    nc_ds.createDimension('crosstrack', mask.shape[1])
+    nc_ds.createDimension('bands', mask.shape[2])
+    finish = add_mask_variable(nc_ds, mask, BAND_NAMES, chunk_lines=16, complevel=complevel, shuffle=shuffle,
+                               n_workers=n_workers)
+    nc_ds.close()
+    finish(path)
+    with netCDF4.Dataset(path) as nc_ds:
+        return np.array(nc_ds['mask'][:])
+
+
+@pytest.mark.parametrize('complevel', [0, 4])
+@pytest.mark.parametrize('shuffle', [False, True])
+def test_parallel_chunks_match_serial(tmp_path, complevel, shuffle):
+    rng = np.random.default_rng(0)
+    mask = rng.integers(0, 2, (70, 23, len(BAND_NAMES))).astype(np.float32)
+    mask[..., 5:7] = rng.random((70, 23, 2), dtype=np.float32)
+
+    serial = write_mask(str(tmp_path / 'serial.nc'), mask, complevel, shuffle, n_workers=1)
+    parallel = write_mask(str(tmp_path / 'parallel.nc'), mask, complevel, shuffle, n_workers=4)
+    np.testing.assert_array_equal(serial, mask)
+    np.testing.assert_array_equal(parallel, mask)
+
+
+
+def test_parallel_chunks_are_bounded(tmp_path):
+    path = str(tmp_path / 'bounded.nc')
+    mask = np.arange(200 * 5 * 3, dtype=np.float32).reshape(200, 5, 3)
+    nc_ds = netCDF4.Dataset(path, 'w', format='NETCDF4')
+    for name, size in zip(['downtrack', 'crosstrack', 'bands'], mask.shape):
+        nc_ds.createDimension(name, size)
+    nc_ds.createVariable('mask', 'f4', ('downtrack', 'crosstrack', 'bands'), zlib=True, complevel=4,
+                         chunksizes=(4,) + mask.shape[1:])
+    nc_ds.close()
+
+    # The first chunk stalls the writer, until more chunks than the window are read or a timeout
+    n_workers = 3
+    release = threading.Event()
+    lock = threading.Lock()
+    read_ahead = []
+    later_chunks = []
+
+    def get_slab(start, stop):
+        if start == 0:
+            release.wait(timeout=1)
+            read_ahead.append(len(later_chunks))
+        else:
+            with lock:
+                later_chunks.append(start)
+                if len(later_chunks) > 2 * n_workers:
+                    release.set()
+        return mask[start:stop]
+
+    write_chunks_parallel(path, 'mask', get_slab, mask.shape[0], 4, n_workers)
+    assert read_ahead[0] < 2 * n_workers
+    with netCDF4.Dataset(path) as nc_ds:
+        np.testing.assert_array_equal(np.array(nc_ds['mask'][:]), mask)
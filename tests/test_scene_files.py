@@ -0,0 +1,83 @@
+import os
+
+import numpy as np
+import pytest
+from osgeo import gdal
+from spectral.io import envi
+
+from scene_files import EnviFile, describe_scene, INTERLEAVE_AXES
+
+
+def write_raw_envi(path, bsq, interleave, header_offset=0, byte_order=0):
+    """ Write a (bands, lines, samples) array as an ENVI file of any interleave, offset and byte order """
+    bands, lines, samples = bsq.shape
+    bil = bsq.transpose((1, 0, 2))
+    stored = bil.transpose(INTERLEAVE_AXES[interleave])
+    dtype = bsq.dtype.newbyteorder('>' if byte_order == 1 else '<')
+    with open(path, 'wb') as fout:
+        fout.write(b'\0' * header_offset)
+        fout.write(np.ascontiguousarray(stored, dtype=dtype).tobytes())
+    envi.write_envi_header(os.path.splitext(path)[0] + '.hdr',
+                           {'lines': lines, 'samples': samples, 'bands': bands, 'interleave': interleave,
+                            'header offset': header_offset, 'byte order': byte_order,
+                            'data type': {np.dtype(np.int16): 2, np.dtype(np.float32): 4}[bsq.dtype],
+                            'band names': [f'band {b}' for b in range(bands)]})
+
+
+@pytest.mark.parametrize('interleave', ['bil', 'bip', 'bsq'])
+@pytest.mark.parametrize('header_offset, byte_order', [(0, 0), (128, 1)])
+@pytest.mark.parametrize('dtype', [np.float32, np.int16])
+def test_memmap_matches_gdal(tmp_path, interleave, header_offset, byte_order, dtype):
+    rng = np.random.default_rng(0)
+    bsq = (rng.standard_normal((4, 9, 7)) * 1000).astype(dtype)
+    path = str(tmp_path / 'data.img')
+    write_raw_envi(path, bsq, interleave, header_offset, byte_order)
+
+    ds = EnviFile(path)
+    assert (ds.lines, ds.bands, ds.samples) == (9, 4, 7)
+    assert ds.band_names == [f'band {b}' for b in range(4)]
+    ds.check_size()
+
+    reference = gdal.Open(path, gdal.GA_ReadOnly).ReadAsArray()
+    np.testing.assert_array_equal(reference, bsq)
+    np.testing.assert_array_equal(ds.memmap('bsq'), reference)
+    np.testing.assert_array_equal(ds.memmap('bil'), reference.transpose((1, 0, 2)))
+    np.testing.assert_array_equal(ds.memmap('bip'), reference.transpose((1, 2, 0)))
+    # One memory map, viewed in every interleave
+    assert ds.memmap('bip').base is ds.memmap('bsq').base
+
+
+def test_check_size(tmp_path):
+    path = str(tmp_path / 'data.img')
+    write_raw_envi(path, np.zeros((2, 5, 3), dtype=np.float32), 'bil', header_offset=16)
+    EnviFile(path).check_size()
+    with open(path, 'r+b') as fout:
+        fout.truncate(os.path.getsize(path) - 1)
+    with pytest.raises(ValueError, match='header describes'):
+        EnviFile(path).check_size()
+
+
+@pytest.mark.parametrize('name, shape, message', [
+    ('loc', (3, 8, 5), 'LOC and input'),
+    ('loc', (2, 9, 5), 'three bands'),
+    ('obs', (11, 9, 4), 'OBS and input'),
+    ('atm', (2, 8, 5), 'Label and input'),
+])
+def test_describe_scene_dimensions(tmp_path, name, shape, message):
+    shapes = {'rdn': (6, 9, 5), 'loc': (3, 9, 5), 'obs': (11, 9, 5), 'atm': (2, 9, 5)}
+    shapes[name] = shape
+    paths = {}
+    for key, bsq_shape in shapes.items():
+        paths[key] = str(tmp_path / f'{key}.img')
+        write_raw_envi(paths[key], np.zeros(bsq_shape, dtype=np.float32), 'bil')
+    with pytest.raises(ValueError, match=message):
+        describe_scene(paths['rdn'], paths['loc'], paths['obs'], paths['atm'])
+
+
+def test_describe_scene(tmp_path):
+    paths = {}
+    for key, bands in [('rdn', 6), ('loc', 3), ('obs', 11), ('atm', 2)]:
+        paths[key] = str(tmp_path / f'{key}.img')
+        write_raw_envi(paths[key], np.zeros((bands, 9, 5), dtype=np.float32), 'bil')
+    scene = describe_scene(paths['rdn'], paths['loc'], paths['obs'], paths['atm'])
+    assert {k: ds.bands for k, ds in scene.items()} == {'rdn': 6, 'loc': 3, 'obs': 11, 'atm': 2}
@@ -0,0 +1,65 @@
+import os
+
+import numpy as np
+import pytest
+
+import scene_geometry
+from benchmarks.synthetic import synthetic_geometry, write_envi
+
+
+PIXEL_SIZE = 60.0
+
+
+@pytest.fixture
+def loc_file(tmp_path):
+    """ LOC file of a track near 34N, with a ground spacing of PIXEL_SIZE between lines """
+    loc, _, _ = synthetic_geometry(40, 30, pixel_size=PIXEL_SIZE, rotation=12, lat=34.0)
+    path = str(tmp_path / 'loc' / 'loc.img')
+    os.makedirs(os.path.dirname(path))
+    write_envi(path, loc)
+    return path
+
+
+def test_loc_pixel_size_reads_longitude_then_latitude(loc_file):
+    # Swapping longitude and latitude gives about 31 m on this track
+    np.testing.assert_allclose(scene_geometry.loc_pixel_size(loc_file), PIXEL_SIZE, rtol=1e-3)
+    line_pixel_size = scene_geometry.loc_pixel_size(loc_file, per_line=True)
+    assert line_pixel_size.shape == (40,)
+    np.testing.assert_allclose(line_pixel_size, PIXEL_SIZE, rtol=1e-3)
+
+
+def test_map_info_pixel_size_converts_degrees():
+    utm = ['UTM', '1', '1', '500000.0', '3760000.0', '60.0', '60.0', '11', 'North', 'WGS-84']
+    assert scene_geometry.map_info_pixel_size(utm) == 60.0
+
+    degrees = str(float(np.degrees(PIXEL_SIZE / scene_geometry.EARTH_RADIUS)))
+    geographic = ['Geographic Lat/Lon', '1', '1', '-117.0', '34.0', degrees, degrees, 'WGS-84']
+    assert scene_geometry.map_info_pixel_size(geographic) == pytest.approx(PIXEL_SIZE)
+    assert scene_geometry.scene_pixel_size('unused', map_info=geographic) == pytest.approx(PIXEL_SIZE)
+
+
+def test_pixel_size_cache_is_opt_in(loc_file, tmp_path, monkeypatch):
+    loc_dir_files = sorted(os.listdir(os.path.dirname(loc_file)))
+    pixel_size = scene_geometry.scene_pixel_size(loc_file)
+    assert sorted(os.listdir(os.path.dirname(loc_file))) == loc_dir_files
+
+    cache_dir = str(tmp_path / 'cache')
+    assert scene_geometry.scene_pixel_size(loc_file, cache_dir=cache_dir) == pixel_size
+    line_pixel_size = scene_geometry.scene_pixel_size(loc_file, per_line=True, cache_dir=cache_dir)
+    assert len(os.listdir(cache_dir)) == 1
+    assert sorted(os.listdir(os.path.dirname(loc_file))) == loc_dir_files
+
+    def _not_cached(*args, **kwargs):
+        raise AssertionError('LOC file read despite the cache')
+
+    monkeypatch.setattr(scene_geometry, 'loc_pixel_size', _not_cached)
+    cached = scene_geometry.scene_pixel_size(loc_file, cache_dir=cache_dir)
+    assert cached == pixel_size and isinstance(cached, np.float64)
+    np.testing.assert_array_equal(scene_geometry.scene_pixel_size(loc_file, per_line=True, cache_dir=cache_dir),
+                                  line_pixel_size)
+
+    # A rewritten LOC file is read again
+    stat = os.stat(loc_file)
+    os.utime(loc_file, ns=(stat.st_atime_ns, stat.st_mtime_ns + 10**9))
+    with pytest.raises(AssertionError):
+        scene_geometry.scene_pixel_size(loc_file, cache_dir=cache_dir)
@@ -0,0 +1,124 @@
+import os
+
+import numpy as np
+import pytest
+
+import make_emit_masks
+import stage_cache
+from stage_cache import StageCache
+from benchmarks.synthetic import write_synthetic_scene
+
+
+@pytest.fixture
+def input_file(tmp_path):
+    path = str(tmp_path / 'input.txt')
+    with open(path, 'w') as fout:
+        fout.write('input')
+    return path
+
+
+def keyed(cache_dir, input_file, version=1, software_version=None, threshold=0.5, upstream_version=1):
+    cache = StageCache(cache_dir, software_version=software_version)
+    cache.key('upstream', upstream_version, files=[input_file])
+    cache.key('stage', version, upstream=['upstream'], files=[input_file],
+              params={'threshold': threshold, 'weights': np.arange(3.0)})
+    return cache
+
+
+def test_saved_stage_is_reused(tmp_path, input_file):
+    cache_dir = str(tmp_path / 'cache')
+    flags = np.arange(12, dtype=np.uint8).reshape(3, 4)
+    distance = np.linspace(0, 1, 6, dtype=np.float32)
+    cache = keyed(cache_dir, input_file)
+    assert cache.load('stage') is None
+    cache.save('stage', flags=flags, distance=distance)
+
+    cached = keyed(cache_dir, input_file).load('stage')
+    assert sorted(cached) == ['distance', 'flags']
+    assert isinstance(cached['flags'], np.memmap) and not cached['flags'].flags.writeable
+    np.testing.assert_array_equal(cached['flags'], flags)
+    np.testing.assert_array_equal(cached['distance'], distance)
+    assert cached['distance'].dtype == np.float32
+    assert sorted(os.listdir(cache_dir)) == ['manifest.json', 'stage']
+
+
+@pytest.mark.parametrize('change', [{'threshold': 0.6}, {'version': 2}, {'software_version': 'V2'},
+                                    {'upstream_version': 2}, 'file', 'cache_version'])
+def test_changed_inputs_recompute(tmp_path, input_file, monkeypatch, change):
+    cache_dir = str(tmp_path / 'cache')
+    keyed(cache_dir, input_file).save('stage', flags=np.ones(4, dtype=np.uint8))
+    assert keyed(cache_dir, input_file).load('stage') is not None
+
+    kwargs = {}
+    if change == 'file':
+        stat = os.stat(input_file)
+        os.utime(input_file, ns=(stat.st_atime_ns, stat.st_mtime_ns + 10**9))
+    elif change == 'cache_version':
+        monkeypatch.setattr(stage_cache, 'STAGE_CACHE_VERSION', stage_cache.STAGE_CACHE_VERSION + 1)
+    else:
+        kwargs = change
+    assert keyed(cache_dir, input_file, **kwargs).load('stage') is None
+
+
+def test_unusable_cache_recomputes(tmp_path, input_file, caplog):
+    cache_dir = str(tmp_path / 'cache')
+    keyed(cache_dir, input_file).save('stage', flags=np.ones(4, dtype=np.uint8), distance=np.zeros(2))
+
+    # A missing array file
+    os.remove(os.path.join(cache_dir, 'stage', 'distance.npy'))
+    assert keyed(cache_dir, input_file).load('stage') is None
+
+    # A corrupt manifest is ignored, and replaced by the next save
+    with open(os.path.join(cache_dir, 'manifest.json'), 'w') as fout:
+        fout.write('{"stage": {"key"')
+    cache = keyed(cache_dir, input_file)
+    assert 'unreadable stage manifest' in caplog.text
+    assert cache.load('stage') is None
+    cache.save('stage', flags=np.zeros(4, dtype=np.uint8))
+    np.testing.assert_array_equal(keyed(cache_dir, input_file).load('stage')['flags'], 0)
+
+
+def test_created_arrays_replace_stage(tmp_path, input_file):
+    cache_dir = str(tmp_path / 'cache')
+    cache = keyed(cache_dir, input_file)
+    cache.save('stage', flags=np.ones((4, 3), dtype=np.uint8), old=np.ones(2))
+    earlier = cache.load('stage')
+
+    stored = cache.create('stage', flags=((4, 3), np.uint8))
+    # Uncommitted arrays are not loaded
+    np.testing.assert_array_equal(keyed(cache_dir, input_file).load('stage')['flags'], 1)
+    for line in range(4):
+        stored['flags'][line] = line
+    cache.commit('stage', stored)
+
+    cached = keyed(cache_dir, input_file).load('stage')
+    assert sorted(cached) == ['flags']
+    np.testing.assert_array_equal(cached['flags'], np.arange(4)[:, np.newaxis].repeat(3, axis=1))
+    np.testing.assert_array_equal(earlier['flags'], 1)
+    assert sorted(os.listdir(cache_dir)) == ['manifest.json', 'stage']
+
+
+def test_make_masks_reuses_cached_stages(tmp_path, monkeypatch):
+    files = write_synthetic_scene(str(tmp_path / 'scene'), n_lines=40, n_samples=30, n_bands=60, seed=4)
+    inputs = [files[f] for f in ['rdnfile', 'locfile', 'obsfile', 'atmfile', 'cloudfile', 'irrfile']]
+    cache_dir = str(tmp_path / 'cache')
+
+    reference, _ = make_emit_masks.make_masks(*inputs, n_cores=1, chunk_lines=16, keep_masks=True)
+    computed, _ = make_emit_masks.make_masks(*inputs, outfile=str(tmp_path / 'computed'), n_cores=1, chunk_lines=16,
+                                             stage_cache=StageCache(cache_dir))
+    assert computed is None
+    assert os.path.isfile(os.path.join(cache_dir, 'masks', 'flags.npy'))
+
+    def _not_cached(*args, **kwargs):
+        raise AssertionError('masks recomputed despite the cache')
+
+    monkeypatch.setattr(make_emit_masks, 'generate_mask_blocks', _not_cached)
+    cached, _ = make_emit_masks.make_masks(*inputs, outfile=str(tmp_path / 'cached'), n_cores=1, chunk_lines=16,
+                                           keep_masks=True, stage_cache=StageCache(cache_dir))
+    assert cached.to_bip().tobytes() == reference.to_bip().tobytes()
+    assert (tmp_path / 'cached').read_bytes() == (tmp_path / 'computed').read_bytes()
+    assert (tmp_path / 'cached').read_bytes() == reference.to_bil().tobytes()
+
+    with pytest.raises(AssertionError):
+        make_emit_masks.make_masks(*inputs, n_cores=1, chunk_lines=16, aerosol_threshold=0.4,
+                                   stage_cache=StageCache(cache_dir))